@@ -0,0 +1,210 @@
+import os
+import sys
+import json
+import time
+import argparse
+import traceback
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from numpy import asarray
+
+'''
+Headless batch rectification
+
+Re-rectifies every photo in a directory from its saved constraints, on a process
+pool, without a display (only QtGui is used, for image files):
+
+    python src/batchrectify.py photos/ --output rectified/ --jobs 8
+
+Each photo has a JSON sidecar with the same stem (photo.jpg -> photo.json):
+
+    {
+      "points": [[image_x, image_y, world_x, world_y], ...],   weight optional, 5th value
+      "transform": [[...], [...], [...]],     optional, used instead of solving the points
+      "resolution": 300,                      optional, output pixels per world unit
+      "camera": "name",                       optional, lens profile from config/cameras.ini
+      "outline": [[image_x, image_y], ...]    optional, convex board outline to limit the warp to
+    }
+
+Outputs are written as <stem>.<format>; .npy outputs are streamed to a memmap, so
+they work for images larger than memory. Format dzi streams the same way and then
+writes a Deep Zoom tile pyramid, <stem>.dzi and <stem>_files/. With --crop, photos
+without an "outline" have the board found automatically (outline.py), and only the
+board is rectified. The exit status is 1 if any photo failed,
+with a per-file error report at the end (and in --report, as JSON).
+
+With --mosaic NAME, the photos are shots of one board instead: they are registered
+against each other where they overlap and composited into one canvas, NAME.<format>:
+
+    python src/batchrectify.py shots/ --mosaic panel --format dzi
+'''
+
+IMAGE_SUFFIXES = {'.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp', '.npy'}
+
+def load_sidecar(image_path):
+    path = Path(image_path).with_suffix('.json')
+    with open(path) as f:
+        return json.load(f)
+
+def solve_sidecar(data):
+    from solver import BatchSVDSolver
+    if 'transform' in data:
+        return asarray(data['transform'], dtype=float), None, None
+    points = asarray(data.get('points', []), dtype=float)
+    if points.ndim != 2 or points.shape[0] < 3 or points.shape[1] not in (4, 5):
+        raise ValueError('Sidecar needs a "transform" or at least 3 "points" of 4 or 5 values')
+    cols = [points[None,:,i] for i in range(points.shape[1])]
+    T, r, t = BatchSVDSolver().ComputeSolutions(*cols)
+    return T[0], int(r[0]), int(t[0])
+
+# Rectify one photo, run in a worker process
+# Returns a dict with the output path and timings; raises on failure
+def rectify_one(image_path, output_dir, fmt, resolution, method, budget, threads, crop=False):
+    from imagefile import read_image, write_image
+    from warp import OutputGeometry, warp, warp_to_file
+    from lens import load_profile
+    from dzi import export_dzi
+    from outline import detect_outline
+
+    times = {}
+    t0 = time.perf_counter()
+    data = load_sidecar(image_path)
+    T, r, t = solve_sidecar(data)
+    times['solve'] = time.perf_counter() - t0
+
+    t1 = time.perf_counter()
+    image = read_image(image_path)
+    times['read'] = time.perf_counter() - t1
+
+    profile = load_profile(data['camera']) if 'camera' in data else None
+    h, w = image.shape[:2]
+    region = asarray(data['outline'], dtype=float) if 'outline' in data else None
+    if region is None and crop:
+        t1 = time.perf_counter()
+        region = detect_outline(image)
+        times['outline'] = time.perf_counter() - t1
+    res = data.get('resolution', resolution)
+    if region is None:
+        geometry = OutputGeometry.from_image(T, w, h, res)
+    else:
+        geometry = OutputGeometry.from_polygon(T, region, res)
+    out_path = Path(output_dir) / f'{Path(image_path).stem}.{fmt}'
+    t2 = time.perf_counter()
+    if fmt in ('npy', 'dzi'):
+        flat = out_path.with_suffix('.npy')
+        out = warp_to_file(image, T, geometry, flat, method, budget, workers=threads, profile=profile,
+                           region=region)
+        times['warp'] = time.perf_counter() - t2
+        if fmt == 'dzi':
+            t3 = time.perf_counter()
+            export_dzi(out, out_path, workers=threads)
+            del out
+            os.remove(flat)
+            times['write'] = time.perf_counter() - t3
+    else:
+        out = warp(image, T, geometry, method, workers=threads, profile=profile, region=region)
+        times['warp'] = time.perf_counter() - t2
+        t3 = time.perf_counter()
+        write_image(out_path, out)
+        times['write'] = time.perf_counter() - t3
+    times['total'] = time.perf_counter() - t0
+    return {'image': str(image_path), 'output': str(out_path), 'rank': r, 'type': t,
+            'size': [geometry.width, geometry.height], 'times': times}
+
+# Register and composite all images into one canvas, see mosaic.py
+def run_mosaic(images, args) -> int:
+    from imagefile import write_image
+    from lens import load_profile
+    from mosaic import Shot, mosaic
+
+    start = time.perf_counter()
+    shots = []
+    for p in images:
+        data = load_sidecar(p)
+        profile = load_profile(data['camera']) if 'camera' in data else None
+        shots.append(Shot(str(p), solve_sidecar(data)[0], profile))
+    out_path = Path(args.output) / f'{args.mosaic}.{args.format}'
+    flat = out_path.with_suffix('.npy')
+    out, pairs = mosaic(shots, flat, args.resolution, method=args.method)
+    for i, j, dx, dy, peak in pairs:
+        print(f'{images[i].name} / {images[j].name}: offset ({dx:.4g}, {dy:.4g}), peak {peak:.2f}')
+    print(f'{len(pairs)} overlaps registered, composited {out.shape[1]}x{out.shape[0]} '
+          f'in {time.perf_counter()-start:.2f}s', flush=True)
+    if args.format == 'dzi':
+        from dzi import export_dzi
+        export_dzi(out, out_path)
+    elif args.format != 'npy':
+        write_image(out_path, out)
+    if args.format != 'npy':
+        del out
+        os.remove(flat)
+    print(f'-> {out_path}')
+    return 0
+
+def find_images(inputs):
+    images = []
+    for p in map(Path, inputs):
+        if p.is_dir():
+            images.extend(sorted(q for q in p.iterdir() if q.suffix.lower() in IMAGE_SUFFIXES
+                                 and q.with_suffix('.json').exists()))
+        else:
+            images.append(p)
+    return images
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Rectify photos from their saved constraints, without the GUI')
+    parser.add_argument('inputs', nargs='+', help='photos, or directories of photos with .json sidecars')
+    parser.add_argument('--output', '-o', default='rectified', help='output directory')
+    parser.add_argument('--format', default='png', help='output format: png, tif, jpg, ..., npy (streamed) or dzi (streamed tile pyramid)')
+    parser.add_argument('--resolution', type=float, default=300., help='output pixels per world unit, unless the sidecar sets it')
+    parser.add_argument('--method', default='bilinear', choices=['nearest', 'bilinear', 'bicubic', 'lanczos'])
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count() or 1, help='worker processes')
+    parser.add_argument('--budget', type=int, default=512, help='working memory per worker for npy output, MB')
+    parser.add_argument('--report', help='write per-file results and errors here as JSON')
+    parser.add_argument('--mosaic', metavar='NAME', help='register and composite all photos into one canvas, NAME.<format>')
+    parser.add_argument('--crop', action='store_true', help='rectify only the board, found automatically unless the sidecar has an outline')
+    args = parser.parse_args()
+
+    images = find_images(args.inputs)
+    if not images:
+        print('No images with .json sidecars found', file=sys.stderr)
+        return 1
+    Path(args.output).mkdir(parents=True, exist_ok=True)
+    if args.mosaic:
+        return run_mosaic(images, args)
+    jobs = max(1, min(args.jobs, len(images)))
+    threads = max(1, (os.cpu_count() or 1)//jobs)
+
+    results, errors = [], []
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {pool.submit(rectify_one, str(p), args.output, args.format, args.resolution,
+                               args.method, args.budget*2**20, threads, args.crop): p for p in images}
+        for i, f in enumerate(as_completed(futures), 1):
+            p = futures[f]
+            try:
+                r = f.result()
+            except Exception as e:
+                detail = ''.join(traceback.format_exception_only(type(e), e)).strip()
+                errors.append({'image': str(p), 'error': detail})
+                print(f'[{i}/{len(images)}] {p.name}: FAILED {detail}', flush=True)
+                continue
+            results.append(r)
+            t = r['times']
+            print(f"[{i}/{len(images)}] {p.name}: {t['total']:.2f}s (solve {t['solve']:.3f}s, read {t['read']:.2f}s, "
+                  f"{'outline %.2fs, ' % t['outline'] if 'outline' in t else ''}"
+                  f"warp {t['warp']:.2f}s{', write %.2fs' % t['write'] if 'write' in t else ''}) -> {r['output']}", flush=True)
+
+    print(f'{len(results)} rectified, {len(errors)} failed in {time.perf_counter()-start:.2f}s')
+    if errors:
+        print('\nErrors:', file=sys.stderr)
+        for err in errors:
+            print(f"  {err['image']}: {err['error']}", file=sys.stderr)
+    if args.report:
+        with open(args.report, 'w') as report_file:
+            json.dump({'results': results, 'errors': errors}, report_file, indent=1)
+    return 1 if errors else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
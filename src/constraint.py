@@ -23,3 +23,35 @@ class ConstraintDialog(QDialog):
         layout.addWidget(vdistance, 3, 1, 1, 1)
         layout.addWidget(okbutton, 4, 2, 1, 1)
         layout.addWidget(cancelvbutton, 4, 3, 1, 1)
+
+# World position of one marker, which makes it a point constraint
+class PointConstraintDialog(QDialog):
+    def __init__(self, parent: QtWidgets.QWidget, world: QtCore.QPointF | None = None) -> None:
+        super().__init__(parent)
+        self.setWindowTitle('World Position')
+        xlabel = QtWidgets.QLabel('World X')
+        ylabel = QtWidgets.QLabel('World Y')
+        self.xedit = QtWidgets.QLineEdit('' if world is None else repr(world.x()))
+        self.yedit = QtWidgets.QLineEdit('' if world is None else repr(world.y()))
+        for edit in (self.xedit, self.yedit):
+            edit.setValidator(QtGui.QDoubleValidator(edit))
+        okbutton = QtWidgets.QPushButton('OK')
+        cancelbutton = QtWidgets.QPushButton('Cancel')
+        okbutton.setDefault(True)
+        okbutton.clicked.connect(self.accept)
+        cancelbutton.clicked.connect(self.reject)
+        layout = QtWidgets.QGridLayout(self)
+        layout.addWidget(xlabel, 0, 0, 1, 1)
+        layout.addWidget(self.xedit, 0, 1, 1, 2)
+        layout.addWidget(ylabel, 1, 0, 1, 1)
+        layout.addWidget(self.yedit, 1, 1, 1, 2)
+        layout.addWidget(okbutton, 2, 1, 1, 1)
+        layout.addWidget(cancelbutton, 2, 2, 1, 1)
+
+    def accept(self) -> None:
+        if self.xedit.hasAcceptableInput() and self.yedit.hasAcceptableInput():
+            super().accept()
+
+    def world(self) -> QtCore.QPointF:
+        locale = QtCore.QLocale()
+        return QtCore.QPointF(locale.toDouble(self.xedit.text())[0], locale.toDouble(self.yedit.text())[0])
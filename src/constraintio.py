@@ -0,0 +1,55 @@
+from itertools import islice
+from numpy import load, loadtxt, atleast_2d
+
+#
+#  Chunked readers for large constraint sets
+#
+# Each reader yields (k,4) or (k,5) float arrays with columns
+# image_x, image_y, world_x, world_y[, weight], at most chunk_size rows at a time,
+# so a file of any size can be fed to SVDSolver.IngestConstraints() in bounded memory.
+#
+
+# CSV (or other delimited text), one constraint per line
+# A first line that does not parse as numbers is taken as a header and skipped
+def read_csv_chunks(path, chunk_size=65536, delimiter=','):
+    with open(path) as f:
+        first = True
+        while True:
+            lines = list(islice(f, chunk_size))
+            if not lines:
+                return
+            if first:
+                first = False
+                try:
+                    [float(v) for v in lines[0].split(delimiter)]
+                except ValueError:
+                    lines = lines[1:]
+                    if not lines:
+                        continue
+            yield atleast_2d(loadtxt(lines, delimiter=delimiter, ndmin=2))
+
+# .npy file holding an (m,4) or (m,5) array, read through a memory map
+def read_npy_chunks(path, chunk_size=65536):
+    data = load(path, mmap_mode='r')
+    for i in range(0, len(data), chunk_size):
+        yield data[i:i+chunk_size].astype(float)
+
+# .npz file, either with one (m,4|5) array under key, or with separate
+# image_x, image_y, world_x, world_y[, weight] arrays
+# Note: npz members can not be memory mapped, so each member is loaded whole;
+# use read_npy_chunks() for files larger than memory
+def read_npz_chunks(path, chunk_size=65536, key=None):
+    with load(path) as npz:
+        if key is not None:
+            data = npz[key]
+        else:
+            names = ['image_x', 'image_y', 'world_x', 'world_y']
+            if 'weight' in npz.files:
+                names.append('weight')
+            cols = [npz[name] for name in names]
+            data = None
+        for i in range(0, len(data if data is not None else cols[0]), chunk_size):
+            if data is not None:
+                yield data[i:i+chunk_size].astype(float)
+            else:
+                yield atleast_2d([c[i:i+chunk_size] for c in cols]).T.astype(float)
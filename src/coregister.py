@@ -0,0 +1,198 @@
+import sys
+import json
+import argparse
+from math import atan2, cos, sin, radians, degrees
+from numpy import array, asarray, diag, eye, float32, float64
+from numpy.linalg import inv
+from scipy.ndimage import gaussian_gradient_magnitude, binary_erosion
+
+from warp import OutputGeometry, inverse_map_tile, sample, warp
+from imagepyramid import build_pyramid
+from mosaic import match_channels
+from phasecorr import phase_correlate
+
+'''
+Top/bottom layer co-registration
+
+Overlays the rectified solder side photo of a board on the rectified component side:
+the bottom image is mirrored, then the small rotation and shift left between the two
+are found from what both sides show, the board outline and drill holes:
+
+    python src/coregister.py top.png bottom.png --output bottom_on_top.png
+
+Both sides look different, so they are compared as gradient magnitude (edges), coarse
+to fine over image pyramids:
+
+  - At the coarsest level (about coarse_size pixels) every rotation in steps of about
+    a pixel at the image edge is tried, each with the shift from phase correlation, and
+    the one with the highest correlation peak kept.
+  - At each finer level a grid of patches is phase correlated, and a rotation and
+    shift are fitted to the patch offsets, so large levels are never transformed whole.
+
+The result maps bottom image pixels to top image pixels (the mirror included); warp
+with it onto the top image's grid to overlay.
+'''
+
+# Pixel coordinates of a level l are 2^-l those of level 0, see imagepyramid
+def level_scale(l):
+    s = 2.**-l
+    return diag([s, s, 1.])
+
+def to_level(M, l):
+    S = level_scale(l)
+    return S @ M @ diag([1./S[0,0], 1./S[1,1], 1.])
+
+def rotation(angle, cx, cy):
+    c, s = cos(angle), sin(angle)
+    return array([[c, -s, cx - c*cx + s*cy], [s, c, cy - s*cx - c*cy], [0., 0., 1.]])
+
+def translation(dx, dy):
+    return array([[1., 0., dx], [0., 1., dy], [0., 0., 1.]])
+
+# Mirror of a width x height image, 'horizontal' (left-right, a board turned over its
+# vertical axis) or 'vertical', into the same pixel rectangle
+def mirror(kind, width, height):
+    if kind == 'horizontal':
+        return array([[-1., 0., width], [0., 1., 0.], [0., 0., 1.]])
+    if kind == 'vertical':
+        return array([[1., 0., 0.], [0., -1., height], [0., 0., 1.]])
+    if kind in (None, 'none'):
+        return eye(3)
+    raise ValueError(f'Unknown mirror: {kind}')
+
+def edges(gray, sigma=1.):
+    return gaussian_gradient_magnitude(asarray(gray, dtype=float32), sigma)
+
+# Edges of moving rendered through M (moving -> fixed pixels) onto geometry, with the
+# mask of pixels inside the moving image, pulled in past the edge filter's reach
+def render_edges(moving, M, geometry, margin=3):
+    Minv = inv(asarray(M, dtype=float64))
+    sx, sy = inverse_map_tile(Minv, geometry, 0, 0, geometry.height, geometry.width)
+    values, inside = sample(moving, sx, sy)
+    return edges(values[..., 0]), binary_erosion(inside, iterations=margin)
+
+def window(image, geometry):
+    g = geometry
+    c0, r0 = int(g.x0), int(g.y0)
+    return image[r0:r0+g.height, c0:c0+g.width]
+
+class CoregistrationResult:
+    def __init__(self, M, angle, shift, peak, levels) -> None:
+        self.M = M                  # bottom image pixel -> top image pixel, mirror included
+        self.angle = angle          # rotation left after the mirror, degrees
+        self.shift = shift          # (dx, dy) top image pixels, of the bottom image center
+        self.peak = peak            # mean correlation peak at the finest level, 0..1
+        self.levels = levels        # [(level, patches used, peak)], coarse to fine
+
+# Best rotation of M about the fixed image center, within +-max_angle (radians) in
+# steps, each with its phase correlation shift; returns (M, peak)
+def coarse_search(fixed, moving, M, max_angle, step):
+    h, w = fixed.shape[:2]
+    g = OutputGeometry(0., 0., 1., w, h)
+    target = edges(fixed)
+    best = None
+    n = max(1, int(max_angle/step))
+    for k in range(-n, n+1):
+        Mk = rotation(k*step, w/2, h/2) @ M
+        e, mask = render_edges(moving, Mk, g)
+        shift = phase_correlate(target, e, mask)
+        if shift is not None and (best is None or shift[2] > best[1]):
+            best = (translation(-shift[0], -shift[1]) @ Mk, shift[2])
+    if best is None:
+        raise ValueError('The images do not overlap')
+    return best
+
+# Rotation and shift that best move points q onto points p, weighted (Procrustes)
+def rigid_fit(p, q, w):
+    w = w/w.sum()
+    pc, qc = w @ p, w @ q
+    P, Q = p - pc, q - qc
+    angle = atan2((w*(Q[:,0]*P[:,1] - Q[:,1]*P[:,0])).sum(), (w*(Q[:,0]*P[:,0] + Q[:,1]*P[:,1])).sum())
+    return translation(*pc) @ rotation(angle, 0., 0.) @ translation(*-qc)
+
+# One refinement of M_l from a grid x grid of patches of at most patch pixels
+def refine(fixed, moving, M, grid, patch, min_peak):
+    h, w = fixed.shape[:2]
+    pw, ph = min(patch, w//grid), min(patch, h//grid)
+    p, q, weights = [], [], []
+    for i in range(grid):
+        for j in range(grid):
+            x0 = int((j + 0.5)*w/grid - pw/2)
+            y0 = int((i + 0.5)*h/grid - ph/2)
+            g = OutputGeometry(float(x0), float(y0), 1., pw, ph)
+            e, mask = render_edges(moving, M, g)
+            shift = phase_correlate(edges(window(fixed, g)), e, mask)
+            if shift is None or shift[2] < min_peak:
+                continue
+            # Moving content at the patch center appears shifted by (dx, dy)
+            cx, cy = x0 + pw/2, y0 + ph/2
+            p.append((cx, cy))
+            q.append((cx + shift[0], cy + shift[1]))
+            weights.append(shift[2])
+    if not p:
+        return M, 0, 0.
+    p, q, weights = asarray(p), asarray(q), asarray(weights)
+    if len(p) == 1:
+        C = translation(*(p[0] - q[0]))
+    else:
+        C = rigid_fit(p, q, weights)
+    return C @ M, len(p), float(weights.mean())
+
+# Register the bottom side image onto the top side image, both (H,W[,C]) rectified at
+# the same resolution. max_angle (degrees) bounds the rotation searched at the coarsest
+# level; each finer level refines with grid x grid patches of at most patch pixels,
+# iterations times. Patches whose correlation peak is under min_peak (blank areas) are
+# not used.
+def coregister(top, bottom, mirror_kind='horizontal', max_angle=3., coarse_size=512, grid=3,
+               patch=512, iterations=2, min_peak=0.1, finest=0):
+    fixed = build_pyramid(match_channels(asarray(top), 1), min_size=32)
+    moving = build_pyramid(match_channels(asarray(bottom), 1), min_size=32)
+    coarse = next((l for l, f in enumerate(fixed) if max(f.shape[:2]) <= coarse_size), len(fixed)-1)
+    coarse = min(coarse, len(moving)-1)
+    H, W = top.shape[:2]
+    h, w = bottom.shape[:2]
+    # Mirrored bottom centered on the top image
+    M = translation((W-w)/2, (H-h)/2) @ mirror(mirror_kind, w, h)
+
+    f, m = fixed[coarse], moving[coarse]
+    # About a pixel at the image edge
+    step = 2./max(f.shape[:2])
+    Ml, peak = coarse_search(f, m, to_level(M, coarse), radians(max_angle), step)
+    levels = [(coarse, 1, peak)]
+    for l in range(coarse-1, finest-1, -1):
+        Ml = to_level(Ml, -1)
+        for it in range(iterations):
+            Ml, used, peak = refine(fixed[l], moving[l], Ml, grid, patch, min_peak)
+        levels.append((l, used, peak))
+    M = to_level(Ml, -finest) if finest else Ml
+    R = M @ mirror(mirror_kind, w, h)
+    angle = degrees(atan2(R[1,0], R[0,0]))
+    c = M @ array([w/2, h/2, 1.])
+    return CoregistrationResult(M, angle, (c[0] - W/2, c[1] - H/2), peak, levels)
+
+def main() -> int:
+    from imagefile import read_image, write_image
+    parser = argparse.ArgumentParser(description='Mirror the bottom side of a board onto the top side')
+    parser.add_argument('top', help='rectified component side image')
+    parser.add_argument('bottom', help='rectified solder side image, same resolution')
+    parser.add_argument('--output', '-o', help='write the bottom image overlaid on the top image grid here')
+    parser.add_argument('--mirror', default='horizontal', choices=['horizontal', 'vertical', 'none'])
+    parser.add_argument('--max-angle', type=float, default=3., help='largest rotation searched, degrees')
+    parser.add_argument('--transform', help='write the bottom -> top pixel transform here as JSON')
+    args = parser.parse_args()
+
+    top, bottom = read_image(args.top), read_image(args.bottom)
+    r = coregister(top, bottom, args.mirror, args.max_angle)
+    for l, used, peak in r.levels:
+        print(f'level {l}: {used} patches, peak {peak:.2f}')
+    print(f'rotation {r.angle:.3f} degrees, shift ({r.shift[0]:.2f}, {r.shift[1]:.2f}) pixels')
+    if args.transform:
+        with open(args.transform, 'w') as f:
+            json.dump({'transform': r.M.tolist(), 'angle': r.angle, 'shift': list(r.shift), 'peak': r.peak}, f, indent=1)
+    if args.output:
+        H, W = top.shape[:2]
+        write_image(args.output, warp(bottom, r.M, OutputGeometry(0., 0., 1., W, H)))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,99 @@
+import os
+import tempfile
+from math import ceil, log2
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from numpy import array, concatenate
+from numpy.lib.format import open_memmap
+
+from imagepyramid import downsample
+from imagefile import write_image
+
+#
+#  Deep Zoom (DZI) pyramid export
+#
+# Writes <name>.dzi and <name>_files/<level>/<column>_<row>.<format>, the layout
+# OpenSeadragon and other deep zoom viewers read. Level max is the full image and each
+# level below is half the size (rounded up), down to 1x1.
+#
+# The source is read in bands of tile rows, e.g. from the memmap warp.warp_to_file()
+# writes, so the full image is never in memory. Each level below the top is written to
+# a temporary .npy memmap, band by band, and tiled from there. Tiles of a band are
+# encoded on a thread pool.
+#
+
+DZI_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" TileSize="{tile}" Overlap="{overlap}" Format="{fmt}">
+  <Size Width="{width}" Height="{height}"/>
+</Image>
+'''
+
+# Half size band, rounding odd sizes up by repeating the last row/column
+def half(band):
+    if band.shape[0] % 2:
+        band = concatenate((band, band[-1:]), axis=0)
+    if band.shape[1] % 2:
+        band = concatenate((band, band[:, -1:]), axis=1)
+    return downsample(band)
+
+# Next smaller level of source into a new memmap at path, band_rows rows (even) at a time
+def write_half(source, path, band_rows):
+    h, w = source.shape[:2]
+    out = open_memmap(path, mode='w+', dtype=source.dtype, shape=((h+1)//2, (w+1)//2) + source.shape[2:])
+    for r0 in range(0, h, band_rows):
+        out[r0//2:(min(r0+band_rows, h)+1)//2] = half(array(source[r0:r0+band_rows]))
+    out.flush()
+    return out
+
+def write_tiles(source, directory, tile, overlap, fmt, quality, band_tiles, pool):
+    h, w = source.shape[:2]
+    directory.mkdir(parents=True, exist_ok=True)
+    rows, cols = (h + tile - 1)//tile, (w + tile - 1)//tile
+    for tr0 in range(0, rows, band_tiles):
+        tr1 = min(tr0 + band_tiles, rows)
+        y0 = max(tr0*tile - overlap, 0)
+        band = array(source[y0:min(tr1*tile + overlap, h)])
+        futures = []
+        for tr in range(tr0, tr1):
+            for tc in range(cols):
+                # Tiles carry overlap pixels on the sides that have neighbours
+                ya, yb = max(tr*tile - overlap, 0), min((tr+1)*tile + overlap, h)
+                xa, xb = max(tc*tile - overlap, 0), min((tc+1)*tile + overlap, w)
+                futures.append(pool.submit(write_image, directory / f'{tc}_{tr}.{fmt}',
+                                           band[ya-y0:yb-y0, xa:xb], quality))
+        for f in futures:
+            f.result()
+
+# Export source (H,W[,C]) uint8, e.g. numpy.load(path, mmap_mode='r'), as <path>.dzi
+# progress(level, top) is called as each level is finished, from the top down
+# temp_dir holds the intermediate levels (defaults to next to the output)
+def export_dzi(source, path, tile=254, overlap=1, fmt='jpg', quality=90, band_tiles=4,
+               workers=None, temp_dir=None, progress=None):
+    path = Path(path).with_suffix('')
+    h, w = source.shape[:2]
+    top = int(ceil(log2(max(w, h, 1))))
+    files = path.parent / f'{path.name}_files'
+    workers = workers or os.cpu_count() or 1
+    temp_dir = Path(temp_dir or path.parent)
+    band_rows = 2*band_tiles*tile
+    level_source, temp = source, None
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for level in range(top, -1, -1):
+            write_tiles(level_source, files / str(level), tile, overlap, fmt, quality, band_tiles, pool)
+            if progress is not None:
+                progress(level, top)
+            if level == 0:
+                break
+            fd, name = tempfile.mkstemp(suffix='.npy', dir=temp_dir)
+            os.close(fd)
+            smaller = write_half(level_source, name, band_rows)
+            if temp is not None:
+                del level_source
+                os.remove(temp)
+            level_source, temp = smaller, name
+    if temp is not None:
+        del level_source
+        os.remove(temp)
+    with open(f'{path}.dzi', 'w') as f:
+        f.write(DZI_XML.format(tile=tile, overlap=overlap, fmt=fmt, width=w, height=h))
+    return Path(f'{path}.dzi')
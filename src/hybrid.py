@@ -0,0 +1,102 @@
+from time import perf_counter
+from numpy import array, zeros, concatenate, vstack, column_stack
+from scipy.optimize import least_squares
+
+from solver import BatchSVDSolver, PointConstraint, build_matrix, transform_from_solution
+from solver2 import DeltaXConstraint, DeltaYConstraint, model_fx, model_fy, jacobian_fx, jacobian_fy, delta_residuals, delta_jacobian
+
+#
+#  Linear then nonlinear solve
+#
+# The linear stage is a closed form SVDSolver style solve of the point constraints
+# plus the delta constraints with the perspective terms dropped, which makes them linear:
+#   (1+a)*dX + b*dY = world_dx,   -b*dX + (1+a)*dY = world_dy
+# Its solution is the starting point of the nonlinear least squares refinement,
+# which fits all constraints with the full perspective model.
+#
+
+class HybridSolver:
+    # svdsolver holds the point constraints and nllssolver the delta constraints,
+    # either may be None
+    def __init__(self, svdsolver=None, nllssolver=None) -> None:
+        self.svdsolver = svdsolver
+        self.nllssolver = nllssolver
+        self.linear = BatchSVDSolver()
+        self.stats: dict = {}
+
+    def point_columns(self):
+        if self.svdsolver is None:
+            return tuple(zeros(0) for f in PointConstraint.fields)
+        return tuple(self.svdsolver.store.column(f) for f in PointConstraint.fields)
+
+    def delta_columns(self):
+        if self.nllssolver is None:
+            return (tuple(zeros(0) for f in DeltaXConstraint.fields),
+                    tuple(zeros(0) for f in DeltaYConstraint.fields))
+        return self.nllssolver.dxcolumns(), self.nllssolver.dycolumns()
+
+    # A and b for the linear stage
+    def BuildMatrix(self):
+        A, b = build_matrix(*self.point_columns())
+        dx, dy = self.delta_columns()
+        zx, zy = zeros(len(dx[0])), zeros(len(dy[0]))
+        DXx, DYx = dx[0]-dx[2], dx[1]-dx[3]
+        DXy, DYy = dy[0]-dy[2], dy[1]-dy[3]
+        Ax = column_stack((DXx, DYx, zx, zx, zx, zx))
+        Ay = column_stack((DYy, -DXy, zy, zy, zy, zy))
+        bx = (dx[4] - DXx)[:, None]
+        by = (dy[4] - DYy)[:, None]
+        return vstack((A, Ax, Ay)), vstack((b, bx, by))
+
+    # Residuals and Jacobian of all constraints, x in NLLSSolver form (x[0] is the scale)
+    # Point residuals are weighted, delta residuals are not, as in NLLSSolver
+    def FunctionG(self, x):
+        ix, iy, wx, wy, w = self.point_columns()
+        dx, dy = self.delta_columns()
+        return concatenate((delta_residuals(x, dx, dy),
+                            w*(model_fx(ix, iy, x) - wx),
+                            w*(model_fy(ix, iy, x) - wy)))
+
+    def FunctionJ(self, x):
+        ix, iy, wx, wy, w = self.point_columns()
+        dx, dy = self.delta_columns()
+        return vstack((delta_jacobian(x, dx, dy),
+                       w[:, None]*jacobian_fx(ix, iy, x),
+                       w[:, None]*jacobian_fy(ix, iy, x)))
+
+    def ComputeLinearSolution(self):
+        A, b = self.BuildMatrix()
+        x, r, t = self.linear.compute_solution(A[None], b[None], array([len(A)]))
+        return x[0], int(r[0]), int(t[0])
+
+    # compare=True also runs the nonlinear solve from the fixed NLLSSolver start point,
+    # so the iteration and evaluation counts can be compared
+    def ComputeSolution(self, compare=False):
+        t0 = perf_counter()
+        xl, r, t = self.ComputeLinearSolution()
+        t1 = perf_counter()
+        x0 = xl.copy()
+        x0[0] += 1.   # SVDSolver form to NLLSSolver form
+        res = least_squares(self.FunctionG, x0, jac=self.FunctionJ)
+        t2 = perf_counter()
+        self.result = res
+        self.stats = {
+            'linear_rank': r, 'linear_type': t,
+            'linear_time': t1-t0, 'nonlinear_time': t2-t1,
+            'nfev': int(res.nfev), 'njev': int(res.njev), 'cost': float(res.cost),
+        }
+        if compare:
+            cold = least_squares(self.FunctionG, [1, 0, 0, 0, 0, 0], jac=self.FunctionJ)
+            self.stats.update({'cold_time': perf_counter()-t2, 'cold_nfev': int(cold.nfev),
+                               'cold_njev': int(cold.njev), 'cold_cost': float(cold.cost)})
+
+        print(f"Linear stage: r={r}, t={t}")
+        print(f"Nonlinear stage: nfev={res.nfev}, njev={res.njev}, cost={res.cost:.6g}")
+        if compare:
+            print(f"Cold start: nfev={self.stats['cold_nfev']}, njev={self.stats['cold_njev']}, cost={self.stats['cold_cost']:.6g}")
+
+        x = res.x.copy()
+        x[0] -= 1.
+        T = transform_from_solution(x)
+        print(f'T=\n{T}')
+        return T
@@ -0,0 +1,69 @@
+from pathlib import Path
+from PySide6 import QtGui
+from numpy import frombuffer, ascontiguousarray, uint8, load, save
+
+#
+#  Image files and conversion between QImage and numpy arrays
+#
+# Only QtGui is used, which works without a display (no widgets are created).
+# Arrays are (H,W,3) RGB or (H,W,4) RGBA uint8, or (H,W) grayscale uint8.
+# .npy files are read as memmaps, for images too large to decode into memory.
+#
+
+# Copy of a QImage (or QPixmap.toImage()) as an array; alpha is kept only if the image has it
+def qimage_to_array(image: QtGui.QImage):
+    if image.format() == QtGui.QImage.Format.Format_Grayscale8:
+        fmt, channels = QtGui.QImage.Format.Format_Grayscale8, 1
+    elif image.hasAlphaChannel():
+        fmt, channels = QtGui.QImage.Format.Format_RGBA8888, 4
+    else:
+        fmt, channels = QtGui.QImage.Format.Format_RGB888, 3
+    image = image.convertToFormat(fmt)
+    h, w, bpl = image.height(), image.width(), image.bytesPerLine()
+    # Rows are padded to bytesPerLine
+    rows = frombuffer(image.constBits(), dtype=uint8, count=h*bpl).reshape(h, bpl)
+    a = rows[:, :w*channels].reshape((h, w, channels) if channels > 1 else (h, w))
+    return a.copy()
+
+# QImage sharing nothing with the array (the data is copied)
+def array_to_qimage(a) -> QtGui.QImage:
+    a = ascontiguousarray(a, dtype=uint8)
+    if a.ndim == 2:
+        fmt = QtGui.QImage.Format.Format_Grayscale8
+    elif a.shape[2] == 3:
+        fmt = QtGui.QImage.Format.Format_RGB888
+    elif a.shape[2] == 4:
+        fmt = QtGui.QImage.Format.Format_RGBA8888
+    else:
+        raise ValueError(f'Cannot make a QImage from an array of shape {a.shape}')
+    h, w = a.shape[:2]
+    return QtGui.QImage(a.data, w, h, a.strides[0], fmt).copy()
+
+def read_image(path):
+    path = Path(path)
+    if path.suffix.lower() == '.npy':
+        return load(path, mmap_mode='r')
+    image = QtGui.QImage(str(path))
+    if image.isNull():
+        raise OSError(f'Could not load image file: {path}')
+    return qimage_to_array(image)
+
+# (width, height) of an image file, from its header only
+def image_size(path):
+    path = Path(path)
+    if path.suffix.lower() == '.npy':
+        shape = load(path, mmap_mode='r').shape
+        return shape[1], shape[0]
+    size = QtGui.QImageReader(str(path)).size()
+    if not size.isValid():
+        raise OSError(f'Could not read image file: {path}')
+    return size.width(), size.height()
+
+# quality is for lossy formats (0-100, -1 for the format's default)
+def write_image(path, a, quality=-1) -> None:
+    path = Path(path)
+    if path.suffix.lower() == '.npy':
+        save(path, a)
+        return
+    if not array_to_qimage(a).save(str(path), None, quality):
+        raise OSError(f'Could not write image file: {path}')
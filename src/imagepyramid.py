@@ -0,0 +1,44 @@
+from numpy import asarray, array, diag, uint16, float32, issubdtype, integer
+
+#
+#  Image pyramid
+#
+# Level l is the image reduced 2^l times by 2x2 box averaging. A pixel center at
+# x + 0.5 in level l is at 2^l*(x + 0.5) in level 0, so a solution T for the photo
+# applies to level l as T @ diag(2^l, 2^l, 1).
+#
+
+# Half size image, odd last rows/columns are dropped
+def downsample(image):
+    image = asarray(image)
+    h, w = image.shape[0]//2*2, image.shape[1]//2*2
+    a = image[:h:2, :w:2]
+    b = image[1:h:2, :w:2]
+    c = image[:h:2, 1:w:2]
+    d = image[1:h:2, 1:w:2]
+    if image.dtype == 'uint8':
+        s = a.astype(uint16) + b + c + d
+        return ((s + 2) >> 2).astype(image.dtype)
+    s = a.astype(float32) + b + c + d
+    if issubdtype(image.dtype, integer):
+        return (s*0.25 + 0.5).astype(image.dtype)
+    return (s*0.25).astype(image.dtype)
+
+# Levels from the full image down to the first level with a side under min_size
+# Level 0 is the image itself (not copied)
+def build_pyramid(image, min_size=256, max_levels=16):
+    levels = [asarray(image)]
+    while len(levels) < max_levels and min(levels[-1].shape[:2]) >= 2*min_size:
+        levels.append(downsample(levels[-1]))
+    return levels
+
+def level_transform(T, level):
+    s = float(2**level)
+    return array(T, dtype=float) @ diag([s, s, 1.])
+
+# Coarsest level whose larger side is still at least size pixels
+def level_for_size(levels, size):
+    for l in range(len(levels)-1, -1, -1):
+        if max(levels[l].shape[:2]) >= size:
+            return l
+    return 0
@@ -5,15 +5,20 @@
 from PySide6 import QtCore, QtGui, QtWidgets
 from PySide6.QtWidgets import QGraphicsView, QGraphicsScene, QGraphicsPixmapItem
 from typing import cast
+from numpy import ndarray
 
 from undoredo import undoContext, UndoContext
 from marker import Marker
 from constraint import ConstraintDialog
+from solveservice import SolveService
+from preview import PreviewRenderer, PreviewLayer, preview_geometry
+from imagefile import qimage_to_array
 
 SCALE_FACTOR = 1.25
 
 class ImageView(QGraphicsView):
     coordinatesChanged = QtCore.Signal(QtCore.QPointF)
+    solutionChanged = QtCore.Signal(object)
 
     def __init__(self, parent: QtWidgets.QWidget | None, statusbar: QtWidgets.QStatusBar) -> None:
         super().__init__(parent)
@@ -25,6 +30,14 @@ class ImageView(QGraphicsView):
         self._photo = QGraphicsPixmapItem()
         self._photo.setShapeMode(QGraphicsPixmapItem.ShapeMode.BoundingRectShape)
         self._scene.addItem(self._photo)
+        # Rectified preview, shown instead of the photo when toggled on
+        self._preview = PreviewLayer()
+        self._preview.setVisible(False)
+        self._scene.addItem(self._preview)
+        self.previewer = PreviewRenderer(self)
+        self.previewer.coarseReady.connect(self.handlePreviewCoarse)
+        self.previewer.tileReady.connect(self.handlePreviewTile)
+        self._photo_array: ndarray | None = None
         self.setScene(self._scene)
         self.setTransformationAnchor(QGraphicsView.ViewportAnchor.AnchorUnderMouse)
         self.setResizeAnchor(QGraphicsView.ViewportAnchor.AnchorUnderMouse)
@@ -36,6 +49,12 @@ class ImageView(QGraphicsView):
         #self._scene.selectionChanged.connect(self.handleSelectionChange)
         self.markerlist: list[Marker] = []
 
+        # Live solve from the markers with world positions, off the GUI thread
+        self.solution: ndarray | None = None
+        self.solveservice = SolveService(self)
+        self.solveservice.solved.connect(self.handleSolved)
+        self.solveservice.failed.connect(self.handleSolveFailed)
+
     def contextMenuEvent(self, event: QtGui.QContextMenuEvent) -> None:
         if self._photo.isUnderMouse():
             if len(self.items(QtCore.QRect(event.x(), event.y(), 1, 1))) > 1: # TBD need to ignore the image item!
@@ -70,21 +89,35 @@ class ImageView(QGraphicsView):
             self.createMarker(uctx, point)
             self.statusbar.showMessage("Create Marker")
 
-    def createMarker(self, uctx: UndoContext, point: QtCore.QPointF, mid: int | None = None) -> None:
+    def createMarker(self, uctx: UndoContext, point: QtCore.QPointF, mid: int | None = None,
+                     world: QtCore.QPointF | None = None) -> None:
         marker = Marker(self,point,mid)
+        marker.world = world
         self._scene.addItem(marker)
         self.markerlist.append(marker)
         marker.update()
         #print(f'Created marker id={marker.mid}')
         uctx.recordAction(self.deleteMarker, uctx, marker.mid)
+        if world is not None:
+            self.requestSolve()
 
     def deleteMarker(self, uctx: UndoContext, mid: int ) -> None:
         marker = self.getItemById(mid)
-        pos,mid = marker.pos(),marker.mid
+        pos,mid,world = marker.pos(),marker.mid,marker.world
         self.markerlist.remove(marker)
         self._scene.removeItem(marker)
         #print(f'Deleted marker id={id}')
-        uctx.recordAction(self.createMarker, uctx, pos, mid)
+        uctx.recordAction(self.createMarker, uctx, pos, mid, world)
+        # Its point constraint goes with it
+        if world is not None:
+            self.requestSolve()
+
+    # Give a marker a world position, making it a point constraint, or None to clear it
+    def setMarkerWorld(self, uctx: UndoContext, mid: int, world: QtCore.QPointF | None) -> None:
+        marker = self.getItemById(mid)
+        uctx.recordAction(self.setMarkerWorld, uctx, mid, marker.world)
+        marker.world = None if world is None else QtCore.QPointF(world)
+        self.requestSolve()
 
     # Atomic Action
     def deleteSelection(self) -> None:
@@ -127,8 +160,13 @@ class ImageView(QGraphicsView):
     def hasPhoto(self) -> bool:
         return not self._empty
 
+    def displayRect(self) -> QtCore.QRectF:
+        if self.previewVisible():
+            return self._preview.boundingRect()
+        return QtCore.QRectF(self._photo.pixmap().rect())
+
     def resetView(self, scale: float = 1.0) -> None:
-        rect = QtCore.QRectF(self._photo.pixmap().rect())
+        rect = self.displayRect()
         if not rect.isNull():
             self.setSceneRect(rect)
             if (scale := max(1, scale)) == 1:
@@ -142,7 +180,7 @@ class ImageView(QGraphicsView):
                              viewrect.height() / scenerect.height()) * scale
                 self.scale(factor, factor)
                 if not self.zoomPinned():
-                    self.centerOn(self._photo)
+                    self.centerOn(rect.center())
                 self.updateCoordinates()
 
     def setPhoto(self, pixmap: QtGui.QPixmap | None = None) -> None:
@@ -154,6 +192,9 @@ class ImageView(QGraphicsView):
             self._empty = True
             #self.setDragMode(QGraphicsView.DragMode.NoDrag)
             self._photo.setPixmap(QtGui.QPixmap())
+        # The array for the preview is made when it is first needed
+        self._photo_array = None
+        self.previewer.setImage(None)
         if not (self.zoomPinned() and self.hasPhoto()):
             self._zoom = 0
         self.resetView(SCALE_FACTOR ** self._zoom)
@@ -224,12 +265,52 @@ class ImageView(QGraphicsView):
                 marker = cast(Marker, item)
                 uctx.recordAction(self.moveMarker, uctx, marker.mid, old_pos)
         self.statusbar.showMessage("Move Selection")
+        self.requestSolve()
     
     def moveMarker(self, uctx: UndoContext, mid, pos: QtCore.QPointF) -> None:
         item = self.getItemById(mid)
         old_pos = item.pos()
         uctx.recordAction(self.moveMarker, uctx, mid, old_pos)
         item.setPos(pos)
+
+    # Called by markers as they move, including during an interactive drag
+    def markerMoved(self, marker: Marker) -> None:
+        if marker.world is not None:
+            self.requestSolve()
+
+    # Image and world positions of the markers that have world positions
+    def pointConstraints(self) -> tuple[list[float], list[float], list[float], list[float]]:
+        image_x: list[float] = []
+        image_y: list[float] = []
+        world_x: list[float] = []
+        world_y: list[float] = []
+        for m in self.markerlist:
+            if m.world is None:
+                continue
+            image_x.append(m.pos().x())
+            image_y.append(m.pos().y())
+            world_x.append(m.world.x())
+            world_y.append(m.world.y())
+        return image_x, image_y, world_x, world_y
+
+    # Queue a background solve from the markers that have world positions,
+    # a request still waiting is replaced by this one
+    def requestSolve(self) -> None:
+        constraints = self.pointConstraints()
+        if len(constraints[0]) < 3:
+            # Not enough point constraints left for a solution
+            self.solution = None
+            return
+        self.solveservice.request(*constraints)
+
+    def handleSolved(self, rid: int, T, r: int, t: int) -> None:
+        self.solution = T
+        self.solutionChanged.emit(T)
+        if self.previewVisible():
+            self.startPreview()
+
+    def handleSolveFailed(self, rid: int, msg: str) -> None:
+        self.statusbar.showMessage(f'Solve failed: {msg}')
     
     def createConstraint(self) -> None:
         dialog = ConstraintDialog(self)
@@ -242,3 +323,65 @@ class ImageView(QGraphicsView):
             if item.mid == mid:
                 return item
         raise KeyError
+
+    def previewVisible(self) -> bool:
+        return self._preview.isVisible()
+
+    # Solution from the point constraints, solved now on this thread (or found in the
+    # solution cache) unless a live solve already gave one; None if there are too few
+    def currentSolution(self) -> ndarray | None:
+        if self.solution is None:
+            constraints = self.pointConstraints()
+            if len(constraints[0]) >= 3:
+                try:
+                    self.solution = self.solveservice.solve(*constraints)[0]
+                except ValueError as e:
+                    self.statusbar.showMessage(f'Solve failed: {e}')
+        return self.solution
+
+    # Toggle between the photo (with its markers) and the rectified preview
+    def setPreviewVisible(self, enable: bool) -> None:
+        if enable and (not self.hasPhoto() or self.currentSolution() is None):
+            self.statusbar.showMessage('Nothing to preview, no solution yet')
+            return
+        self._preview.setVisible(enable)
+        self._photo.setVisible(not enable)
+        for marker in self.markerlist:
+            marker.setVisible(not enable)
+        if enable:
+            self.startPreview()
+        else:
+            self.previewer.cancel()
+            self.resetView(SCALE_FACTOR ** self._zoom)
+
+    # Render the current solution, cancelling any refinement still in flight
+    def startPreview(self) -> None:
+        solution = self.solution
+        if solution is None:
+            return
+        image = self._photo_array
+        if image is None:
+            image = self._photo_array = qimage_to_array(self._photo.pixmap().toImage())
+            self.previewer.setImage(image)
+        h, w = image.shape[:2]
+        try:
+            geometry = preview_geometry(solution, w, h)
+        except ValueError as e:
+            self.statusbar.showMessage(f'Preview failed: {e}')
+            return
+        resized = self._preview.image.size() != QtCore.QSize(geometry.width, geometry.height)
+        if resized:
+            self._preview.reset(geometry.width, geometry.height)
+            self.resetView()
+        # Visible part of the layer, refined first
+        visible = self._preview.mapFromScene(self.mapToScene(self.viewport().rect())).boundingRect()
+        focus = (visible.left(), visible.top(), visible.right(), visible.bottom())
+        self.previewer.start(solution, geometry, focus)
+
+    def handlePreviewCoarse(self, gen: int, coarse) -> None:
+        if gen == self.previewer.generation:
+            self._preview.setCoarse(coarse)
+
+    def handlePreviewTile(self, gen: int, r0: int, c0: int, tile) -> None:
+        if gen == self.previewer.generation:
+            self._preview.setTile(r0, c0, tile)
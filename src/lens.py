@@ -0,0 +1,187 @@
+import os
+import tempfile
+from configparser import ConfigParser
+from hashlib import blake2b
+from pathlib import Path
+from numpy import array, asarray, zeros, ones, arange, concatenate, float32, float64, empty, abs as npabs
+from numpy.lib.format import open_memmap
+from scipy.ndimage import map_coordinates
+from scipy.optimize import least_squares
+
+from solver import BatchSVDSolver
+from solver2 import model_fx, model_fy
+
+#
+#  Lens distortion
+#
+# Brown-Conrady radial (k1, k2, k3) and tangential (p1, p2) terms, written as the
+# correction from the observed (distorted) pixel to the undistorted one, so the solver
+# can apply it directly to marker positions:
+#   xu = xd*(1 + k1*r^2 + k2*r^4 + k3*r^6) + 2*p1*xd*yd + p2*(r^2 + 2*xd^2)
+#   yu = yd*(1 + k1*r^2 + k2*r^4 + k3*r^6) + p1*(r^2 + 2*yd^2) + 2*p2*xd*yd
+# in normalized coordinates: xd = (x - cx*width)/f, f = max(width, height)/2.
+# The center is a fraction of the image size, so a profile fits any resolution of
+# the same camera and aspect ratio.
+#
+# Rectifying needs the inverse, the distorted source pixel of every undistorted pixel.
+# That is solved iteratively once per profile and resolution and cached on disk as a
+# memory mapped .npy, so later photos from the same camera only map the file.
+#
+# Pixel positions follow QImage and the markers: pixel (i, j) covers [j, j+1] x [i, i+1]
+# with its center at (j + 0.5, i + 0.5), as in warp.sample(). The maps hold such positions
+# for the centers of the undistorted pixels, so they can be sampled with warp.sample().
+#
+
+CAMERA_CONFIG = str(Path('config') / 'cameras.ini')
+MAP_CACHE = str(Path('cache') / 'lens')
+TERMS = ('k1', 'k2', 'k3', 'p1', 'p2')
+
+class CameraProfile:
+    def __init__(self, name, k1=0., k2=0., k3=0., p1=0., p2=0., cx=0.5, cy=0.5) -> None:
+        self.name = name
+        self.k1, self.k2, self.k3 = k1, k2, k3
+        self.p1, self.p2 = p1, p2
+        self.cx, self.cy = cx, cy
+
+    def coefficients(self):
+        return array([getattr(self, t) for t in TERMS])
+
+    # Changes whenever a coefficient does, used to key the cached maps
+    def digest(self):
+        h = blake2b(digest_size=8)
+        h.update(self.name.encode())
+        h.update(array([*self.coefficients(), self.cx, self.cy], dtype=float64).tobytes())
+        return h.hexdigest()
+
+    def normalization(self, width, height):
+        return self.cx*width, self.cy*height, max(width, height)/2.
+
+    # Observed pixel -> undistorted pixel, vectorized
+    def undistort_points(self, x, y, width, height):
+        cx, cy, f = self.normalization(width, height)
+        xu, yu = correct(self.coefficients(), (asarray(x)-cx)/f, (asarray(y)-cy)/f)
+        return xu*f + cx, yu*f + cy
+
+    # Undistorted pixel -> observed pixel, by fixed point iteration on the correction
+    # Stops early once every point moves by less than tol pixels
+    def distort_points(self, x, y, width, height, iterations=20, tol=1e-6):
+        cx, cy, f = self.normalization(width, height)
+        c = self.coefficients()
+        xu, yu = (asarray(x)-cx)/f, (asarray(y)-cy)/f
+        xd, yd = xu.copy(), yu.copy()
+        for i in range(iterations):
+            ex, ey = correct(c, xd, yd)
+            ex -= xu
+            ey -= yu
+            xd -= ex
+            yd -= ey
+            if max(npabs(ex).max(initial=0.), npabs(ey).max(initial=0.))*f < tol:
+                break
+        return xd*f + cx, yd*f + cy
+
+# The correction in normalized coordinates, c is (k1, k2, k3, p1, p2)
+def correct(c, xd, yd):
+    k1, k2, k3, p1, p2 = c
+    r2 = xd*xd + yd*yd
+    radial = 1 + r2*(k1 + r2*(k2 + r2*k3))
+    xu = xd*radial + 2*p1*xd*yd + p2*(r2 + 2*xd*xd)
+    yu = yd*radial + p1*(r2 + 2*yd*yd) + 2*p2*xd*yd
+    return xu, yu
+
+def load_profile(name, path=CAMERA_CONFIG):
+    config = ConfigParser()
+    config.read(path)
+    if not config.has_section(name):
+        raise KeyError(f'No camera profile {name} in {path}')
+    return CameraProfile(name, **{k: config.getfloat(name, k) for k in (*TERMS, 'cx', 'cy') if config.has_option(name, k)})
+
+def save_profile(profile, path=CAMERA_CONFIG):
+    config = ConfigParser()
+    config.read(path)
+    if not config.has_section(profile.name):
+        config.add_section(profile.name)
+    for k in (*TERMS, 'cx', 'cy'):
+        config.set(profile.name, k, repr(float(getattr(profile, k))))
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w') as f:
+        config.write(f)
+
+# Source (distorted) position of the center of every pixel of the undistorted image, shape
+# (2,height,width) float32, x then y, centers at integer + 0.5 (see above). Built in row
+# bands and cached as cache_dir/<name>_<w>x<h>_<digest>.c.npy; an existing file is memory
+# mapped read only instead of rebuilt.
+def undistortion_maps(profile, width, height, cache_dir=MAP_CACHE, band_rows=256):
+    # .c: maps of pixel centers, files from before held pixel indices
+    path = Path(cache_dir) / f'{profile.name}_{width}x{height}_{profile.digest()}.c.npy'
+    if path.exists():
+        return open_memmap(path, mode='r')
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Written under a temporary name of its own so an interrupted build is never picked
+    # up, and processes building the same maps at once do not write into one file
+    fd, tmp = tempfile.mkstemp(dir=path.parent, suffix='.npy')
+    os.close(fd)
+    try:
+        maps = open_memmap(tmp, mode='w+', dtype=float32, shape=(2, height, width))
+        xs = arange(width, dtype=float64) + 0.5
+        for y0 in range(0, height, band_rows):
+            rows = arange(y0, min(y0+band_rows, height), dtype=float64) + 0.5
+            gx = ones((len(rows), 1))*xs
+            gy = rows[:, None]*ones(width)
+            sx, sy = profile.distort_points(gx, gy, width, height)
+            maps[0, y0:y0+len(rows)] = sx
+            maps[1, y0:y0+len(rows)] = sy
+        maps.flush()
+        del maps
+        # Another process may have finished the same maps first, theirs will do
+        if not path.exists():
+            os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return open_memmap(path, mode='r')
+
+# Undistort an image array (H,W) or (H,W,C) with maps from undistortion_maps()
+# order is the spline order of scipy.ndimage.map_coordinates (0 nearest, 1 bilinear, 3 cubic)
+def undistort_image(image, maps, order=1, band_rows=256, cval=0.):
+    image = asarray(image)
+    out = empty(maps.shape[1:] + image.shape[2:], dtype=image.dtype)
+    channels = [image] if image.ndim == 2 else [image[..., c] for c in range(image.shape[2])]
+    for y0 in range(0, out.shape[0], band_rows):
+        # map_coordinates puts pixel centers at integer indices
+        coords = array((maps[1, y0:y0+band_rows], maps[0, y0:y0+band_rows])) - 0.5
+        for c, ch in enumerate(channels):
+            band = map_coordinates(ch, coords, order=order, cval=cval, mode='constant')
+            if image.ndim == 2:
+                out[y0:y0+band_rows] = band
+            else:
+                out[y0:y0+band_rows, :, c] = band
+    return out
+
+# Fit the perspective model and the distortion terms together to point constraints
+# Starts from the linear solution without distortion; terms selects which coefficients are
+# free (the rest stay 0). Returns x in SVDSolver form (x[0] is scale-1) and a CameraProfile.
+def fit_distortion(image_x, image_y, world_x, world_y, weight, width, height, name='camera',
+                   terms=('k1', 'k2', 'p1', 'p2')):
+    cols = [asarray(c, dtype=float) for c in (image_x, image_y, world_x, world_y)]
+    w = ones(len(cols[0]))*asarray(weight, dtype=float)
+    free = [TERMS.index(t) for t in terms]
+    T, r, t = BatchSVDSolver().ComputeSolutions(*(c[None] for c in cols), w[None])
+    T = T[0]
+    x0 = array([T[0,0], T[0,1], T[0,2], T[1,2], T[2,0], T[2,1]])
+    profile = CameraProfile(name)
+    cx, cy, f = profile.normalization(width, height)
+    xn, yn = (cols[0]-cx)/f, (cols[1]-cy)/f
+
+    def residuals(p):
+        c = zeros(len(TERMS))
+        c[free] = p[6:]
+        xu, yu = correct(c, xn, yn)
+        xu, yu = xu*f + cx, yu*f + cy
+        return concatenate((w*(model_fx(xu, yu, p) - cols[2]), w*(model_fy(xu, yu, p) - cols[3])))
+
+    res = least_squares(residuals, concatenate((x0, zeros(len(free)))), x_scale='jac')
+    for i, k in enumerate(free):
+        setattr(profile, TERMS[k], float(res.x[6+i]))
+    x = res.x[:6].copy()
+    x[0] -= 1.
+    return x, profile, res
@@ -113,6 +113,16 @@ class MainWindow(QtWidgets.QMainWindow):
         redo_action.triggered.connect(self.handleRedo)
         edit_menu.addAction(redo_action)
 
+        # View Menu
+        view_menu = menu_bar.addMenu("&View")
+
+        self.preview_action = QAction("&Rectified Preview", self)
+        self.preview_action.setShortcut("R")
+        self.preview_action.setCheckable(True)
+        self.preview_action.setStatusTip("Show the rectified photo")
+        self.preview_action.toggled.connect(self.handlePreview)
+        view_menu.addAction(self.preview_action)
+
         # Help Menu
         help_menu = menu_bar.addMenu("&Help")
         about_action = QAction("&About", self)
@@ -134,6 +144,11 @@ class MainWindow(QtWidgets.QMainWindow):
         else:
             self.statusbar.showMessage(f'{msg} Redone')
 
+    def handlePreview(self, checked: bool) -> None:
+        self.viewer.setPreviewVisible(checked)
+        if checked != self.viewer.previewVisible():
+            self.preview_action.setChecked(self.viewer.previewVisible())
+
     def handleCoords(self, point: QtCore.QPointF) -> None:
         if not point.isNull():
             #self.labelCoords.setText(f'{point.x()}, {point.y()}')
@@ -3,6 +3,7 @@ from PySide6 import QtCore, QtGui, QtWidgets
 from PySide6.QtWidgets import QGraphicsItem, QGraphicsPixmapItem
 from configparser import ConfigParser
 from undoredo import undoContext
+from constraint import PointConstraintDialog
 from pathlib import Path
 
 from typing import TYPE_CHECKING, Any
@@ -89,6 +90,10 @@ class Marker(QGraphicsPixmapItem):
             Marker.next_marker_id += 1
         else:
             self.mid = mid
+        self.view = view
+        # World position of the marker, if known, which makes it a point constraint
+        # Set through the view (ImageView.setMarkerWorld()), so the solve follows
+        self.world: QtCore.QPointF | None = None
         if not Marker.pixmaps_initialized:
            self._initPixmaps()
         self.setPos(pos)
@@ -97,9 +102,9 @@ class Marker(QGraphicsPixmapItem):
         #self.setTransformationMode(QtCore.Qt.SmoothTransformation)
         self.setFlags(QGraphicsItem.GraphicsItemFlag.ItemIsMovable | QGraphicsItem.GraphicsItemFlag.ItemIsSelectable)
         self.setFlag(QGraphicsItem.GraphicsItemFlag.ItemIgnoresTransformations, True)
+        self.setFlag(QGraphicsItem.GraphicsItemFlag.ItemSendsGeometryChanges, True)
         self.setAcceptHoverEvents(True)
         self.setPixmap(Marker.unselected_pixmap)
-        self.view = view
 
     def itemChange(self, change: QGraphicsItem.GraphicsItemChange, value: Any) -> Any:
         # if selection state changed, swap the pixmap
@@ -108,6 +113,9 @@ class Marker(QGraphicsPixmapItem):
                 self.setPixmap(Marker.selected_pixmap)
             else:
                 self.setPixmap(Marker.unselected_pixmap)
+        # Live updates while dragging, the view coalesces the solves
+        elif change == QGraphicsItem.GraphicsItemChange.ItemPositionHasChanged:
+            self.view.markerMoved(self)
         return super().itemChange(change, value)
     
     def shape(self) -> QtGui.QPainterPath:
@@ -155,8 +163,31 @@ class Marker(QGraphicsPixmapItem):
             action = QtGui.QAction("Delete Marker")
             action.triggered.connect(self.deleteYourself)
             context_menu.addAction(action)
+        context_menu.addSeparator()
+        world_action = QtGui.QAction("Set &World Position...")
+        world_action.triggered.connect(self.editWorld)
+        context_menu.addAction(world_action)
+        if self.world is not None:
+            clear_action = QtGui.QAction("Clear World Position")
+            clear_action.triggered.connect(self.clearWorld)
+            context_menu.addAction(clear_action)
         context_menu.exec(event.screenPos())
 
+    # Atomic Action
+    def editWorld(self) -> None:
+        dialog = PointConstraintDialog(self.view, self.world)
+        if dialog.exec() != QtWidgets.QDialog.DialogCode.Accepted:
+            return
+        with undoContext("Set World Position") as uctx:
+            self.view.setMarkerWorld(uctx, self.mid, dialog.world())
+        self.view.statusbar.showMessage("Set World Position")
+
+    # Atomic Action
+    def clearWorld(self) -> None:
+        with undoContext("Clear World Position") as uctx:
+            self.view.setMarkerWorld(uctx, self.mid, None)
+        self.view.statusbar.showMessage("Clear World Position")
+
     # Atomic Action
     def deleteYourself(self) -> None:
         with undoContext("Delete Marker") as uctx:
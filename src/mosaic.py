@@ -0,0 +1,256 @@
+import os
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from numpy import asarray, array, zeros, empty, minimum, clip, repeat, concatenate, float32, float64, uint8
+from numpy.linalg import inv, lstsq
+from numpy.lib.format import open_memmap
+
+from warp import METHODS, OutputGeometry, inverse_map_tile, sample, to_dtype
+from imagefile import read_image, image_size
+from phasecorr import phase_correlate
+
+#
+#  Mosaic of several rectified photos of one board
+#
+# Every photo is rectified into one canvas in world coordinates. Where photos overlap,
+# the pairwise offset left by their solutions is measured by phase correlation of the
+# overlap rendered from each photo, and one translation per photo is fitted to all
+# pairwise offsets by weighted least squares.
+#
+# The canvas is composited in bands of tile rows, straight into a .npy memmap. Each
+# pixel is the average of the photos covering it, weighted by the distance to each
+# photo's edge (feathering), so seams fade over the feather width. Photos are loaded
+# when the first band they cover is reached and released after their last, so only
+# the photos across one band are in memory, and the tiles of a band run on a thread pool.
+# Photos are decoded at most loaders at a time, however many workers there are, since
+# each is a full resolution image.
+#
+
+# One photo of the mosaic: source is an image file path or an (H,W[,C]) array (e.g. a
+# memmap), T its solution (image -> world), profile an optional lens.CameraProfile
+class Shot:
+    def __init__(self, source, T, profile=None) -> None:
+        self.source = source
+        self.T = asarray(T, dtype=float64)
+        self.profile = profile
+        if isinstance(source, (str, Path)):
+            self.size = image_size(source)
+        else:
+            self.size = (source.shape[1], source.shape[0])
+
+    def load(self, channels):
+        image = read_image(self.source) if isinstance(self.source, (str, Path)) else self.source
+        return match_channels(image, channels)
+
+    def Tinv(self):
+        return inv(self.T)
+
+    # World bounding box (x0, y0, x1, y1)
+    def bounds(self):
+        g = OutputGeometry.from_image(self.T, *self.size, 1.)
+        return g.x0, g.y0, g.x0 + g.width, g.y0 + g.height
+
+# Image with the given number of channels: gray is repeated, alpha dropped, color averaged
+def match_channels(image, channels):
+    c = image.shape[2] if image.ndim == 3 else 1
+    if c == channels:
+        return image
+    image = asarray(image)
+    if c == 1:
+        return repeat(image.reshape(image.shape[:2] + (1,)), channels, axis=2)
+    if channels == 1:
+        return image[..., :3].mean(axis=2).astype(image.dtype)
+    if channels < c:
+        return image[..., :channels]
+    return concatenate((image, full_alpha(image)), axis=2)
+
+def full_alpha(image):
+    a = empty(image.shape[:2] + (1,), dtype=image.dtype)
+    a[...] = 255 if image.dtype == uint8 else 1
+    return a
+
+# Canvas covering every shot at the given resolution (pixels per world unit)
+def mosaic_geometry(shots, resolution):
+    b = array([s.bounds() for s in shots])
+    size = 1./resolution
+    x0, y0 = b[:,0].min(), b[:,1].min()
+    return OutputGeometry(x0, y0, size, int((b[:,2].max()-x0)/size + 0.5), int((b[:,3].max()-y0)/size + 0.5))
+
+def overlaps(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+#
+#  Registration
+#
+
+# Overlap patches: (i, j, geometry) for every pair of shots whose bounds overlap by at
+# least min_overlap canvas pixels each way, at most max_size pixels around the center
+def overlap_patches(shots, geometry, min_overlap=32, max_size=512):
+    ps = geometry.pixel_size
+    bounds = [s.bounds() for s in shots]
+    patches = []
+    for i in range(len(shots)):
+        for j in range(i+1, len(shots)):
+            a, b = bounds[i], bounds[j]
+            x0, y0 = max(a[0], b[0]), max(a[1], b[1])
+            x1, y1 = min(a[2], b[2]), min(a[3], b[3])
+            w, h = int((x1-x0)/ps), int((y1-y0)/ps)
+            if w < min_overlap or h < min_overlap:
+                continue
+            cw, ch = min(w, max_size), min(h, max_size)
+            # Snapped to the canvas grid, so both renders share the canvas pixel phase
+            c0 = int(((x0+x1)/2 - geometry.x0)/ps - cw/2)
+            r0 = int(((y0+y1)/2 - geometry.y0)/ps - ch/2)
+            patches.append((i, j, OutputGeometry(geometry.x0 + c0*ps, geometry.y0 + r0*ps, ps, cw, ch)))
+    return patches
+
+# Render of a grayscale image of shot onto each of the patch geometries, with masks of
+# the pixels inside the photo
+def render_patches(shot, gray, geometries, method='bilinear'):
+    Tinv = shot.Tinv()
+    renders = []
+    for g in geometries:
+        sx, sy = inverse_map_tile(Tinv, g, 0, 0, g.height, g.width, shot.profile, shot.size)
+        values, inside = sample(gray, sx, sy, method)
+        renders.append((values[..., 0], inside))
+    return renders
+
+# Translation (world units) to add to each shot's solution so the overlaps agree
+# Returns the (n,2) corrections and the measured pairs (i, j, dx, dy, peak), dx, dy
+# being the world offset of shot j's content against shot i's. Pairs whose correlation
+# peak is under min_peak (no shared detail, e.g. blank board) are not used. Each shot
+# is loaded once, at most loaders at a time, and dropped once its patches are rendered;
+# patches of max_size pixels find offsets up to half that.
+def register(shots, geometry, min_peak=0.2, max_size=512, workers=None, loaders=2):
+    patches = overlap_patches(shots, geometry, max_size=max_size)
+    n = len(shots)
+    renders: dict = {}
+    def render(k):
+        mine = [(p, g) for p, (i, j, g) in enumerate(patches) if k in (i, j)]
+        if not mine:
+            return
+        gray = shots[k].load(1)
+        for (p, g), r in zip(mine, render_patches(shots[k], gray, [g for _, g in mine])):
+            renders[p, k] = r
+    with ThreadPoolExecutor(max_workers=min(workers or os.cpu_count() or 1, loaders)) as pool:
+        for f in [pool.submit(render, k) for k in range(n)]:
+            f.result()
+
+    ps = geometry.pixel_size
+    pairs = []
+    for p, (i, j, g) in enumerate(patches):
+        (a, ma), (b, mb) = renders[p, i], renders[p, j]
+        shift = phase_correlate(a, b, ma & mb)
+        if shift is None or shift[2] < min_peak:
+            continue
+        pairs.append((i, j, shift[0]*ps, shift[1]*ps, shift[2]))
+    return solve_corrections(n, pairs), pairs
+
+# Least squares translations t with t_j - t_i = -(offset of j against i), weighted by
+# the correlation peak; a weak pull of every t toward 0 fixes the gauge (the mean
+# position of the solutions is kept) and leaves shots without overlaps where they are
+def solve_corrections(n, pairs, prior=1e-3):
+    A = zeros((len(pairs) + n, n))
+    b = zeros((len(pairs) + n, 2))
+    for row, (i, j, dx, dy, peak) in enumerate(pairs):
+        A[row, i], A[row, j] = -peak, peak
+        b[row] = -peak*dx, -peak*dy
+    for k in range(n):
+        A[len(pairs)+k, k] = prior
+    return lstsq(A, b, rcond=None)[0]
+
+# Solution T moved by the world translation t
+def translated(T, t):
+    return array([[1., 0., t[0]], [0., 1., t[1]], [0., 0., 1.]]) @ T
+
+#
+#  Compositing
+#
+
+# Feather weight of each sample: distance to the nearest photo edge in source pixels,
+# ramping from 0 at the edge to 1 at feather pixels in
+def feather_weights(sx, sy, size, feather):
+    W, H = size
+    d = minimum(minimum(sx, W - sx), minimum(sy, H - sy))
+    return clip(d*(1./feather), 0., 1.).astype(float32)
+
+def composite_tile(shots, loaded, Tinvs, bounds, geometry, out, r0, c0, rows, cols, method, feather, fill):
+    g = geometry
+    box = (g.x0 + c0*g.pixel_size, g.y0 + r0*g.pixel_size,
+           g.x0 + (c0+cols)*g.pixel_size, g.y0 + (r0+rows)*g.pixel_size)
+    C = out.shape[2] if out.ndim == 3 else 1
+    acc = zeros((rows, cols, C), dtype=float32)
+    total = zeros((rows, cols, 1), dtype=float32)
+    for k, image in loaded.items():
+        if not overlaps(bounds[k], box):
+            continue
+        s = shots[k]
+        sx, sy = inverse_map_tile(Tinvs[k], g, r0, c0, rows, cols, s.profile, s.size)
+        # Bounds are loose for tilted shots, so most tiles they overlap need no samples
+        w = feather_weights(sx, sy, s.size, feather)
+        if not w.any():
+            continue
+        values, inside = sample(image, sx, sy, method)
+        w[~inside] = 0.
+        w = w[..., None]
+        acc += values.reshape(acc.shape)*w
+        total += w
+    uncovered = total[..., 0] == 0.
+    total[uncovered] = 1.
+    acc /= total
+    acc[uncovered] = fill
+    dest = out[r0:r0+rows, c0:c0+cols]
+    dest[...] = to_dtype(acc, out.dtype).reshape(dest.shape)
+
+# Composite shots onto geometry into a new .npy file at path, band_tiles rows of tiles
+# at a time; feather is the seam blending width in source pixels, loaders the number of
+# photos decoded at once. progress(rows_done, rows_total) is called after each band.
+# Returns the output opened as a read only memmap.
+def composite(shots, geometry, path, channels=3, dtype=uint8, method='bilinear', feather=64.,
+              tile=256, band_tiles=4, workers=None, fill=0, progress=None, loaders=2):
+    if method not in METHODS:
+        raise ValueError(f'Unknown sampling method: {method}')
+    workers = workers or os.cpu_count() or 1
+    shape = geometry.shape() + ((channels,) if channels > 1 else ())
+    out = open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+    Tinvs = [s.Tinv() for s in shots]
+    bounds = [s.bounds() for s in shots]
+    g = geometry
+    loaded: dict = {}
+    band = tile*band_tiles
+    with ThreadPoolExecutor(max_workers=workers) as pool, \
+         ThreadPoolExecutor(max_workers=min(workers, loaders)) as loading:
+        for r0 in range(0, g.height, band):
+            r1 = min(r0 + band, g.height)
+            wy0, wy1 = g.y0 + r0*g.pixel_size, g.y0 + r1*g.pixel_size
+            need = [k for k, b in enumerate(bounds) if b[1] < wy1 and b[3] > wy0]
+            # Bands run top down, so a shot above this band is never needed again
+            for k in [k for k in loaded if k not in need]:
+                del loaded[k]
+            new = [k for k in need if k not in loaded]
+            for k, image in zip(new, loading.map(lambda k: shots[k].load(channels), new)):
+                loaded[k] = image
+            futures = [pool.submit(composite_tile, shots, loaded, Tinvs, bounds, g, out, *t,
+                                   method, feather, fill) for t in g.tiles(tile, r0, r1)]
+            for f in futures:
+                f.result()
+            out.flush()
+            if progress is not None:
+                progress(r1, g.height)
+    loaded.clear()
+    del out
+    return open_memmap(path, mode='r')
+
+# Register shots against each other and composite them at resolution (pixels per world
+# unit) into path. Returns the output memmap and the registration pairs (see register())
+def mosaic(shots, path, resolution, channels=3, register_shots=True, min_peak=0.2, method='bilinear',
+           feather=64., tile=256, workers=None, fill=0, progress=None, loaders=2):
+    geometry = mosaic_geometry(shots, resolution)
+    pairs = []
+    if register_shots and len(shots) > 1:
+        corrections, pairs = register(shots, geometry, min_peak, workers=workers, loaders=loaders)
+        shots = [Shot(s.source, translated(s.T, t), s.profile) for s, t in zip(shots, corrections)]
+        geometry = mosaic_geometry(shots, resolution)
+    out = composite(shots, geometry, path, channels, method=method, feather=feather, tile=tile,
+                    workers=workers, fill=fill, progress=progress, loaders=loaders)
+    return out, pairs
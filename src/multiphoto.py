@@ -0,0 +1,156 @@
+from numpy import arange, zeros, concatenate, repeat, stack, full, sqrt, bincount, isnan, nan
+from scipy.optimize import least_squares
+from scipy.sparse import csr_matrix
+
+from solver import ConstraintStore, BatchSVDSolver, build_matrix, transform_from_solution, stack_constraint_sets
+from solver2 import model_fx, model_fy, jacobian_fx, jacobian_fy
+
+#
+#  Joint solve of several overlapping photos of one board
+#
+# Unknowns are one transformation per photo (the same 6 parameter model as SVDSolver)
+# and the world position of every shared point. Observations tie a point to its
+# image position in one photo; anchors tie a point to a known world position.
+# Each residual depends on one photo and one point only, so the Jacobian is sparse
+# and the solve scales linearly with the number of photos.
+#
+
+class MultiPhotoSolver:
+    def __init__(self) -> None:
+        self.nphotos = 0
+        # point id -> index
+        self.points: dict = {}
+        self.observations = ConstraintStore(('photo', 'point', 'image_x', 'image_y', 'weight'))
+        self.anchors = ConstraintStore(('point', 'world_x', 'world_y', 'weight'))
+
+    def AddPhoto(self):
+        self.nphotos += 1
+        return self.nphotos-1
+
+    def point_index(self, point):
+        if point not in self.points:
+            self.points[point] = len(self.points)
+        return self.points[point]
+
+    # point is any hashable id, e.g. a marker id shared between photos
+    def AddObservation(self, photo, point, image_x, image_y, weight=1.0):
+        if not 0 <= photo < self.nphotos:
+            raise ValueError(f'No photo {photo}')
+        self.observations.append(None, (photo, self.point_index(point), image_x, image_y, weight))
+
+    # Known world position of a point, this fixes the world frame
+    # Spread anchors over the board: anchors in one photo leave far photos weakly determined
+    def AddAnchor(self, point, world_x, world_y, weight=1.0):
+        self.anchors.append(None, (self.point_index(point), world_x, world_y, weight))
+
+    def columns(self):
+        o, a = self.observations, self.anchors
+        return (o.column('photo').astype(int), o.column('point').astype(int), o.column('image_x'),
+                o.column('image_y'), o.column('weight'), a.column('point').astype(int),
+                a.column('world_x'), a.column('world_y'), a.column('weight'))
+
+    # Parameter vector layout: 6 per photo, then 2 (world x, y) per point
+    # Photo parameters are in SVDSolver form (x[0] is scale-1)
+    def split(self, p):
+        n = 6*self.nphotos
+        return p[:n].reshape(self.nphotos, 6), p[n:].reshape(len(self.points), 2)
+
+    def FunctionG(self, p):
+        photo, point, ix, iy, w, apoint, awx, awy, aw = self.columns()
+        X, W = self.split(p)
+        x = X[photo].T.copy()
+        x[0] += 1.
+        return concatenate((w*(model_fx(ix, iy, x) - W[point,0]),
+                            w*(model_fy(ix, iy, x) - W[point,1]),
+                            aw*(W[apoint,0] - awx),
+                            aw*(W[apoint,1] - awy)))
+
+    # Analytic Jacobian, as a sparse matrix
+    def FunctionJ(self, p):
+        photo, point, ix, iy, w, apoint, awx, awy, aw = self.columns()
+        X, W = self.split(p)
+        x = X[photo].T.copy()
+        x[0] += 1.
+        nobs, nanc = len(photo), len(apoint)
+        wcol = 6*self.nphotos + 2*point
+        acol = 6*self.nphotos + 2*apoint
+        pcols = 6*photo[:, None] + arange(6)
+        rows = concatenate((repeat(arange(nobs), 7), repeat(arange(nobs, 2*nobs), 7),
+                            arange(2*nobs, 2*nobs+nanc), arange(2*nobs+nanc, 2*nobs+2*nanc)))
+        cols = concatenate((concatenate((pcols, wcol[:, None]), axis=1).ravel(),
+                            concatenate((pcols, wcol[:, None]+1), axis=1).ravel(),
+                            acol, acol+1))
+        data = concatenate((concatenate((w[:, None]*jacobian_fx(ix, iy, x), -w[:, None]), axis=1).ravel(),
+                            concatenate((w[:, None]*jacobian_fy(ix, iy, x), -w[:, None]), axis=1).ravel(),
+                            aw, aw))
+        return csr_matrix((data, (rows, cols)), shape=(2*nobs+2*nanc, len(p)))
+
+    # Nonzero structure of the Jacobian, for finite difference Jacobians
+    def JacobianSparsity(self):
+        J = self.FunctionJ(self.initial_guess(linear=False))
+        J.data[:] = 1.
+        return J
+
+    # Starting point: photos are solved linearly against points with known positions,
+    # then points are placed from the solved photos, until everything is reached.
+    # All photos that become solvable in a round are solved as one batch.
+    def initial_guess(self, linear=True):
+        photo, point, ix, iy, w, apoint, awx, awy, aw = self.columns()
+        X = zeros((self.nphotos, 6))
+        W = full((len(self.points), 2), nan)
+        if not linear:
+            return concatenate((X.ravel(), zeros(2*len(self.points))))
+        # Anchors first, averaged if a point has several
+        cnt = bincount(apoint, minlength=len(self.points))
+        known = cnt > 0
+        W[known, 0] = bincount(apoint, awx, len(self.points))[known]/cnt[known]
+        W[known, 1] = bincount(apoint, awy, len(self.points))[known]/cnt[known]
+        solved = zeros(self.nphotos, dtype=bool)
+        while not solved.all():
+            usable = ~isnan(W[point, 0]) & ~solved[photo]
+            counts = bincount(photo[usable], minlength=self.nphotos)
+            ready = (counts >= 3) & ~solved
+            if not ready.any():
+                missing = [int(i) for i in arange(self.nphotos)[~solved]]
+                raise ValueError(f'Photos {missing} are not connected to anchored points')
+            sets = []
+            for k in arange(self.nphotos)[ready]:
+                sel = usable & (photo == k)
+                sets.append(stack((ix[sel], iy[sel], W[point[sel],0], W[point[sel],1], w[sel]), axis=1))
+            # Similarity model only: perspective terms fit to one overlap region extrapolate
+            # badly along a chain of photos, the joint solve adds them back
+            ix_, iy_, wx_, wy_, w_, mask = stack_constraint_sets(sets)
+            A, b = build_matrix(ix_, iy_, wx_, wy_, w_*mask)
+            X[ready] = BatchSVDSolver().compute_reduced_solution(A, b, 2*mask.sum(axis=1), [0,1,2,3])[0]
+            solved |= ready
+            # Place unknown points seen by solved photos at their mean mapped position
+            sel = solved[photo] & isnan(W[point, 0])
+            if sel.any():
+                x = X[photo[sel]].T.copy()
+                x[0] += 1.
+                n = bincount(point[sel], minlength=len(self.points))
+                new = n > 0
+                W[new, 0] = bincount(point[sel], model_fx(ix[sel], iy[sel], x), len(self.points))[new]/n[new]
+                W[new, 1] = bincount(point[sel], model_fy(ix[sel], iy[sel], x), len(self.points))[new]/n[new]
+        if isnan(W).any():
+            raise ValueError('Some points are not observed in any photo')
+        return concatenate((X.ravel(), W.ravel()))
+
+    # Returns T for every photo (P,3,3) and the world position of every point (N,2),
+    # in the order points were first seen; self.points maps ids to rows
+    def ComputeSolution(self, analytic=True):
+        p0 = self.initial_guess()
+        if analytic:
+            res = least_squares(self.FunctionG, p0, jac=self.FunctionJ, tr_solver='lsmr', x_scale='jac')
+        else:
+            res = least_squares(self.FunctionG, p0, jac_sparsity=self.JacobianSparsity(),
+                                tr_solver='lsmr', x_scale='jac')
+        self.result = res
+        X, W = self.split(res.x)
+        # RMS world residual of each photo's observations
+        photo = self.columns()[0]
+        nobs = len(photo)
+        r2 = res.fun[:nobs]**2 + res.fun[nobs:2*nobs]**2
+        self.photo_rms = sqrt(bincount(photo, r2, self.nphotos)/bincount(photo, minlength=self.nphotos).clip(1))
+        print(f'Joint solution: {self.nphotos} photos, {len(self.points)} points, nfev={res.nfev}, cost={res.cost:.6g}')
+        return transform_from_solution(X), W.copy()
@@ -0,0 +1,125 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from numpy import array, arange, zeros, concatenate, column_stack, exp, abs as npabs, stack, sqrt, argsort
+from numpy.linalg import lstsq
+from numpy.random import default_rng
+from scipy.optimize import least_squares
+
+from solver2 import delta_residuals, delta_jacobian
+
+#
+#  Multi-start nonlinear solve for delta constraints
+#
+# With strong perspective the delta constraint fit has local minima, so the fit is run
+# from a spread of starting points across a process pool and the lowest cost kept.
+# Each worker gets a share of the starts, so with one share per core the wall time
+# is about one fit plus the pool start up.
+#
+# Solution vectors here are in NLLSSolver form (x[0] is the scale itself).
+# Delta constraints do not see the translation, so x[2] and x[3] stay at 0.
+#
+
+# Scale and rotation from the deltas with the perspective terms dropped,
+# which makes them linear (see hybrid.HybridSolver)
+def linear_start(dx, dy):
+    DXx, DYx = dx[0]-dx[2], dx[1]-dx[3]
+    DXy, DYy = dy[0]-dy[2], dy[1]-dy[3]
+    A = concatenate((column_stack((DXx, DYx)), column_stack((DYy, -DXy))))
+    b = concatenate((dx[4], dy[4]))
+    if len(b) < 2:
+        return array([1., 0., 0., 0., 0., 0.])
+    (s, r), *_ = lstsq(A, b, rcond=None)
+    return array([s, r, 0., 0., 0., 0.])
+
+# nstarts starting points around the linear estimate: the first is the estimate itself,
+# the rest perturb scale and rotation and draw perspective terms that keep the
+# denominator 1 + g*x + h*y within [1-spread, 1+spread] over the image
+def starting_points(dx, dy, nstarts, spread=0.5, seed=None):
+    rng = default_rng(seed)
+    x0 = linear_start(dx, dy)
+    extent = max([npabs(c).max() for c in (dx[0], dx[1], dx[2], dx[3], dy[0], dy[1], dy[2], dy[3]) if len(c)] + [1.])
+    X = zeros((nstarts, 6))
+    X[:] = x0
+    n = nstarts-1
+    X[1:,0] = x0[0]*exp(rng.normal(0., spread/4, n))
+    X[1:,1] = x0[1] + abs(x0[0])*rng.normal(0., spread/4, n)
+    X[1:,4:] = rng.uniform(-spread/(2*extent), spread/(2*extent), (n, 2))
+    return X
+
+# One share of the starts, run in a worker process
+def fit_starts(starts, dx, dy, kwargs):
+    out = []
+    for x0 in starts:
+        res = least_squares(delta_residuals, x0, jac=delta_jacobian, args=(dx, dy), **kwargs)
+        out.append((res.x, res.cost, res.nfev, res.status))
+    return out
+
+# Group solutions that move the image corners by less than tol world units
+# Returns a list of (indices, cost), best cluster first
+def cluster_solutions(X, cost, corners, tol):
+    cx, cy = corners
+    D = 1 + X[:,4,None]*cx + X[:,5,None]*cy
+    wx = ( X[:,0,None]*cx + X[:,1,None]*cy)/D
+    wy = (-X[:,1,None]*cx + X[:,0,None]*cy)/D
+    P = stack((wx, wy), axis=-1)
+    clusters = []
+    for i in argsort(cost):
+        for members, c in clusters:
+            j = members[0]
+            if sqrt(((P[i]-P[j])**2).sum(axis=-1)).max() < tol:
+                members.append(int(i))
+                break
+        else:
+            clusters.append(([int(i)], float(cost[i])))
+    return clusters
+
+class MultiStartResult:
+    def __init__(self, x, cost, starts, X, costs, nfev, status, clusters) -> None:
+        self.x = x                  # best solution
+        self.cost = cost
+        self.starts = starts        # (S,6) starting points
+        self.solutions = X          # (S,6) solution from each start
+        self.costs = costs          # (S,) final cost from each start
+        self.nfev = nfev
+        self.status = status
+        self.clusters = clusters    # [(start indices, cost)], best first
+
+# dx, dy are the column tuples of the delta constraint stores, see NLLSSolver.dxcolumns()
+# workers defaults to the number of cores; executor may be an existing pool to reuse
+# tol is the clustering tolerance in world units, by default 1e-4 of the largest world delta
+def multistart_solve(dx, dy, nstarts=None, workers=None, executor=None, spread=0.5, seed=None,
+                     tol=None, **kwargs):
+    workers = workers or os.cpu_count() or 1
+    nstarts = nstarts or max(workers, 8)
+    # Copies, store columns are views into arrays that may be reallocated
+    dx, dy = tuple(array(c, dtype=float) for c in dx), tuple(array(c, dtype=float) for c in dy)
+    X = starting_points(dx, dy, nstarts, spread, seed)
+    shares = [X[i::workers] for i in range(min(workers, nstarts))]
+    order = concatenate([arange(nstarts)[i::workers] for i in range(len(shares))])
+    if executor is not None:
+        results = [f.result() for f in [executor.submit(fit_starts, s, dx, dy, kwargs) for s in shares]]
+    elif len(shares) == 1:
+        results = [fit_starts(shares[0], dx, dy, kwargs)]
+    else:
+        with ProcessPoolExecutor(max_workers=len(shares)) as pool:
+            results = [f.result() for f in [pool.submit(fit_starts, s, dx, dy, kwargs) for s in shares]]
+    flat = [r for share in results for r in share]
+    S = zeros((nstarts, 6))
+    costs = zeros(nstarts)
+    nfev = zeros(nstarts, dtype=int)
+    status = zeros(nstarts, dtype=int)
+    for k, (x, c, n, st) in zip(order, flat):
+        S[k], costs[k], nfev[k], status[k] = x, c, n, st
+
+    if tol is None:
+        world = concatenate((npabs(dx[4]), npabs(dy[4]), [1.]))
+        tol = 1e-4*world.max()
+    cx = concatenate((dx[0], dx[2], dy[0], dy[2]))
+    cy = concatenate((dx[1], dx[3], dy[1], dy[3]))
+    if len(cx):
+        corners = (array([cx.min(), cx.max(), cx.max(), cx.min()]), array([cy.min(), cy.min(), cy.max(), cy.max()]))
+    else:
+        corners = (zeros(1), zeros(1))
+    clusters = cluster_solutions(S, costs, corners, tol)
+    best = clusters[0][0][0]
+    return MultiStartResult(S[best], costs[best], X, S, costs, nfev, status, clusters)
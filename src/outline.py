@@ -0,0 +1,159 @@
+from numpy import asarray, array, argwhere, arctan2, bincount, concatenate, cos, cumsum, histogram, \
+                  argmax, hypot, pad, pi, roll, sin, stack, float32, float64
+from scipy.ndimage import gaussian_gradient_magnitude, binary_closing, binary_opening, \
+                          binary_dilation, binary_erosion, binary_fill_holes, label
+from scipy.spatial import ConvexHull
+
+from imagepyramid import build_pyramid, level_for_size
+from mosaic import match_channels
+from warp import half_planes
+
+#
+#  Board outline detection
+#
+# Finds the board in a photo so the warp can be limited to it (warp(..., region=)).
+# Works on a pyramid level of about size pixels: the board is where the edges are
+# (components, traces, silkscreen, and the outline against the background), so the
+# edge map is closed into solid regions, holes filled, thin clutter like cables opened
+# away, and the largest region taken. A textured background has edges too, so in color
+# images the region is then narrowed to the board's dominant color: the most common
+# hue among its strongly colored pixels (the solder mask), with silver copper and parts
+# inside the board filled back in. The convex hull of the result, simplified and grown
+# by a margin, is the outline, in full resolution image positions.
+#
+
+# Threshold between the two classes of values that best separates them (Otsu)
+def otsu(values, bins=256):
+    counts, edges = histogram(values, bins)
+    centers = (edges[:-1] + edges[1:])/2
+    w0 = cumsum(counts).astype(float64)
+    w1 = w0[-1] - w0
+    m0 = cumsum(counts*centers)
+    m1 = m0[-1] - m0
+    valid = (w0 > 0) & (w1 > 0)
+    between = w0*w1*(m0/w0.clip(1) - m1/w1.clip(1))**2
+    between[~valid] = 0.
+    return centers[argmax(between)]
+
+# Douglas-Peucker simplification of a closed polygon (N,2); points dropped are within
+# tolerance of the result
+def simplify(polygon, tolerance):
+    p = asarray(polygon, dtype=float64)
+    if len(p) <= 3:
+        return p
+    # Split at the vertex farthest from the first, simplify both chains
+    far = int(argmax(((p - p[0])**2).sum(axis=1)))
+    keep = {0, far}
+    pending = [(0, far), (far, len(p))]
+    while pending:
+        i, j = pending.pop()
+        if j - i < 2:
+            continue
+        a, b = p[i], p[j % len(p)]
+        d = b - a
+        n = (d**2).sum()**0.5
+        seg = p[i+1:j]
+        dist = abs(d[0]*(seg[:,1] - a[1]) - d[1]*(seg[:,0] - a[0]))/n if n > 0 else ((seg - a)**2).sum(axis=1)**0.5
+        k = int(argmax(dist))
+        if dist[k] > tolerance:
+            keep.add(i+1+k)
+            pending += [(i, i+1+k), (i+1+k, j)]
+    return p[sorted(keep)]
+
+# Convex polygon grown outward by distance (its edges moved out, corners mitered)
+def offset(polygon, distance):
+    planes = half_planes(polygon)
+    planes /= (planes[:,0]**2 + planes[:,1]**2)[:,None]**0.5
+    planes[:,2] += distance
+    # Vertex i is where edges i-1 and i meet
+    a1, b1, c1 = roll(planes, 1, axis=0).T
+    a2, b2, c2 = planes.T
+    det = a1*b2 - a2*b1
+    return stack(((b1*c2 - b2*c1)/det, (a2*c1 - a1*c2)/det), axis=1)
+
+# Convex polygon clipped to the rectangle [0, width] x [0, height] (Sutherland-Hodgman)
+def clip_to_rect(polygon, width, height):
+    p = [tuple(v) for v in polygon]
+    for axis, limit, keep_below in ((0, 0., False), (0, width, True), (1, 0., False), (1, height, True)):
+        inside = lambda v: v[axis] <= limit if keep_below else v[axis] >= limit
+        out = []
+        for k in range(len(p)):
+            a, b = p[k-1], p[k]
+            if inside(b) != inside(a):
+                t = (limit - a[axis])/(b[axis] - a[axis])
+                out.append((a[0] + t*(b[0] - a[0]), a[1] + t*(b[1] - a[1])))
+            if inside(b):
+                out.append(b)
+        p = out
+        if not p:
+            break
+    return array(p, dtype=float64)
+
+# Largest solid region of a bool mask: closed by r pixels, holes filled, opened by r so
+# thin connections break, or None if it covers less than min_area of the mask
+def largest_region(mask, r, min_area=0.05):
+    # Padded, so closing does not erode a board that runs off the frame
+    closed = binary_closing(pad(mask, r, mode='edge'), iterations=r)[r:-r, r:-r]
+    filled = binary_fill_holes(closed)
+    labels, n = label(binary_opening(filled, iterations=r))
+    if n == 0:
+        return None
+    sizes = bincount(labels.ravel())
+    sizes[0] = 0
+    k = int(argmax(sizes))
+    if sizes[k] < min_area*mask.size:
+        return None
+    # Opening rounds the board's corners off, grow it back within the filled region
+    return filled & binary_dilation(labels == k, iterations=r)
+
+# Board region of a pyramid level as a bool mask, or None if nothing covers min_area of it
+def board_mask(gray, sigma=1., min_area=0.05):
+    g = gaussian_gradient_magnitude(asarray(gray, dtype=float32), sigma)
+    r = max(2, int(round(max(gray.shape)/64)))
+    return largest_region(g > otsu(g), r, min_area)
+
+# Pixels of an (H,W,3) pyramid level with the dominant color of region, a bool mask.
+# Chroma is taken on opponent axes; the dominant hue is the most common one (bins of
+# 360/bins degrees) among the region's pixels with more chroma than the Otsu threshold,
+# and a pixel has it if its chroma along that hue is above the Otsu threshold.
+def color_mask(rgb, region, bins=36):
+    c = asarray(rgb[..., :3], dtype=float32)
+    u = c[..., 0] - c[..., 1]
+    v = (c[..., 0] + c[..., 1])/2 - c[..., 2]
+    chroma = hypot(u, v)
+    hue = ((arctan2(v, u) + pi)*(bins/(2*pi))).astype(int) % bins
+    counts = bincount(hue[region & (chroma > otsu(chroma))], minlength=bins)
+    counts = counts + roll(counts, 1) + roll(counts, -1)
+    angle = (int(argmax(counts)) + 0.5)*(2*pi/bins) - pi
+    along = u*cos(angle) + v*sin(angle)
+    return along > otsu(along)
+
+# Board region of a pyramid level (H,W[,C]) as a bool mask, or None if nothing covers
+# min_area of it; the edge region, narrowed to its dominant color in color images
+def board_region(level, sigma=1., min_area=0.05):
+    mask = board_mask(match_channels(level, 1), sigma, min_area)
+    if mask is None or level.ndim < 3 or level.shape[2] < 3:
+        return mask
+    # Denser than the edge map, so half the closing radius; a larger one bridges the
+    # gaps to background objects around the board (rails, clamps)
+    r = max(2, int(round(max(level.shape[:2])/128)))
+    colored = largest_region(color_mask(level, mask) & mask, r, min_area)
+    return mask if colored is None else colored
+
+# Convex board outline (N,2) in image positions of image (H,W[,C]), or None if no board
+# stands out from the background. margin (image pixels) is added around the board.
+def detect_outline(image, size=512, margin=16., sigma=1., min_area=0.05, tolerance=1.):
+    levels = build_pyramid(image, min_size=32)
+    l = level_for_size(levels, size)
+    mask = board_region(levels[l], sigma, min_area)
+    if mask is None:
+        return None
+    # Corners of the pixels on the region's edge, in full resolution image positions
+    edge = argwhere(mask & ~binary_erosion(mask))[:, ::-1].astype(float64)
+    points = concatenate([edge + d for d in ((0., 0.), (1., 0.), (0., 1.), (1., 1.))])*2.**l
+    hull = points[ConvexHull(points).vertices]
+    tolerance *= 2.**l
+    polygon = offset(simplify(hull, tolerance), margin + tolerance)
+    H, W = image.shape[:2]
+    polygon = clip_to_rect(polygon, W, H)
+    return polygon if len(polygon) >= 3 else None
@@ -0,0 +1,81 @@
+from numpy import asarray, arange, outer, hanning, conj, exp, pi, argmax, unravel_index, float32
+from scipy import fft
+
+#
+#  FFT phase correlation
+#
+# The normalized cross power spectrum of two images that differ by a translation is a
+# pure phase ramp, and its inverse transform a single peak at the translation. The
+# whole pixel peak is refined by evaluating the inverse transform on a finer grid around
+# it (Guizar-Sicairos et al. 2008). The peak height, about 1 for identical content and
+# near 0 for unrelated content, is a measure of how much to trust the shift.
+#
+
+# Largest rectangle (r0, r1, c0, c1) that is all True, by trimming the edge row or
+# column with the most False values until none is left
+def valid_rect(mask):
+    bad = ~mask
+    # Invalid pixels per row (over the kept columns) and per column (over the kept rows)
+    rows, cols = bad.sum(axis=1), bad.sum(axis=0)
+    r0, r1, c0, c1 = 0, mask.shape[0], 0, mask.shape[1]
+    while r0 < r1 and c0 < c1:
+        edges = (rows[r0], rows[r1-1], cols[c0], cols[c1-1])
+        worst = max(range(4), key=lambda i: edges[i])
+        if edges[worst] == 0:
+            break
+        if worst < 2:
+            r = r0 if worst == 0 else r1-1
+            cols[c0:c1] -= bad[r, c0:c1]
+            r0, r1 = (r0+1, r1) if worst == 0 else (r0, r1-1)
+        else:
+            c = c0 if worst == 2 else c1-1
+            rows[r0:r1] -= bad[r0:r1, c]
+            c0, c1 = (c0+1, c1) if worst == 2 else (c0, c1-1)
+    return r0, r1, c0, c1
+
+# Zero mean, Hann windowed copy, so the image borders do not correlate
+def windowed(a):
+    a = asarray(a, dtype=float32)
+    a = a - a.mean()
+    return a*outer(hanning(a.shape[0]), hanning(a.shape[1])).astype(float32)
+
+# Correlation r = ifft2(R) at the points y0 + arange(ny)*step, x0 + arange(nx)*step,
+# by matrix multiplication DFT, for sampling around the peak at sub-pixel spacing
+def dft_window(R, y0, x0, ny, nx, step):
+    h, w = R.shape
+    y = y0 + arange(ny)*step
+    x = x0 + arange(nx)*step
+    ey = exp((2j*pi/h)*outer(y, fft.fftfreq(h, 1./h)))
+    ex = exp((2j*pi/w)*outer(fft.fftfreq(w, 1./w), x))
+    return (ey @ R @ ex).real/(h*w)
+
+# Shift (dx, dy) of b relative to a, in pixels: b(x, y) ~ a(x - dx, y - dy)
+# a and b are same shape 2D arrays, mask (optional) the pixels valid in both; only the
+# largest fully valid rectangle is compared. Returns (dx, dy, peak height), or None if
+# less than min_size x min_size pixels are valid. Shifts are found up to half the size,
+# to 1/upsample pixel. whiten is the power of the spectrum magnitude divided out: 1 is
+# pure phase correlation, smaller values keep more weight on the low frequencies, which
+# resists noise and content entering or leaving the window better (0 is plain correlation).
+def phase_correlate(a, b, mask=None, min_size=16, upsample=50, whiten=0.5):
+    if mask is not None:
+        r0, r1, c0, c1 = valid_rect(asarray(mask, dtype=bool))
+        a, b = a[r0:r1, c0:c1], b[r0:r1, c0:c1]
+    if min(a.shape) < min_size:
+        return None
+    A = fft.fft2(windowed(a), workers=-1)
+    B = fft.fft2(windowed(b), workers=-1)
+    R = conj(A)*B
+    R /= abs(R)**whiten + 1e-12
+    # Scaled so the peak of identical images is 1
+    R /= abs(R).mean() + 1e-12
+    r = fft.ifft2(R, workers=-1).real
+    h, w = r.shape
+    py, px = unravel_index(argmax(r), r.shape)
+    # Wrap to [-size/2, size/2)
+    py = py - h if py >= h/2 else py
+    px = px - w if px >= w/2 else px
+    # Refine within a pixel of the whole pixel peak, upsample times finer
+    n = 2*upsample + 1
+    u = dft_window(R, py - 1., px - 1., n, n, 1./upsample)
+    uy, ux = unravel_index(argmax(u), u.shape)
+    return px - 1. + ux/upsample, py - 1. + uy/upsample, float(u[uy, ux])
@@ -0,0 +1,348 @@
+import os
+import threading
+from hashlib import blake2b
+from math import floor, log2
+from concurrent.futures import ThreadPoolExecutor
+from numpy import asarray, arange, empty, full, clip, rint, count_nonzero, float32, float64, uint8
+from numpy.linalg import inv
+from scipy.ndimage import gaussian_filter
+
+from warp import METHODS, TAPS, inverse_map_tile, sample, to_dtype, region_planes, region_mask
+from warpcache import ArrayCache, image_digest
+from imagepyramid import downsample
+from lens import MAP_CACHE, undistortion_maps
+
+#
+#  Lazy tile pipeline
+#
+# A chain of stages (undistort, rectify, crop, flatten illumination, enhance contrast)
+# from a source image, evaluated a tile at a time, on demand: a tile of a stage's
+# output reads the part of its input it needs, which is assembled from the tiles of
+# the stage before, and so on back to the source. No stage ever writes a whole image.
+#
+# Every tile is kept in one LRU (warpcache.ArrayCache) under the key of its stage,
+# which hashes the stage's parameters together with the key of the stage before it.
+# Changing a stage therefore changes its key and the keys of every stage after it,
+# while the tiles before it are still found in the cache; stale tiles age out of the LRU.
+#
+# The viewer pulls tiles (preview.PreviewRenderer.startPipeline()) and the exporters
+# read rows through view(), which slices like an array.
+#
+
+def digest(*parts):
+    h = blake2b(digest_size=16)
+    for p in parts:
+        h.update(p.tobytes() if hasattr(p, 'tobytes') else repr(p).encode())
+    return h.hexdigest()
+
+# A step of the pipeline. key() changes whenever the output would; output_shape()
+# is the output's (H,W[,C]) for the input's; tile() computes output rows r0:r0+rows,
+# columns c0:c0+cols, calling read(y0, y1, x0, x1), which returns the input window
+# clipped to the input and its (x, y) origin.
+class Stage:
+    def key(self) -> str:
+        raise NotImplementedError
+
+    def output_shape(self, shape):
+        return shape
+
+    def tile(self, read, shape, dtype, r0, c0, rows, cols):
+        raise NotImplementedError
+
+# Sample input positions sx, sy (pixel centers at integer + 0.5) from the input window
+# around them, see warp.sample()
+def resample(read, shape, dtype, sx, sy, method, fill):
+    margin = TAPS[method] + 1
+    x0, x1 = int(floor(sx.min())) - margin, int(floor(sx.max())) + margin + 1
+    y0, y1 = int(floor(sy.min())) - margin, int(floor(sy.max())) + margin + 1
+    window, origin = read(y0, y1, x0, x1)
+    if window.size == 0:
+        return full(sx.shape + shape[2:], fill, dtype=dtype)
+    values, inside = sample(window, sx, sy, method, origin, shape[1::-1])
+    values[~inside] = fill
+    return to_dtype(values, dtype).reshape(sx.shape + shape[2:])
+
+# Lens correction, the same size as the photo, through the cached maps of lens.py
+class Undistort(Stage):
+    def __init__(self, profile, method='bilinear', fill=0, cache_dir=MAP_CACHE) -> None:
+        self.profile, self.method, self.fill = profile, method, fill
+        self.cache_dir = cache_dir
+        self._maps = None
+        self._lock = threading.Lock()
+
+    def key(self):
+        return digest('undistort', self.profile.digest(), self.method, self.fill)
+
+    # Built (or mapped from the cache) by the first tile, once
+    def maps(self, width, height):
+        with self._lock:
+            if self._maps is None or self._maps.shape[1:] != (height, width):
+                self._maps = undistortion_maps(self.profile, width, height, self.cache_dir)
+            return self._maps
+
+    def tile(self, read, shape, dtype, r0, c0, rows, cols):
+        maps = self.maps(shape[1], shape[0])
+        sx = maps[0, r0:r0+rows, c0:c0+cols]
+        sy = maps[1, r0:r0+rows, c0:c0+cols]
+        return resample(read, shape, dtype, sx, sy, self.method, self.fill)
+
+# Perspective rectification with solution T onto geometry, optionally limited to a
+# convex region of input positions (see warp.py)
+class Rectify(Stage):
+    def __init__(self, T, geometry, method='bilinear', fill=0, region=None) -> None:
+        if method not in METHODS:
+            raise ValueError(f'Unknown sampling method: {method}')
+        self.T = asarray(T, dtype=float64)
+        self.Tinv = inv(self.T)
+        self.geometry = geometry
+        self.method, self.fill = method, fill
+        self.region = None if region is None else asarray(region, dtype=float64)
+        self.planes = None if region is None else region_planes(self.region, self.T, geometry)
+
+    def key(self):
+        g = self.geometry
+        return digest('rectify', self.T, (g.x0, g.y0, g.pixel_size, g.width, g.height), self.method,
+                      self.fill, self.region)
+
+    def output_shape(self, shape):
+        return self.geometry.shape() + tuple(shape[2:])
+
+    def tile(self, read, shape, dtype, r0, c0, rows, cols):
+        out_shape = (rows, cols) + tuple(shape[2:])
+        keep = True if self.planes is None else region_mask(self.planes, r0, c0, rows, cols)
+        if keep is False:
+            return full(out_shape, self.fill, dtype=dtype)
+        sx, sy = inverse_map_tile(self.Tinv, self.geometry, r0, c0, rows, cols)
+        if keep is True or 2*count_nonzero(keep) > keep.size:
+            # Mostly inside, see warp.warp_tile()
+            out = resample(read, shape, dtype, sx, sy, self.method, self.fill)
+            if keep is not True:
+                out[~keep] = self.fill
+            return out
+        out = full(out_shape, self.fill, dtype=dtype)
+        out[keep] = resample(read, shape, dtype, sx[keep], sy[keep], self.method, self.fill)
+        return out
+
+# Rectangle x, y, width, height of the input
+class Crop(Stage):
+    def __init__(self, x, y, width, height) -> None:
+        self.x, self.y, self.width, self.height = int(x), int(y), int(width), int(height)
+
+    def key(self):
+        return digest('crop', self.x, self.y, self.width, self.height)
+
+    def output_shape(self, shape):
+        if self.x < 0 or self.y < 0 or self.x + self.width > shape[1] or self.y + self.height > shape[0]:
+            raise ValueError(f'Crop {self.width}x{self.height}+{self.x}+{self.y} is outside the {shape[1]}x{shape[0]} input')
+        return (self.height, self.width) + tuple(shape[2:])
+
+    def tile(self, read, shape, dtype, r0, c0, rows, cols):
+        window, origin = read(self.y + r0, self.y + r0 + rows, self.x + c0, self.x + c0 + cols)
+        return window
+
+# Uneven lighting divided out: every pixel is scaled so the local mean brightness, a
+# Gaussian blur of sigma pixels, becomes target. The blur is taken on a reduced copy of
+# the tile and a 4 sigma margin around it, with the reduction grid fixed to the image,
+# so neighbouring tiles agree.
+class FlattenIllumination(Stage):
+    def __init__(self, sigma=64., target=160.) -> None:
+        self.sigma, self.target = float(sigma), float(target)
+
+    def key(self):
+        return digest('flatten', self.sigma, self.target)
+
+    def tile(self, read, shape, dtype, r0, c0, rows, cols):
+        levels = max(0, int(log2(max(self.sigma/4., 1.))))
+        f = 2**levels
+        m = int(4*self.sigma)
+        # Window aligned to the reduction grid
+        y0, x0 = max(0, (r0 - m)//f*f), max(0, (c0 - m)//f*f)
+        window, (wx, wy) = read(y0, r0 + rows + m, x0, c0 + cols + m)
+        gray = window.astype(float32)
+        if gray.ndim == 3:
+            gray = gray.mean(axis=2)
+        for i in range(levels):
+            gray = downsample(gray)
+        light = gaussian_filter(gray, self.sigma/f, mode='nearest')
+        # Tile pixel centers in the reduced copy, see imagepyramid
+        sx = ((c0 - wx + arange(cols) + 0.5)/f)[None,:].repeat(rows, axis=0)
+        sy = ((r0 - wy + arange(rows) + 0.5)/f)[:,None].repeat(cols, axis=1)
+        level, _ = sample(light, sx, sy, 'bilinear')
+        gain = self.target/level.clip(1.)
+        t = window[r0-wy:r0-wy+rows, c0-wx:c0-wx+cols].astype(float32)
+        t *= gain if t.ndim == 3 else gain[..., 0]
+        return to_dtype(t, dtype)
+
+# Levels and gamma: black maps to 0, white to the full scale (255 for 8 bit images)
+class EnhanceContrast(Stage):
+    def __init__(self, black=0., white=255., gamma=1.) -> None:
+        if white <= black:
+            raise ValueError('white must be above black')
+        self.black, self.white, self.gamma = float(black), float(white), float(gamma)
+
+    def key(self):
+        return digest('contrast', self.black, self.white, self.gamma)
+
+    def curve(self, values, top):
+        v = clip((asarray(values, dtype=float32) - self.black)/(self.white - self.black), 0., 1.)
+        return v**(1./self.gamma)*top
+
+    def tile(self, read, shape, dtype, r0, c0, rows, cols):
+        window, origin = read(r0, r0 + rows, c0, c0 + cols)
+        if dtype == uint8:
+            lut = rint(self.curve(arange(256), 255.)).astype(uint8)
+            return lut[window]
+        return to_dtype(self.curve(window, 255.), dtype)
+
+class Pipeline:
+    # source is an (H,W[,C]) array or memmap; source_key identifies its content, by
+    # default its digest (which reads it once)
+    def __init__(self, source, stages=(), tile=256, cache=None, workers=None, source_key=None) -> None:
+        self.source = source
+        self.stages = list(stages)
+        self.tile_size = tile
+        self.cache = cache if cache is not None else ArrayCache()
+        self.workers = workers or os.cpu_count() or 1
+        self.source_key = source_key or image_digest(source)
+        self._lock = threading.Lock()
+        self._pending: dict = {}
+        self.update()
+
+    # Shapes and keys of every stage output, index 0 being the source
+    def update(self) -> None:
+        shapes, keys = [tuple(self.source.shape)], [self.source_key]
+        for s in self.stages:
+            shapes.append(tuple(s.output_shape(shapes[-1])))
+            keys.append(digest(keys[-1], s.key(), self.tile_size))
+        self.shapes, self.keys = shapes, keys
+
+    # Replace stage i (0 is the first stage after the source); only the tiles of it and
+    # the stages after it are recomputed
+    def setStage(self, i, stage) -> None:
+        self.stages[i] = stage
+        self.update()
+
+    @property
+    def shape(self):
+        return self.shapes[-1]
+
+    @property
+    def dtype(self):
+        return self.source.dtype
+
+    def tiles(self, level=None):
+        level = len(self.stages) if level is None else level
+        h, w = self.shapes[level][:2]
+        t = self.tile_size
+        return [(i, j) for i in range(0, (h + t - 1)//t) for j in range(0, (w + t - 1)//t)]
+
+    # Output tile (i, j) of stage output level, computed once even if several threads
+    # ask for it at the same time
+    def tile(self, i, j, level=None):
+        level = len(self.stages) if level is None else level
+        if level == 0:
+            t = self.tile_size
+            return asarray(self.source[i*t:(i+1)*t, j*t:(j+1)*t])
+        key = f'{self.keys[level]}-{i}-{j}'
+        value = self.cache.get(key)
+        if value is not None:
+            return value
+        with self._lock:
+            event = self._pending.get(key)
+            owner = event is None
+            if owner:
+                event = self._pending[key] = threading.Event()
+        if not owner:
+            event.wait()
+            value = self.cache.get(key)
+            if value is not None:
+                return value
+        try:
+            value = self.compute(level, i, j)
+            self.cache.put(key, value)
+        finally:
+            if owner:
+                with self._lock:
+                    del self._pending[key]
+                event.set()
+        return value
+
+    def compute(self, level, i, j):
+        h, w = self.shapes[level][:2]
+        t = self.tile_size
+        r0, c0 = i*t, j*t
+        read = lambda y0, y1, x0, x1: self.window(level-1, y0, y1, x0, x1)
+        return self.stages[level-1].tile(read, self.shapes[level-1], self.dtype, r0, c0, min(t, h-r0), min(t, w-c0))
+
+    # Rows y0:y1, columns x0:x1 of stage output level, clipped to it, from its tiles;
+    # returns the window and its (x, y) origin
+    def window(self, level, y0, y1, x0, x1):
+        h, w = self.shapes[level][:2]
+        y0, y1 = max(0, min(y0, h)), max(0, min(y1, h))
+        x0, x1 = max(0, min(x0, w)), max(0, min(x1, w))
+        if level == 0:
+            return asarray(self.source[y0:y1, x0:x1]), (x0, y0)
+        return self.assemble(level, y0, y1, x0, x1), (x0, y0)
+
+    def assemble(self, level, y0, y1, x0, x1, workers=1):
+        t = self.tile_size
+        out = empty((y1-y0, x1-x0) + self.shapes[level][2:], dtype=self.dtype)
+        if out.size == 0:
+            return out
+        jobs = [(i, j) for i in range(y0//t, (y1-1)//t + 1) for j in range(x0//t, (x1-1)//t + 1)]
+        def place(i, j):
+            v = self.tile(i, j, level)
+            r0, r1 = max(i*t, y0), min((i+1)*t, y1)
+            c0, c1 = max(j*t, x0), min((j+1)*t, x1)
+            out[r0-y0:r1-y0, c0-x0:c1-x0] = v[r0-i*t:r1-i*t, c0-j*t:c1-j*t]
+        if workers == 1 or len(jobs) == 1:
+            for job in jobs:
+                place(*job)
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                for f in [pool.submit(place, *job) for job in jobs]:
+                    f.result()
+        return out
+
+    # Rows y0:y1, columns x0:x1 of the final output, its tiles computed in parallel
+    def read(self, y0, y1, x0=0, x1=None):
+        level = len(self.stages)
+        x1 = self.shapes[level][1] if x1 is None else x1
+        h, w = self.shapes[level][:2]
+        y0, y1, x0, x1 = max(0, y0), min(y1, h), max(0, x0), min(x1, w)
+        return self.assemble(level, y0, y1, x0, x1, self.workers)
+
+    # The output as something that slices like a read only array, for the exporters
+    # (e.g. dzi.export_dzi(pipeline.view(), path))
+    def view(self):
+        return PipelineView(self)
+
+class PipelineView:
+    def __init__(self, pipeline: Pipeline) -> None:
+        self.pipeline = pipeline
+        self.shape = pipeline.shape
+        self.dtype = pipeline.dtype
+        self.ndim = len(self.shape)
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    # Only row and column slices with step 1, e.g. view[r0:r1] or view[r0:r1, c0:c1]
+    def __getitem__(self, index):
+        if not isinstance(index, tuple):
+            index = (index,)
+        rows = index[0] if isinstance(index[0], slice) else slice(index[0], index[0]+1)
+        cols = index[1] if len(index) > 1 else slice(None)
+        h, w = self.shape[:2]
+        y0, y1, ys = rows.indices(h)
+        x0, x1, xs = cols.indices(w)
+        if ys != 1 or xs != 1:
+            raise IndexError('Pipeline views only slice with step 1')
+        out = self.pipeline.read(y0, y1, x0, x1)
+        if not isinstance(index[0], slice):
+            out = out[0]
+        return out
+
+    def __array__(self, dtype=None, copy=None):
+        a = self.pipeline.read(0, self.shape[0])
+        return a if dtype is None else a.astype(dtype)
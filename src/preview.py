@@ -0,0 +1,218 @@
+import threading
+from math import sqrt
+from PySide6 import QtCore, QtGui, QtWidgets
+from numpy import asarray
+
+from warp import OutputGeometry, warp
+from imagepyramid import build_pyramid, level_transform, level_for_size
+from imagefile import array_to_qimage
+
+#
+#  Progressive rectified preview
+#
+# A new T is shown at once from a coarse pyramid level, stretched over the whole
+# output, then refined tile by tile at full resolution on a thread pool. Tiles in
+# the visible viewport are refined first. Every start() begins a new generation;
+# workers stop as soon as the generation they serve is no longer current, and results
+# of old generations are dropped by the receiver.
+#
+
+# Output over the whole photo with about as many pixels as the photo
+def preview_geometry(T, width, height):
+    g = OutputGeometry.from_image(T, width, height, 1.)
+    area = g.width*g.height*g.pixel_size**2
+    if area <= 0.:
+        raise ValueError('Solution maps the photo to an empty area')
+    return OutputGeometry.from_image(T, width, height, sqrt(width*height/area))
+
+class PreviewRenderer(QtCore.QObject):
+    # generation, (H,W[,C]) array covering the whole output at low resolution
+    coarseReady = QtCore.Signal(int, object)
+    # generation, row, column, tile array at full resolution
+    tileReady = QtCore.Signal(int, int, int, object)
+    # generation, all tiles done
+    finished = QtCore.Signal(int)
+
+    def __init__(self, parent: QtCore.QObject | None = None, coarse_size: int = 1024, tile: int = 256) -> None:
+        super().__init__(parent)
+        self.pool = QtCore.QThreadPool(self)
+        self.coarse_size = coarse_size
+        self.tile = tile
+        self.generation = 0
+        self._lock = threading.Lock()
+        # Held while building the pyramid, so it is built once; never taken on the GUI thread
+        self._pyramid_lock = threading.Lock()
+        self._image = None
+        self._pyramid: list | None = None
+        self._queue: list = []
+        self._remaining = 0
+
+    def setImage(self, image) -> None:
+        self.cancel()
+        with self._lock:
+            self._image = image
+            self._pyramid = None
+
+    # Built outside self._lock, which cancel() and start() take on the GUI thread, and
+    # published under it unless setImage() replaced the image meanwhile
+    def pyramid(self) -> list:
+        with self._lock:
+            levels = self._pyramid
+        if levels is not None:
+            return levels
+        with self._pyramid_lock:
+            with self._lock:
+                image, levels = self._image, self._pyramid
+            if levels is None:
+                levels = build_pyramid(image)
+                with self._lock:
+                    if self._image is image:
+                        self._pyramid = levels
+        return levels
+
+    def cancel(self) -> None:
+        with self._lock:
+            self.generation += 1
+            self._queue = []
+
+    # Render image through T onto geometry; focus is the (x0, y0, x1, y1) output pixel
+    # rectangle to refine first, e.g. the visible part of the view
+    def start(self, T, geometry: OutputGeometry, focus=None, method: str = 'bilinear') -> int:
+        gen = self._queue_tiles(list(geometry.tiles(self.tile)), focus, geometry.width, geometry.height)
+        self.pool.start(_CoarseTask(self, gen, asarray(T, dtype=float), geometry, method))
+        return gen
+
+    # Show the output of a pipeline.Pipeline tile by tile, pulled through its cache, so
+    # tiles already computed (e.g. before a later stage changed) show at once; focus as
+    # in start(), there is no coarse image
+    def startPipeline(self, pipeline, focus=None) -> int:
+        h, w = pipeline.shape[:2]
+        t = pipeline.tile_size
+        tiles = [(i*t, j*t, min(t, h-i*t), min(t, w-j*t)) for i, j in pipeline.tiles()]
+        gen = self._queue_tiles(tiles, focus, w, h)
+        render = lambda r0, c0, rows, cols: pipeline.tile(r0//t, c0//t)
+        for i in range(max(1, self.pool.maxThreadCount())):
+            self.pool.start(_TileTask(self, gen, render))
+        return gen
+
+    # New generation refining tiles (r0, c0, rows, cols), those in focus first
+    def _queue_tiles(self, tiles, focus, width, height) -> int:
+        if focus is None:
+            focus = (0, 0, width, height)
+        fx0, fy0, fx1, fy1 = focus
+        cx, cy = (fx0+fx1)/2, (fy0+fy1)/2
+        def order(tile):
+            r0, c0, rows, cols = tile
+            visible = c0 < fx1 and c0+cols > fx0 and r0 < fy1 and r0+rows > fy0
+            return (not visible, (c0+cols/2-cx)**2 + (r0+rows/2-cy)**2)
+        tiles.sort(key=order)
+        with self._lock:
+            self.generation += 1
+            gen = self.generation
+            # Popped from the end
+            self._queue = tiles[::-1]
+            self._remaining = len(tiles)
+        return gen
+
+    def _next(self, gen):
+        with self._lock:
+            if gen != self.generation or not self._queue:
+                return None
+            return self._queue.pop()
+
+    def _done(self, gen) -> None:
+        with self._lock:
+            if gen != self.generation:
+                return
+            self._remaining -= 1
+            last = self._remaining == 0
+        if last:
+            self.finished.emit(gen)
+
+    def _coarse(self, gen, T, geometry, method) -> None:
+        levels = self.pyramid()
+        if gen != self.generation:
+            return
+        l = level_for_size(levels, self.coarse_size)
+        scale = max(geometry.width, geometry.height)/self.coarse_size
+        if l > 0 and scale > 1.:
+            coarse = OutputGeometry(geometry.x0, geometry.y0, geometry.pixel_size*scale,
+                                    max(1, int(geometry.width/scale)), max(1, int(geometry.height/scale)))
+            out = warp(levels[l], level_transform(T, l), coarse, method, workers=1)
+            if gen != self.generation:
+                return
+            self.coarseReady.emit(gen, out)
+        # Refinement, one worker per pool thread pulling tiles off the shared queue
+        g = geometry
+        def render(r0, c0, rows, cols):
+            sub = OutputGeometry(g.x0 + c0*g.pixel_size, g.y0 + r0*g.pixel_size, g.pixel_size, cols, rows)
+            return warp(levels[0], T, sub, method, workers=1)
+        for i in range(max(1, self.pool.maxThreadCount()-1)):
+            self.pool.start(_TileTask(self, gen, render))
+        self._tiles(gen, render)
+
+    # render(r0, c0, rows, cols) returns the tile
+    def _tiles(self, gen, render) -> None:
+        while (tile := self._next(gen)) is not None:
+            r0, c0, rows, cols = tile
+            out = render(r0, c0, rows, cols)
+            if gen != self.generation:
+                return
+            self.tileReady.emit(gen, r0, c0, out)
+            self._done(gen)
+
+    def wait(self, msecs: int = -1) -> bool:
+        return self.pool.waitForDone(msecs)
+
+class _CoarseTask(QtCore.QRunnable):
+    def __init__(self, renderer: PreviewRenderer, gen: int, T, geometry: OutputGeometry, method: str) -> None:
+        super().__init__()
+        self.args = (renderer, gen, T, geometry, method)
+
+    def run(self) -> None:
+        renderer, gen, T, geometry, method = self.args
+        renderer._coarse(gen, T, geometry, method)
+
+class _TileTask(QtCore.QRunnable):
+    def __init__(self, renderer: PreviewRenderer, gen: int, render) -> None:
+        super().__init__()
+        self.args = (renderer, gen, render)
+
+    def run(self) -> None:
+        renderer, gen, render = self.args
+        renderer._tiles(gen, render)
+
+# Display layer for the rectified image, painted from a QImage that the coarse image
+# and the refined tiles are drawn into as they arrive
+class PreviewLayer(QtWidgets.QGraphicsItem):
+    def __init__(self) -> None:
+        super().__init__()
+        self.image = QtGui.QImage()
+        self.setFlag(QtWidgets.QGraphicsItem.GraphicsItemFlag.ItemUsesExtendedStyleOption, True)
+
+    def reset(self, width: int, height: int) -> None:
+        self.prepareGeometryChange()
+        self.image = QtGui.QImage(width, height, QtGui.QImage.Format.Format_RGBA8888)
+        self.image.fill(QtGui.QColor(30, 30, 30))
+        self.update()
+
+    def boundingRect(self) -> QtCore.QRectF:
+        return QtCore.QRectF(0, 0, self.image.width(), self.image.height())
+
+    def paint(self, painter: QtGui.QPainter, option: QtWidgets.QStyleOptionGraphicsItem, widget: QtWidgets.QWidget | None = None) -> None:
+        if not self.image.isNull():
+            rect = option.exposedRect
+            painter.drawImage(rect, self.image, rect)
+
+    def setCoarse(self, coarse) -> None:
+        painter = QtGui.QPainter(self.image)
+        painter.setRenderHint(QtGui.QPainter.RenderHint.SmoothPixmapTransform, True)
+        painter.drawImage(self.boundingRect(), array_to_qimage(coarse))
+        painter.end()
+        self.update()
+
+    def setTile(self, r0: int, c0: int, tile) -> None:
+        painter = QtGui.QPainter(self.image)
+        painter.drawImage(QtCore.QPointF(c0, r0), array_to_qimage(tile))
+        painter.end()
+        self.update(QtCore.QRectF(c0, r0, tile.shape[1], tile.shape[0]))
@@ -0,0 +1,120 @@
+from numpy import asarray, ones, zeros, sqrt, log, ceil, median, count_nonzero, einsum, isfinite, inf
+from numpy.random import default_rng
+
+from solver import BatchSVDSolver, build_matrix, transform_from_solution
+
+#
+#  Robust (outlier tolerant) estimation for point constraints
+#
+# Hypotheses are solved from minimal samples and scored against all constraints,
+# a batch of thousands at a time, using stacked numpy operations.
+#
+# The model has 6 parameters and each point constraint gives 2 equations,
+# so a minimal sample is 3 points (a general 8 parameter homography would need 4).
+#
+
+SAMPLE_SIZE = 3
+
+class RobustEstimator:
+    def __init__(self, method='ransac', threshold=None, confidence=0.99, max_hypotheses=100000,
+                 batch_size=2048, outlier_fraction=0.5, max_scores=2**24, seed=None) -> None:
+        if method not in ('ransac', 'lmeds'):
+            raise ValueError(f'Unknown robust method: {method}')
+        if method == 'ransac' and threshold is None:
+            raise ValueError('RANSAC needs an inlier threshold (world units)')
+        self.method = method
+        self.threshold = threshold
+        self.confidence = confidence
+        self.max_hypotheses = max_hypotheses
+        self.batch_size = batch_size
+        # LMedS breaks down above 50% outliers, this sets how many samples it draws
+        self.outlier_fraction = outlier_fraction
+        # Bound on hypotheses x constraints scored at once, to bound memory
+        self.max_scores = max_scores
+        self.rng = default_rng(seed)
+        self.solver = BatchSVDSolver()
+
+    # Number of samples needed to draw one all-inlier sample with the given confidence
+    def samples_needed(self, inlier_ratio):
+        if inlier_ratio >= 1.:
+            return 1
+        good = inlier_ratio**SAMPLE_SIZE
+        if good <= 0.:
+            return self.max_hypotheses
+        return int(ceil(log(1.-self.confidence)/log(1.-good)))
+
+    # Draw n samples of distinct indices, rejecting samples with repeats
+    def draw_samples(self, n, count):
+        idx = self.rng.integers(0, count, size=(n, SAMPLE_SIZE))
+        distinct = (idx[:,0] != idx[:,1]) & (idx[:,0] != idx[:,2]) & (idx[:,1] != idx[:,2])
+        return idx[distinct]
+
+    # Solve the minimal samples, dropping degenerate ones (e.g. collinear points)
+    def hypotheses(self, cols, idx):
+        A, b = build_matrix(*(c[idx] for c in cols))
+        nrows = ones(len(idx), dtype=int)*2*SAMPLE_SIZE
+        x, r, _ = self.solver.compute_one_solution(A, b, nrows)
+        good = (r == 6) & isfinite(x).all(axis=-1)
+        return x[good]
+
+    # World space distance of every constraint under every hypothesis, shape (H,n)
+    def distances(self, x, image_x, image_y, world_x, world_y):
+        T = transform_from_solution(x)
+        p = zeros((3, len(image_x)))
+        p[0], p[1], p[2] = image_x, image_y, 1.
+        q = einsum('hij,jn->hin', T, p)
+        dx = q[:,0]/q[:,2] - world_x
+        dy = q[:,1]/q[:,2] - world_y
+        d = sqrt(dx*dx + dy*dy)
+        d[~isfinite(d)] = inf
+        return d
+
+    # Lower is better
+    def scores(self, d):
+        if self.method == 'ransac':
+            return -count_nonzero(d < self.threshold, axis=-1)
+        return median(d*d, axis=-1)
+
+    # Inlier threshold for a hypothesis with the given LMedS score (median squared distance)
+    def lmeds_threshold(self, score, n):
+        sigma = 1.4826*(1. + 5./max(n-SAMPLE_SIZE, 1))*sqrt(score)
+        return 2.5*sigma
+
+    # Returns (x, inlier mask) for the best hypothesis, or (None, all False) if
+    # no non-degenerate sample was found
+    def estimate(self, image_x, image_y, world_x, world_y, weight=None):
+        cols = [asarray(c, dtype=float) for c in (image_x, image_y, world_x, world_y)]
+        n = len(cols[0])
+        w = ones(n) if weight is None else asarray(weight, dtype=float)*ones(n)
+        cols.append(w)
+        if n < SAMPLE_SIZE:
+            return None, zeros(n, dtype=bool)
+        batch = max(1, min(self.batch_size, self.max_scores // n))
+        if self.method == 'ransac':
+            needed = self.max_hypotheses
+        else:
+            # Scoring a whole batch costs about the same as a few hypotheses, so use at least one
+            needed = min(self.max_hypotheses, max(batch, self.samples_needed(1.-self.outlier_fraction)))
+        best_x, best_score = None, inf
+        drawn = 0
+        while drawn < needed:
+            idx = self.draw_samples(min(batch, needed-drawn), n)
+            drawn += min(batch, needed-drawn)
+            x = self.hypotheses(cols, idx)
+            if len(x) == 0:
+                continue
+            s = self.scores(self.distances(x, *cols[:4]))
+            i = s.argmin()
+            if s[i] < best_score:
+                best_x, best_score = x[i], s[i]
+                if self.method == 'ransac':
+                    needed = min(needed, self.samples_needed(-best_score/n))
+        if best_x is None:
+            return None, zeros(n, dtype=bool)
+        return best_x, self.inliers(best_x, cols, best_score)
+
+    def inliers(self, x, cols, score):
+        d = self.distances(x[None], *cols[:4])[0]
+        if self.method == 'ransac':
+            return d < self.threshold
+        return d < self.lmeds_threshold(score, len(d))
@@ -0,0 +1,65 @@
+from collections import OrderedDict
+from hashlib import blake2b
+from threading import Lock
+from numpy import ascontiguousarray, column_stack, lexsort, float64
+
+#
+#  Memo cache for solver results
+#
+# Results are keyed on a fingerprint of the constraint values, so a constraint set
+# that comes back (undo/redo, re-opening a project) is not solved again.
+# The fingerprint does not depend on constraint order, since undo re-adds
+# constraints at the end of the store.
+#
+
+# Stable fingerprint of a constraint set, given as equal length columns
+# kind separates different solvers and constraint types
+def fingerprint(kind, *columns):
+    h = blake2b(kind.encode(), digest_size=16)
+    if len(columns) == 0 or len(columns[0]) == 0:
+        h.update(b'empty')
+        return h.hexdigest()
+    rows = column_stack(columns).astype(float64) + 0.  # + 0. turns -0. into 0.
+    # Sort rows, last column is the primary key for lexsort
+    rows = ascontiguousarray(rows[lexsort(rows.T[::-1])])
+    h.update(str(rows.shape).encode())
+    h.update(rows.tobytes())
+    return h.hexdigest()
+
+# Least recently used cache with a size bound, and hit/miss counters
+# Thread safe, the GUI solve service uses it from a worker thread and the GUI thread
+class SolutionCache:
+    def __init__(self, maxsize=128) -> None:
+        self.maxsize = maxsize
+        self.entries: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key):
+        with self._lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value) -> None:
+        with self._lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries), 'maxsize': self.maxsize}
@@ -1,19 +1,263 @@
-from numpy import array, diag, zeros, arctan2, pi, sqrt, finfo, count_nonzero, delete, vstack
-from numpy.linalg import svd, norm
+from numpy import array, asarray, broadcast_to, hstack, diag, zeros, ones, full, hypot, abs as npabs, ones_like, zeros_like, stack, \
+                  maximum, divide, swapaxes, concatenate, flatnonzero, select, where, arange, arctan2, pi, sqrt, finfo, count_nonzero, delete, vstack, eye
+from numpy.linalg import svd, norm, qr
+from scipy.linalg import solve_triangular
 from pynnex import with_emitters, emitter, listener
 
-class PointConstraint:
+from solvecache import SolutionCache, fingerprint
+
+# Struct-of-arrays storage for constraints
+# Each field is a contiguous float64 column, grown by doubling so appends are cheap.
+# Rows are removed by moving the last row into the hole, so removal is O(1) too,
+# and the handle that owned the moved row gets its index updated.
+class ConstraintStore:
+    def __init__(self, fields, capacity=16):
+        self.fields = tuple(fields)
+        self.count = 0
+        self.columns = {f: zeros(capacity) for f in self.fields}
+        self.handles = []
+
+    def __len__(self):
+        return self.count
+
+    def capacity(self):
+        return len(self.columns[self.fields[0]])
+
+    def column(self, name):
+        # View of the active part of a column - no copy
+        return self.columns[name][:self.count]
+
+    def reserve(self, n):
+        if n <= self.capacity():
+            return
+        newcap = max(n, 2*self.capacity())
+        for f in self.fields:
+            col = zeros(newcap)
+            col[:self.count] = self.columns[f][:self.count]
+            self.columns[f] = col
+
+    def append(self, handle, values):
+        self.reserve(self.count+1)
+        i = self.count
+        for f, v in zip(self.fields, values):
+            self.columns[f][i] = v
+        self.handles.append(handle)
+        self.count += 1
+        return i
+
+    def extend(self, handles, columns):
+        # Bulk append, columns is a sequence of equal length arrays in field order
+        n = len(handles)
+        self.reserve(self.count+n)
+        i = self.count
+        for f, col in zip(self.fields, columns):
+            self.columns[f][i:i+n] = col
+        self.handles.extend(handles)
+        self.count += n
+        return i
+
+    def row(self, i):
+        return tuple(float(self.columns[f][i]) for f in self.fields)
+
+    def remove(self, i):
+        last = self.count-1
+        if i != last:
+            for f in self.fields:
+                col = self.columns[f]
+                col[i] = col[last]
+            moved = self.handles[last]
+            moved.index = i
+            self.handles[i] = moved
+        self.handles.pop()
+        self.count -= 1
+
+# Property that reads/writes one field of a constraint through its store
+def column_property(name):
+    def fget(self):
+        if self.store is None:
+            return self._values[name]
+        return float(self.store.columns[name][self.index])
+    def fset(self, value):
+        if self.store is None:
+            self._values[name] = value
+        else:
+            self.store.columns[name][self.index] = value
+    return property(fget, fset)
+
+# A constraint is a handle to a row in a ConstraintStore.
+# Once removed from its store, it keeps a copy of its values, so it can be re-added (undo)
+class StoredConstraint:
+    fields: tuple[str, ...] = ()
+
+    def __init__(self, *values):
+        self.store = None
+        self.index = -1
+        self._values = dict(zip(self.fields, values))
+
+    def values(self):
+        return tuple(getattr(self, f) for f in self.fields)
+
+    def attach(self, store):
+        self.index = store.append(self, self.values())
+        self.store = store
+        self._values = None
+
+    # Point a handle at an existing row, used for bulk appends
+    def bind(self, store, index):
+        self.store = store
+        self.index = index
+        self._values = None
+
+    def detach(self):
+        self._values = dict(zip(self.fields, self.store.row(self.index)))
+        self.store.remove(self.index)
+        self.store = None
+        self.index = -1
+
+# Bulk append of constraints of class cls, given as columns (arrays or scalars) in field order
+# Returns the new handles and the columns as float arrays
+def append_constraints(store, cls, columns):
+    n = len(columns[0])
+    columns = [broadcast_to(asarray(col, dtype=float), (n,)) for col in columns]
+    handles = [cls.__new__(cls) for i in range(0,n)]
+    start = store.extend(handles, columns)
+    for i, c in enumerate(handles):
+        c.bind(store, start+i)
+    return handles, columns
+
+class PointConstraint(StoredConstraint):
+    fields = ('image_x', 'image_y', 'world_x', 'world_y', 'weight')
+    image_x = column_property('image_x')
+    image_y = column_property('image_y')
+    world_x = column_property('world_x')
+    world_y = column_property('world_y')
+    weight  = column_property('weight')
+
     def __init__(self, image_x, image_y, world_x, world_y, weight):
-        self.image_x = image_x
-        self.image_y = image_y
-        self.world_x = world_x
-        self.world_y = world_y
-        self.weight  = weight
+        super().__init__(image_x, image_y, world_x, world_y, weight)
+
+# Build A and b for point constraints, given as arrays
+# Leading dimensions are treated as a batch, so this also works on stacked constraint sets
+def build_matrix(xd, yd, xp, yp, w):
+    one = ones_like(xd)
+    zero = zeros_like(xd)
+    rows = stack((stack(( xd,  yd, one, zero, -xd*xp, -yd*xp), axis=-1),
+                  stack(( yd, -xd, zero, one, -xd*yp, -yd*yp), axis=-1)), axis=-2)
+    A = (w[..., None, None]*rows).reshape(xd.shape[:-1] + (2*xd.shape[-1], 6))
+    b = (w[..., None]*stack((xp-xd, yp-yd), axis=-1)).reshape(xd.shape[:-1] + (2*xd.shape[-1], 1))
+    return A, b
+
+# Incrementally updated least squares factorization
+#
+# Keeps the upper triangular R of the QR factorization of the augmented matrix [A b].
+# For n unknowns R is (n+1)x(n+1), so memory does not grow with the number of rows:
+#   R[:n,:n] is the R factor of A, R[:n,n] is Q'b, and |R[n,n]| is the residual norm |Ax-b|.
+# Rows are added with Givens rotations (rank-1 update) and removed with the
+# LINPACK dchdd algorithm (rank-1 downdate). system() gives a small A,b pair with the
+# same least squares solution, singular values and residual as the full A,b.
+class IncrementalQR:
+    def __init__(self, n=6):
+        self.n = n
+        self.reset()
+
+    def reset(self):
+        self.R = zeros((self.n+1, self.n+1))
+        self.nrows = 0
+        self.downdates = 0
+
+    def system(self):
+        return self.R[:, :self.n], self.R[:, self.n:]
+
+    # Add a block of rows in one step (blocked QR of the stacked system)
+    def add_rows(self, A, b):
+        if len(A) == 0:
+            return
+        M = vstack((self.R, hstack((A, b))))
+        self.R = qr(M, mode='r')[:self.n+1]
+        self.nrows += len(A)
+
+    # Rank-1 update: add the row [a beta]
+    def update(self, a, beta):
+        R = self.R
+        x = hstack((a, beta))
+        for i in range(0, self.n+1):
+            rho = hypot(R[i,i], x[i])
+            if rho == 0.:
+                continue
+            c, s = R[i,i]/rho, x[i]/rho
+            Ri = R[i,i:].copy()
+            R[i,i:] = c*Ri + s*x[i:]
+            x[i:] = c*x[i:] - s*Ri
+        self.nrows += 1
+
+    # Rank-1 downdate: remove the row [a beta], which must have been added before
+    # Returns False if the downdate is numerically unsafe, R is then unchanged
+    # and the caller should refactor from scratch.
+    def downdate(self, a, beta):
+        R = self.R
+        x = hstack((a, beta))
+        d = npabs(diag(R))
+        if d.min() <= d.max() * len(d) * finfo(R.dtype).eps:
+            return False
+        p = solve_triangular(R, x, trans='T')
+        q2 = 1. - p@p
+        if q2 <= finfo(R.dtype).eps:
+            return False
+        # Generate the rotations
+        n1 = self.n+1
+        c = zeros(n1)
+        s = zeros(n1)
+        alpha = sqrt(q2)
+        for i in range(n1-1, -1, -1):
+            scale = alpha + abs(p[i])
+            a1, b1 = alpha/scale, p[i]/scale
+            nrm = sqrt(a1*a1 + b1*b1)
+            c[i], s[i] = a1/nrm, b1/nrm
+            alpha = scale*nrm
+        # Apply them to R, column by column
+        for j in range(0, n1):
+            xx = 0.
+            for i in range(j, -1, -1):
+                t = c[i]*xx + s[i]*R[i,j]
+                R[i,j] = c[i]*R[i,j] - s[i]*xx
+                xx = t
+        self.nrows -= 1
+        self.downdates += 1
+        return True
+
+# Transformation matrix from solution vector(s) x, shape (...,6) -> (...,3,3)
+def transform_from_solution(x):
+    T = zeros(x.shape[:-1] + (3,3))
+    T[...,0,0] = x[...,0]+1.
+    T[...,0,1] = x[...,1]
+    T[...,0,2] = x[...,2]
+    T[...,1,0] = -x[...,1]
+    T[...,1,1] = x[...,0]+1.
+    T[...,1,2] = x[...,3]
+    T[...,2,0] = x[...,4]
+    T[...,2,1] = x[...,5]
+    T[...,2,2] = 1.
+    return T
 
 @with_emitters
 class SVDSolver:
+    # Refactor from the store after this many downdates, to bound error growth
+    REFACTOR_DOWNDATES = 1000
+
+    # Results of ComputeSolution(), shared by all solvers, keyed on the constraint values
+    cache = SolutionCache(maxsize=64)
+
     def __init__(self) -> None:
-        self.constraints = []
+        self.store = ConstraintStore(PointConstraint.fields)
+        # IncrementalQR when in incremental mode, else None
+        self.factor = None
+        # IncrementalQR accumulating streamed constraints, see IngestConstraints()
+        self.stream = IncrementalQR(6)
+
+    # Constraint handles, in store order
+    @property
+    def constraints(self):
+        return self.store.handles
 
     @emitter
     def emitcreateconstraint(self):
@@ -23,27 +267,93 @@ class SVDSolver:
     def emitdestroyconstraint(self):
         pass
 
+    # Incremental mode keeps a factorization of A up to date as constraints
+    # are created, destroyed or moved, so ComputeSolution() does not rebuild A.
+    # The solution matches the full rebuild to rounding error, about 1e-9 relative
+    # in T for well conditioned constraint sets.
+    # Note: in incremental mode, change constraints with MoveConstraint(), not by
+    # assigning to their attributes, or the factorization will be out of date.
+    def SetIncremental(self, enable=True):
+        if enable:
+            self.factor = IncrementalQR(6)
+            self.refactor()
+        else:
+            self.factor = None
+
+    def refactor(self):
+        self.factor.reset()
+        self.factor.add_rows(*self.BuildMatrix())
+
+    def constraint_rows(self, c):
+        A,b = build_matrix(*(array([v]) for v in c.values()))
+        return A,b
+
+    def factor_add(self, c):
+        A,b = self.constraint_rows(c)
+        for i in range(0,len(A)):
+            self.factor.update(A[i], b[i])
+
+    def factor_remove(self, c):
+        # Must be called while c is still in the store
+        A,b = self.constraint_rows(c)
+        for i in range(0,len(A)):
+            if not self.factor.downdate(A[i], b[i]):
+                return False
+        return self.factor.downdates < self.REFACTOR_DOWNDATES
+
     def CreateConstraint(self, image_x, image_y, world_x, world_y, weight=1.0, emit=True):
         c = PointConstraint(image_x, image_y, world_x, world_y, weight)
-        self.constraints.append(c)
+        c.attach(self.store)
+        if self.factor is not None:
+            self.factor_add(c)
         if emit:
             self.emitcreateconstraint.emit(c)
         return c
+
+    # Bulk version of CreateConstraint, for auto-generated constraints
+    def CreateConstraints(self, image_x, image_y, world_x, world_y, weight=1.0, emit=False):
+        handles, columns = append_constraints(self.store, PointConstraint, (image_x, image_y, world_x, world_y, weight))
+        if self.factor is not None:
+            self.factor.add_rows(*build_matrix(*columns))
+        if emit:
+            for c in handles:
+                self.emitcreateconstraint.emit(c)
+        return handles
     
     def DestroyConstraint(self, c, emit=True):
         if emit:
             self.emitdestroyconstraint.emit(c)
-        self.constraints.remove(c)
+        if self.factor is not None:
+            ok = self.factor_remove(c)
+            c.detach()
+            if not ok:
+                self.refactor()
+        else:
+            c.detach()
+
+    # Change some values of a constraint, e.g. while its marker is dragged
+    def MoveConstraint(self, c, image_x=None, image_y=None, world_x=None, world_y=None, weight=None):
+        ok = self.factor_remove(c) if self.factor is not None else True
+        for name, value in zip(PointConstraint.fields, (image_x, image_y, world_x, world_y, weight)):
+            if value is not None:
+                setattr(c, name, value)
+        if self.factor is not None:
+            if ok:
+                self.factor_add(c)
+            else:
+                self.refactor()
 
     # Calculate Rank from Singular Value - code stolen from matrix_rank()
     # Used to avoid calling svd() twice
-    def rank_from_S(self, S, A):
-        tol = S.max(axis=-1, keepdims=True) * max(A.shape[-2:]) * finfo(S.dtype).eps
+    # nrows overrides the row count of A, for when A is a compressed (triangular) system
+    def rank_from_S(self, S, A, nrows=None):
+        rows = A.shape[-2] if nrows is None else nrows
+        tol = S.max(axis=-1, keepdims=True) * max(rows, A.shape[-1]) * finfo(S.dtype).eps
         return count_nonzero(S > tol, axis=-1)
 
-    def compute_one_solution(self, A, b):
+    def compute_one_solution(self, A, b, nrows=None):
         U, S, Vh = svd(A, full_matrices=False)
-        r = self.rank_from_S(S, A)
+        r = self.rank_from_S(S, A, nrows)
         #print(U.shape)
         #print(S.shape)
         #print(Vh.shape)
@@ -56,60 +366,151 @@ class SVDSolver:
         x = Vh.transpose()@Dinv@U.transpose()@b
         return x, r
 
-    def try_no_y_skew(self, A, b):
+    def try_no_y_skew(self, A, b, nrows=None):
         Anew = delete(A,5,1)
-        xnew,rnew = self.compute_one_solution(Anew, b)
+        xnew,rnew = self.compute_one_solution(Anew, b, nrows)
         err = norm(Anew@xnew-b)
         xnew = vstack((xnew,array([[0.]])))
         return xnew,rnew,err
 
-    def try_no_x_skew(self, A, b):
+    def try_no_x_skew(self, A, b, nrows=None):
         Anew = delete(A,4,1)
-        xnew,rnew = self.compute_one_solution(Anew, b)
+        xnew,rnew = self.compute_one_solution(Anew, b, nrows)
         err = norm(Anew@xnew-b)
         xnew = vstack((xnew[0:4],array([[0.]]),xnew[4]))
         return xnew,rnew,err
 
-    def try_no_skew(self, A, b):
+    def try_no_skew(self, A, b, nrows=None):
         Anew = delete(A,range(4,6),1)
-        xnew,rnew = self.compute_one_solution(Anew, b)
+        xnew,rnew = self.compute_one_solution(Anew, b, nrows)
         err = norm(Anew@xnew-b)
         xnew = vstack((xnew[0:4],array([[0.]]),array([[0.]])))
         return xnew,rnew,err
 
-    def compute_solution(self, A, b):
+    # Compress A,b to an equivalent (at most) 7 row system with one QR factorization of [A b].
+    # Every candidate model is a column subset of A, so it can be solved on the compressed
+    # system with the same solution and residual, without touching the 2m rows again.
+    # The result is upper triangular, see reduced_residual().
+    def compress(self, A, b):
+        R = qr(hstack((A, b)), mode='r')
+        return R[:, :A.shape[1]], R[:, A.shape[1]:]
+
+    # Triangular system of the model keeping only columns keep of A, from the triangular
+    # compressed R of [A b]: the dropped columns are deleted and the Hessenberg part left
+    # behind is rotated back to triangular (one Givens rotation per column after the
+    # first dropped one). The last column is the model's b.
+    def reduced_system(self, R, keep):
+        S = R[:, list(keep) + [R.shape[1]-1]].copy()
+        k = len(keep)
+        first = next((i for i, j in enumerate(keep) if j != i), k)
+        for i in range(first, min(k, len(S)-1)):
+            rho = hypot(S[i,i], S[i+1,i])
+            if rho == 0.:
+                continue
+            c, s = S[i,i]/rho, S[i+1,i]/rho
+            Si = S[i].copy()
+            S[i] = c*Si + s*S[i+1]
+            S[i+1] = c*S[i+1] - s*Si
+        return S
+
+    # Residual norm of a reduced_system(): the part of b below the model's rows.
+    # Exact when the kept columns have full rank, a lower bound otherwise.
+    def reduced_residual(self, S):
+        k = S.shape[1]-1
+        return norm(S[k:, k])
+
+    # Least squares solution of a reduced_system() by back substitution, or None unless
+    # it certainly has full rank by the tolerance of rank_from_S(): its smallest singular
+    # value is at least 1/|R^-1| and its largest at most |R| (Frobenius norms)
+    def reduced_solution(self, S, nrows):
+        k = S.shape[1]-1
+        if len(S) < k:
+            return None
+        R = S[:k, :k]
+        d = npabs(diag(R))
+        if d.min() == 0.:
+            return None
+        Rinv = solve_triangular(R, eye(k))
+        if 1./norm(Rinv) <= norm(R) * max(nrows, k) * finfo(R.dtype).eps:
+            return None
+        return Rinv @ S[:k, k:]
+
+    # Reduced models, as (try_ method, kept columns of A)
+    # 'no_skew' has no perspective terms left, i.e. it is the similarity-only model
+    MODELS = {
+        'no_x_skew': ('try_no_x_skew', [0,1,2,3,5]),
+        'no_y_skew': ('try_no_y_skew', [0,1,2,3,4]),
+        'no_skew':   ('try_no_skew',   [0,1,2,3]),
+    }
+
+    # Residual of every reduced model from the compressed A,b, {name: (None, None, residual norm)};
+    # a model is only solved (by model()) once its residual is small enough to pick it
+    def evaluate_models(self, A, b, nrows=None):
+        R = hstack((A, b))
+        return {name: (None, None, self.reduced_residual(self.reduced_system(R, keep)))
+                for name, (_, keep) in self.MODELS.items()}
+
+    # Candidate name as (x, rank, residual norm), solved when its residual is under tol:
+    # by back substitution on the same compressed R when the model has full rank, else
+    # (rank deficient models need the minimum norm solution) by its try_ method on the
+    # compressed A,b. The solved residual replaces the estimate.
+    def model(self, name, A, b, nrows, tol):
+        x, r, err = self.candidates[name]
+        if x is None and err < tol:
+            method, keep = self.MODELS[name]
+            xk = self.reduced_solution(self.reduced_system(hstack((A, b)), keep), nrows)
+            if xk is None:
+                x, r, err = getattr(self, method)(A, b, nrows)
+            else:
+                x = zeros((A.shape[1], 1))
+                x[keep] = xk
+                r = len(keep)
+            self.candidates[name] = (x, r, err)
+        return x, r, err
+
+    # Candidates from the last compute_solution(), kept so the choice can be inspected
+    # (only the full model when it had full rank)
+    def ModelResiduals(self):
+        return {name: float(err) for name, (x, r, err) in self.candidates.items()}
+
+    def compute_solution(self, A, b, nrows=None):
         TOL = 1.e-8
-        x,r = self.compute_one_solution(A, b)
+        if nrows is None:
+            nrows = len(A)
+        A, b = self.compress(A, b)
+        x,r = self.compute_one_solution(A, b, nrows)
+        self.candidates = {'full': (x, r, norm(A@x-b))}
         if r == 6:
             return x,r,2
+        self.candidates.update(self.evaluate_models(A, b, nrows))
         # insert logic here - don't skew if you don't need to
         if abs(x[5]) < TOL:
             if abs(x[4]) < TOL:  # already no skew
                 return x,r,0
             else:  # only x skew, try to remove it
-                xnew,rnew,err = self.try_no_x_skew(A, b)
+                xnew,rnew,err = self.model('no_x_skew', A, b, nrows, TOL)
                 if err < TOL:
                     return xnew,rnew,1
                 else:
                     return x,r,0
         elif abs(x[4]) < TOL: # only y skew, try to remove it
-            xnew,rnew,err = self.try_no_y_skew(A, b)
+            xnew,rnew,err = self.model('no_y_skew', A, b, nrows, TOL)
             if err < TOL:
                 return xnew,rnew,1
             else:
                 return x,r,0
         else: # skew in y and x, try to remove in order
-            xnew,rnew,err = self.try_no_y_skew(A, b)
+            xnew,rnew,err = self.model('no_y_skew', A, b, nrows, TOL)
             if err < TOL: # removed y skew
                 x = xnew.copy()
-                r = rnew.copy()
-                xnew,rnew,err = self.try_no_skew(A, b)
+                r = rnew
+                xnew,rnew,err = self.model('no_skew', A, b, nrows, TOL)
                 if err < TOL: # removed all skew
                     return xnew,rnew,1
                 else:
                     return x,r,1
             else:
-                xnew,rnew,err = self.try_no_x_skew(A, b)
+                xnew,rnew,err = self.model('no_x_skew', A, b, nrows, TOL)
                 if err < TOL: # removed x skew
                     return xnew,rnew,1
                 else:
@@ -117,22 +518,103 @@ class SVDSolver:
             
     def BuildMatrix(self):
         # Build A and b
-        m = len(self.constraints)*2
-        A = zeros((m,6))
-        b = zeros((m,1))
-        for i in range(0,len(self.constraints)):
-            c = self.constraints[i]
-            xp, yp = c.world_x, c.world_y
-            xd, yd = c.image_x, c.image_y
-            A[2*i,  :] = c.weight*array([ xd, yd, 1., 0., -xd*xp, -yd*xp])
-            b[2*i,  0] = c.weight*array([xp-xd])
-            A[2*i+1,:] = c.weight*array([yd, -xd, 0., 1., -xd*yp, -yd*yp])
-            b[2*i+1,0] = c.weight*array([yp-yd])
-        return A,b
+        s = self.store
+        return build_matrix(s.column('image_x'), s.column('image_y'),
+                            s.column('world_x'), s.column('world_y'), s.column('weight'))
 
     def ComputeSolution(self):
-        A,b = self.BuildMatrix()
-        x,r,t = self.compute_solution(A, b)
+        # In incremental mode the solve is cheaper than the fingerprint, and drag steps
+        # would only fill the cache with one-off entries, so it is not used
+        if self.factor is not None:
+            A,b = self.factor.system()
+            x,r,t = self.compute_solution(A, b, 2*len(self.store))
+            return self.report_solution(x, r, t)
+        key = fingerprint('svd', *(self.store.column(f) for f in PointConstraint.fields))
+        cached = self.cache.get(key)
+        # The model candidates too, so ModelResiduals() describes this solution; entries
+        # from solveservice do not have them and are solved again
+        if cached is not None and cached[3] is not None:
+            x,r,t,candidates = cached
+            self.candidates = dict(candidates)
+        else:
+            A,b = self.BuildMatrix()
+            x,r,t = self.compute_solution(A, b)
+            self.cache.put(key, (x.copy(), r, t, dict(self.candidates)))
+        return self.report_solution(x, r, t)
+
+    # Streaming ingest, for constraint sets too large to hold as A (or even in the store)
+    # chunks is an iterable of (k,4|5) arrays, or of (image_x, image_y, world_x, world_y[, weight])
+    # tuples of arrays, e.g. from the readers in constraintio. Each chunk is folded into a
+    # 7x7 triangular factor, so memory is bounded by the chunk size, not the total.
+    # Chunks accumulate until ResetStream(); the store is not touched.
+    def IngestConstraints(self, chunks):
+        for chunk in chunks:
+            if isinstance(chunk, tuple):
+                cols = [asarray(c, dtype=float) for c in chunk]
+            else:
+                chunk = asarray(chunk, dtype=float)
+                cols = [chunk[:,i] for i in range(0, chunk.shape[1])]
+            if len(cols) == 4:
+                cols.append(ones_like(cols[0]))
+            self.stream.add_rows(*build_matrix(*cols))
+        return self.stream.nrows // 2
+
+    def ResetStream(self):
+        self.stream.reset()
+
+    # Solution of the streamed constraints. Rank deficiency is detected from the
+    # singular values of the factor, with the same tolerance as for the full matrix.
+    def ComputeStreamSolution(self):
+        A,b = self.stream.system()
+        x,r,t = self.compute_solution(A, b, self.stream.nrows)
+        return self.report_solution(x, r, t)
+
+    # Robust solution, tolerant of misplaced markers
+    # method is 'ransac' (needs threshold, in world units) or 'lmeds'.
+    # The best hypothesis selects the inliers, which are then refit with compute_solution().
+    # The inlier mask, in store order, is left in self.inliers.
+    def ComputeRobustSolution(self, method='ransac', threshold=None, **kwargs):
+        from robust import RobustEstimator  # robust imports this module
+        s = self.store
+        cols = [s.column(f) for f in PointConstraint.fields]
+        estimator = RobustEstimator(method, threshold, **kwargs)
+        x, inliers = estimator.estimate(*cols)
+        if x is None or count_nonzero(inliers) < 3:
+            # Nothing better to go on, use everything
+            inliers = ones(len(s), dtype=bool)
+        for i in range(0,2):
+            x,r,t = self.compute_solution(*build_matrix(*(c[inliers] for c in cols)))
+            # Re-select inliers with the refit model, refit once more if they changed
+            score = estimator.scores(estimator.distances(x[None,:,0], *cols[:4]))[0]
+            refit = estimator.inliers(x[:,0], cols, score)
+            if count_nonzero(refit) < 3 or (refit == inliers).all():
+                break
+            inliers = refit
+        self.inliers = inliers
+        print(f'inliers={count_nonzero(inliers)}/{len(inliers)}')
+        return self.report_solution(x, r, t)
+
+    # Bootstrap (or jackknife) uncertainty of the solution, see uncertainty.bootstrap_uncertainty()
+    # Returns an UncertaintyResult with the parameter covariance and the world position
+    # error at the given image points (or on a grid over the constraints)
+    def ComputeUncertainty(self, nsamples=1000, method='bootstrap', points=None, **kwargs):
+        from uncertainty import bootstrap_uncertainty  # uncertainty imports this module
+        s = self.store
+        return bootstrap_uncertainty(*(s.column(f) for f in PointConstraint.fields),
+                                     nsamples=nsamples, method=method, points=points, **kwargs)
+
+    # Perspective plus lens distortion, see lens.fit_distortion()
+    # width and height are the photo size in pixels; the fitted CameraProfile is left in
+    # self.profile, to be saved with lens.save_profile()
+    def ComputeDistortionSolution(self, width, height, name='camera', terms=('k1', 'k2', 'p1', 'p2')):
+        from lens import fit_distortion  # lens imports this module
+        s = self.store
+        x, self.profile, res = fit_distortion(*(s.column(f) for f in PointConstraint.fields),
+                                              width, height, name, terms)
+        print('distortion: ' + ', '.join(f'{k}={getattr(self.profile, k):.6g}' for k in terms))
+        return self.report_solution(x[:,None], 6, 2)
+
+    def report_solution(self, x, r, t):
         print(f'r={r}')
 
         if t == 2:
@@ -144,15 +626,96 @@ class SVDSolver:
         #print(f'x=\n{x}')
 
         # Compute transformation matrix, for printing
-        T = zeros((3,3))
-        T[0,0] = x[0]+1.
-        T[0,1] = x[1]
-        T[0,2] = x[2]
-        T[1,0] = -x[1]
-        T[1,1] = x[0]+1.
-        T[1,2] = x[3]
-        T[2,0] = x[4]
-        T[2,1] = x[5]
-        T[2,2] = 1.
+        T = transform_from_solution(x[:,0])
         print(f'T=\n{T}')
-        return T
\ No newline at end of file
+        return T
+
+# Solves many independent constraint sets at once, each in the same way as
+# SVDSolver.compute_solution(), but with stacked svd() calls instead of a Python loop.
+# Constraint sets are stacked as (N,M) arrays, padded to a common M; mask marks
+# the real constraints. Use stack_constraint_sets() to build them from ragged sets.
+class BatchSVDSolver:
+    TOL = 1.e-8
+
+    # Same tolerance as SVDSolver.rank_from_S, per item
+    def rank_from_S(self, S, nrows):
+        tol = S.max(axis=-1, keepdims=True) * maximum(nrows, S.shape[-1])[:, None] * finfo(S.dtype).eps
+        return count_nonzero(S > tol, axis=-1), tol
+
+    # Stacked minimum norm least squares solution and residual norm
+    def compute_one_solution(self, A, b, nrows):
+        U, S, Vh = svd(A, full_matrices=False)
+        r, tol = self.rank_from_S(S, nrows)
+        Sinv = divide(1., S, out=zeros_like(S), where=S > tol)
+        x = swapaxes(Vh, -1, -2) @ (Sinv[..., None] * (swapaxes(U, -1, -2) @ b))
+        err = norm((A @ x - b)[..., 0], axis=-1)
+        return x[..., 0], r, err
+
+    # Solve with some columns removed, returning full length x with zeros put back
+    def compute_reduced_solution(self, A, b, nrows, keep):
+        xk, r, err = self.compute_one_solution(A[..., keep], b, nrows)
+        x = zeros(xk.shape[:-1] + (6,))
+        x[..., keep] = xk
+        return x, r, err
+
+    def compute_solution(self, A, b, nrows):
+        TOL = self.TOL
+        # One stacked QR, all models are then solved on the small compressed systems
+        if A.shape[-2] > 7:
+            R = qr(concatenate((A, b), axis=-1), mode='r')
+            A, b = R[..., :6], R[..., 6:]
+        x, r, _ = self.compute_one_solution(A, b, nrows)
+        t = full(len(x), 2)
+        # Reduced models, only needed for rank deficient items
+        deficient = flatnonzero(r < 6)
+        if len(deficient) == 0:
+            return x, r, t
+        Ad, bd, nd = A[deficient], b[deficient], nrows[deficient]
+        xd, rd = x[deficient], r[deficient]
+        xny, rny, eny = self.compute_reduced_solution(Ad, bd, nd, [0,1,2,3,4])
+        xnx, rnx, enx = self.compute_reduced_solution(Ad, bd, nd, [0,1,2,3,5])
+        xns, rns, ens = self.compute_reduced_solution(Ad, bd, nd, [0,1,2,3])
+        # Same decision tree as SVDSolver.compute_solution()
+        nox = abs(xd[:,4]) < TOL
+        noy = abs(xd[:,5]) < TOL
+        use_nx = (noy & ~nox & (enx < TOL)) | (~noy & ~nox & (eny >= TOL) & (enx < TOL))
+        use_ny = (~noy & nox & (eny < TOL)) | (~noy & ~nox & (eny < TOL) & (ens >= TOL))
+        use_ns = ~noy & ~nox & (eny < TOL) & (ens < TOL)
+        choice = select([use_ns, use_ny, use_nx], [3, 2, 1], 0)
+        xs = stack((xd, xnx, xny, xns))
+        rs = stack((rd, rnx, rny, rns))
+        idx = arange(len(deficient))
+        x[deficient] = xs[choice, idx]
+        r[deficient] = rs[choice, idx]
+        t[deficient] = where(noy & nox, 0, where(noy | nox, (choice != 0).astype(int), 1))
+        return x, r, t
+
+    # image_x ... weight are (N,M) arrays, mask is an optional (N,M) boolean array
+    # Returns T (N,3,3), rank (N,) and solution type (N,), with the same codes as
+    # SVDSolver.compute_solution(): 2 = least squares, 1 = preferred, 0 = minimum norm
+    def ComputeSolutions(self, image_x, image_y, world_x, world_y, weight=None, mask=None):
+        image_x, image_y, world_x, world_y = (asarray(a, dtype=float) for a in (image_x, image_y, world_x, world_y))
+        if mask is None:
+            mask = ones(image_x.shape, dtype=bool)
+        w = ones_like(image_x) if weight is None else broadcast_to(asarray(weight, dtype=float), image_x.shape)
+        # Padding may hold anything, including nan, so zero it out before building A
+        cols = [where(mask, a, 0.) for a in (image_x, image_y, world_x, world_y, w)]
+        A, b = build_matrix(*cols)
+        nrows = 2*count_nonzero(mask, axis=-1)
+        x, r, t = self.compute_solution(A, b, nrows)
+        return transform_from_solution(x), r, t
+
+# Pad ragged constraint sets into (N,M) arrays plus mask, for BatchSVDSolver
+# Each set is an (m,4) or (m,5) array of image_x, image_y, world_x, world_y[, weight]
+def stack_constraint_sets(sets):
+    M = max((len(c) for c in sets), default=0)
+    cols = zeros((5, len(sets), M))
+    cols[4] = 1.
+    mask = zeros((len(sets), M), dtype=bool)
+    for i, c in enumerate(sets):
+        if len(c) == 0:
+            continue
+        c = asarray(c, dtype=float)
+        cols[:c.shape[1], i, :len(c)] = c.T
+        mask[i, :len(c)] = True
+    return cols[0], cols[1], cols[2], cols[3], cols[4], mask
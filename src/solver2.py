@@ -1,31 +1,92 @@
-from numpy import array, diag, zeros, arctan2, pi, sqrt, finfo, count_nonzero, delete, vstack
+from numpy import array, diag, zeros, zeros_like, column_stack, concatenate, arctan2, pi, sqrt, finfo, count_nonzero, delete, vstack
 from numpy.linalg import svd, norm
 from scipy.optimize import least_squares
 from pynnex import with_emitters, emitter, listener
 
-class DeltaXConstraint:
+from solver import ConstraintStore, StoredConstraint, column_property, append_constraints
+from solvecache import SolutionCache, fingerprint
+
+class DeltaXConstraint(StoredConstraint):
+    fields = ('image_x1', 'image_y1', 'image_x2', 'image_y2', 'world_dx', 'weight')
+    image_x1 = column_property('image_x1')
+    image_y1 = column_property('image_y1')
+    image_x2 = column_property('image_x2')
+    image_y2 = column_property('image_y2')
+    world_dx = column_property('world_dx')
+    weight   = column_property('weight')
+
     def __init__(self, image_x1, image_y1, image_x2, image_y2, world_dx, weight):
-        self.image_x1 = image_x1
-        self.image_y1 = image_y1
-        self.image_x2 = image_x2
-        self.image_y2 = image_y2
-        self.world_dx = world_dx
-        self.weight  = weight
-
-class DeltaYConstraint:
+        super().__init__(image_x1, image_y1, image_x2, image_y2, world_dx, weight)
+
+class DeltaYConstraint(StoredConstraint):
+    fields = ('image_x1', 'image_y1', 'image_x2', 'image_y2', 'world_dy', 'weight')
+    image_x1 = column_property('image_x1')
+    image_y1 = column_property('image_y1')
+    image_x2 = column_property('image_x2')
+    image_y2 = column_property('image_y2')
+    world_dy = column_property('world_dy')
+    weight   = column_property('weight')
+
     def __init__(self, image_x1, image_y1, image_x2, image_y2, world_dy, weight):
-        self.image_x1 = image_x1
-        self.image_y1 = image_y1
-        self.image_x2 = image_x2
-        self.image_y2 = image_y2
-        self.world_dy = world_dy
-        self.weight  = weight
+        super().__init__(image_x1, image_y1, image_x2, image_y2, world_dy, weight)
+
+# The model, vectorized over arrays of image points
+# Note: here x[0] is the scale itself, not scale-1 as in SVDSolver
+def model_fx(image_x, image_y, x):
+    return ( x[0]*image_x + x[1]*image_y + x[2] )/( 1 + x[4]*image_x + x[5]*image_y)
+
+def model_fy(image_x, image_y, x):
+    return (-x[1]*image_x + x[0]*image_y + x[3] )/( 1 + x[4]*image_x + x[5]*image_y)
+
+# Analytic derivatives of model_fx and model_fy with respect to x, shape (k,6)
+def jacobian_fx(image_x, image_y, x):
+    D = 1 + x[4]*image_x + x[5]*image_y
+    N = x[0]*image_x + x[1]*image_y + x[2]
+    zero = zeros_like(D)
+    return column_stack((image_x/D, image_y/D, 1/D, zero, -N*image_x/D**2, -N*image_y/D**2))
+
+def jacobian_fy(image_x, image_y, x):
+    D = 1 + x[4]*image_x + x[5]*image_y
+    N = -x[1]*image_x + x[0]*image_y + x[3]
+    zero = zeros_like(D)
+    return column_stack((image_y/D, -image_x/D, zero, 1/D, -N*image_x/D**2, -N*image_y/D**2))
+
+# Residuals of delta constraints, dx and dy are the column tuples of the two stores
+# (image_x1, image_y1, image_x2, image_y2, world_d[, weight])
+def delta_residuals(x, dx, dy):
+    rx = model_fx(dx[0], dx[1], x) - model_fx(dx[2], dx[3], x) - dx[4]
+    ry = model_fy(dy[0], dy[1], x) - model_fy(dy[2], dy[3], x) - dy[4]
+    return concatenate((rx, ry))
+
+def delta_jacobian(x, dx, dy):
+    Jx = jacobian_fx(dx[0], dx[1], x) - jacobian_fx(dx[2], dx[3], x)
+    Jy = jacobian_fy(dy[0], dy[1], x) - jacobian_fy(dy[2], dy[3], x)
+    return vstack((Jx, Jy))
 
 @with_emitters
 class NLLSSolver:
+    # Results of ComputeSolution(), shared by all solvers, keyed on the constraint values
+    cache = SolutionCache(maxsize=64)
+
     def __init__(self):
-        self.dxconstraints = []
-        self.dyconstraints = []
+        self.dxstore = ConstraintStore(DeltaXConstraint.fields)
+        self.dystore = ConstraintStore(DeltaYConstraint.fields)
+
+    # Constraint handles, in store order
+    @property
+    def dxconstraints(self):
+        return self.dxstore.handles
+
+    @property
+    def dyconstraints(self):
+        return self.dystore.handles
+
+    # Constraint values as column arrays (views into the stores)
+    def dxcolumns(self):
+        return tuple(self.dxstore.column(f) for f in DeltaXConstraint.fields)
+
+    def dycolumns(self):
+        return tuple(self.dystore.column(f) for f in DeltaYConstraint.fields)
 
     @emitter
     def emitcreateconstraint(self):
@@ -37,27 +98,38 @@ class NLLSSolver:
 
     def CreateDXConstraint(self, image_x1, image_y1, image_x2, image_y2, world_dx, weight=1.0, emit=True):
         c = DeltaXConstraint(image_x1, image_y1, image_x2, image_y2, world_dx, weight)
-        self.dxconstraints.append(c)
+        c.attach(self.dxstore)
         if emit:
             self.emitcreateconstraint.emit(c)
         return c
     
     def CreateDYConstraint(self, image_x1, image_y1, image_x2, image_y2, world_dy, weight=1.0, emit=True):
         c = DeltaYConstraint(image_x1, image_y1, image_x2, image_y2, world_dy, weight)
-        self.dyconstraints.append(c)
+        c.attach(self.dystore)
         if emit:
             self.emitcreateconstraint.emit(c)
         return c
 
+    # Bulk versions of CreateDXConstraint and CreateDYConstraint
+    def CreateDXConstraints(self, image_x1, image_y1, image_x2, image_y2, world_dx, weight=1.0, emit=False):
+        handles, columns = append_constraints(self.dxstore, DeltaXConstraint, (image_x1, image_y1, image_x2, image_y2, world_dx, weight))
+        if emit:
+            for c in handles:
+                self.emitcreateconstraint.emit(c)
+        return handles
+
+    def CreateDYConstraints(self, image_x1, image_y1, image_x2, image_y2, world_dy, weight=1.0, emit=False):
+        handles, columns = append_constraints(self.dystore, DeltaYConstraint, (image_x1, image_y1, image_x2, image_y2, world_dy, weight))
+        if emit:
+            for c in handles:
+                self.emitcreateconstraint.emit(c)
+        return handles
+
     def DestroyConstraint(self, c, emit=True):
-        if c in self.dxconstraints:
+        if c.store is self.dxstore or c.store is self.dystore:
             if emit:
                 self.emitdestroyconstraint.emit(c)
-            self.dxconstraints.remove(c)
-        elif c in self.dyconstraints:
-            if emit:
-                self.emitdestroyconstraint.emit(c)
-            self.dyconstraints.remove(c)
+            c.detach()
 
     '''
     # Calculate Rank from Singular Value - code stolen from matrix_rank()
@@ -141,33 +213,54 @@ class NLLSSolver:
                     return x,r,1
     '''
 
+    def fingerprint(self):
+        dx, dy = self.dxcolumns(), self.dycolumns()
+        kind = zeros(len(dx[0])+len(dy[0]))
+        kind[len(dx[0]):] = 1.
+        return fingerprint('nlls', *(concatenate((a, b)) for a, b in zip(dx, dy)), kind)
+
     def FunctionFx(self, image_x, image_y, x):
-        return ( x[0]*image_x + x[1]*image_y + x[2] )/( 1 + x[4]*image_x + x[5]*image_y)
+        return model_fx(image_x, image_y, x)
 
     def FunctionFy(self, image_x, image_y, x):
-        return (-x[1]*image_x + x[0]*image_y + x[3] )/( 1 + x[4]*image_x + x[5]*image_y)
+        return model_fy(image_x, image_y, x)
     
     def FunctionG(self, x):
-        r = zeros((self.m,))
-        i = 0
-        for dxc in self.dxconstraints:
-            r[i] = self.FunctionFx(dxc.image_x1, dxc.image_y1, x) - self.FunctionFx(dxc.image_x2, dxc.image_y2, x) - dxc.world_dx
-            i += 1
-        for dyc in self.dyconstraints:
-            r[i] = self.FunctionFy(dyc.image_x1, dyc.image_y1, x) - self.FunctionFy(dyc.image_x2, dyc.image_y2, x) - dyc.world_dy
-            i += 1
-        return r
+        return delta_residuals(x, self.dxcolumns(), self.dycolumns())
+
+    # Analytic Jacobian of FunctionG
+    def FunctionJ(self, x):
+        return delta_jacobian(x, self.dxcolumns(), self.dycolumns())
     
-    def ComputeSolution(self):
+    # use_cache=False always solves, e.g. for timing the solve itself
+    def ComputeSolution(self, use_cache=True):
         # m = number of rows, number of constraints
         self.m = len(self.dxconstraints) + len(self.dyconstraints)
         # n = number of params, 2+2+2 = 6
         self.n = 6
         x0 = [1, 0, 0, 0, 0, 0]
-        res = least_squares(self.FunctionG, x0)
-        
-        x = res.x
-        r = res.fun
+        key = self.fingerprint() if use_cache else None
+        res = self.cache.get(key) if use_cache else None
+        if res is None:
+            res = least_squares(self.FunctionG, x0, jac=self.FunctionJ)
+            if use_cache:
+                self.cache.put(key, res)
+        # Keep the full result, for iteration counts and the raw solution vector
+        self.result = res
+        return self.report_solution(res.x, res.fun)
+
+    # Fit from a spread of starting points across a process pool, keeping the lowest cost,
+    # see multistart.multistart_solve(); self.multistart holds every start's outcome
+    def ComputeMultiStartSolution(self, nstarts=None, workers=None, **kwargs):
+        from multistart import multistart_solve  # multistart imports this module
+        ms = multistart_solve(self.dxcolumns(), self.dycolumns(), nstarts, workers, **kwargs)
+        self.multistart = ms
+        print(f'starts={len(ms.costs)}, clusters={len(ms.clusters)}')
+        for members, cost in ms.clusters:
+            print(f'  {len(members)} starts -> cost={cost:.6g}')
+        return self.report_solution(ms.x, self.FunctionG(ms.x))
+
+    def report_solution(self, x, r):
         print(f'r={r}')
 
         print('NL Least Squares Solution:')
@@ -0,0 +1,108 @@
+from PySide6 import QtCore
+from numpy import array, asarray, ones
+
+from solver import BatchSVDSolver, SVDSolver, transform_from_solution
+from solvecache import fingerprint
+
+#
+#  Background solve service
+#
+# Solves run on a QThreadPool worker so the GUI thread keeps painting while markers
+# are dragged. Requests are coalesced: while a solve is running only the newest request
+# is kept, older ones are dropped, and the worker picks the newest up when it finishes.
+# Results come back through the solved signal, which Qt queues to the GUI thread.
+#
+# The solve is BatchSVDSolver (a plain class) rather than SVDSolver, whose pynnex
+# emitters want an asyncio loop that the Qt application does not run. Results share
+# SVDSolver.cache, so a constraint set that comes back (undo) is not solved again.
+#
+
+class SolveService(QtCore.QObject):
+    # request id, T (3x3), rank, solution type
+    solved = QtCore.Signal(int, object, int, int)
+    # request id, error message
+    failed = QtCore.Signal(int, str)
+
+    def __init__(self, parent: QtCore.QObject | None = None) -> None:
+        super().__init__(parent)
+        self.pool = QtCore.QThreadPool(self)
+        self.pool.setMaxThreadCount(1)
+        self.solver = BatchSVDSolver()
+        self._mutex = QtCore.QMutex()
+        self._pending: tuple | None = None
+        self._running = False
+        self._next_id = 0
+        self.latest = -1     # id of the newest request
+        self.dropped = 0     # requests replaced before they were solved
+
+    # Queue a solve of point constraints given as 1-d arrays, returns the request id
+    # A request still waiting is replaced, a solve already running finishes
+    def request(self, image_x, image_y, world_x, world_y, weight=None) -> int:
+        cols = tuple(asarray(c, dtype=float) for c in (image_x, image_y, world_x, world_y))
+        w = None if weight is None else asarray(weight, dtype=float)
+        with QtCore.QMutexLocker(self._mutex):
+            rid = self._next_id
+            self._next_id += 1
+            self.latest = rid
+            if self._pending is not None:
+                self.dropped += 1
+            self._pending = (rid, cols, w)
+            if self._running:
+                return rid
+            self._running = True
+        self.pool.start(_SolveTask(self))
+        return rid
+
+    # Next request for the worker, None when there is nothing left to do
+    def _take(self) -> tuple | None:
+        with QtCore.QMutexLocker(self._mutex):
+            job = self._pending
+            self._pending = None
+            if job is None:
+                self._running = False
+            return job
+
+    # Solve point constraints given as 1-d arrays on the calling thread, returns
+    # (T, rank, solution type); raises ValueError for fewer than 3 constraints
+    def solve(self, image_x, image_y, world_x, world_y, weight=None) -> tuple:
+        cols = tuple(asarray(c, dtype=float) for c in (image_x, image_y, world_x, world_y))
+        return self._compute(cols, None if weight is None else asarray(weight, dtype=float))
+
+    def _compute(self, cols: tuple, w) -> tuple:
+        if len(cols[0]) < 3:
+            raise ValueError(f'Need at least 3 point constraints, have {len(cols[0])}')
+        w = ones(len(cols[0])) if w is None else w
+        key = fingerprint('svd', *cols, w)
+        cached = SVDSolver.cache.get(key)
+        if cached is not None:
+            x, r, t = cached[:3]
+            return transform_from_solution(x[:,0]), int(r), int(t)
+        T, rs, ts = self.solver.ComputeSolutions(cols[0][None], cols[1][None], cols[2][None], cols[3][None], w[None])
+        # SVDSolver's solution vector (see transform_from_solution()); the model candidates
+        # are not known here, SVDSolver.ComputeSolution() solves again if it needs them
+        T = T[0]
+        x = array([[T[0,0]-1.], [T[0,1]], [T[0,2]], [T[1,2]], [T[2,0]], [T[2,1]]])
+        SVDSolver.cache.put(key, (x, int(rs[0]), int(ts[0]), None))
+        return T, int(rs[0]), int(ts[0])
+
+    def _solve(self, job: tuple) -> None:
+        rid, cols, w = job
+        try:
+            T, r, t = self._compute(cols, w)
+        except Exception as e:
+            self.failed.emit(rid, str(e))
+            return
+        self.solved.emit(rid, T, r, t)
+
+    # Block until the worker is idle, e.g. before shutting down
+    def wait(self, msecs: int = -1) -> bool:
+        return self.pool.waitForDone(msecs)
+
+class _SolveTask(QtCore.QRunnable):
+    def __init__(self, service: SolveService) -> None:
+        super().__init__()
+        self.service = service
+
+    def run(self) -> None:
+        while (job := self.service._take()) is not None:
+            self.service._solve(job)
@@ -0,0 +1,86 @@
+from numpy import asarray, arange, ones, eye, stack, linspace, meshgrid, einsum, sqrt, cov, broadcast_to, concatenate
+from numpy.random import default_rng
+
+from solver import BatchSVDSolver, transform_from_solution
+
+#
+#  Resampling uncertainty of the solution
+#
+# All resampled constraint sets are solved together with BatchSVDSolver,
+# so thousands of resamples cost a few stacked factorizations, not thousands of solves.
+#
+
+# Solution vector(s) back from transformation matrices, (...,3,3) -> (...,6)
+def solution_from_transform(T):
+    return stack((T[...,0,0]-1., T[...,0,1], T[...,0,2], T[...,1,2], T[...,2,0], T[...,2,1]), axis=-1)
+
+# Map image points through transformation(s), T (...,3,3) -> world x, y (...,k)
+def map_points(T, image_x, image_y):
+    p = stack((image_x, image_y, ones(len(image_x))))
+    q = einsum('...ij,jk->...ik', T, p)
+    return q[...,0,:]/q[...,2,:], q[...,1,:]/q[...,2,:]
+
+class UncertaintyResult:
+    def __init__(self, T, samples, covariance, image_x, image_y, world_x, world_y, error_x, error_y) -> None:
+        self.T = T                      # solution from all constraints
+        self.samples = samples          # (B,6) solution vector per resample
+        self.covariance = covariance    # (6,6) covariance of the solution vector
+        # Error field: query points in image and world coordinates, with the
+        # standard deviation of their world position (world units)
+        self.image_x, self.image_y = image_x, image_y
+        self.world_x, self.world_y = world_x, world_y
+        self.error_x, self.error_y = error_x, error_y
+        self.error = sqrt(error_x**2 + error_y**2)
+
+# image_x ... weight are the constraints, as 1-d arrays
+# method is 'bootstrap' (nsamples resamples with replacement) or 'jackknife' (leave one out)
+# points is an optional (image_x, image_y) pair of arrays where the error is wanted,
+# e.g. the board corners; by default a grid x grid field over the constraints' bounding box
+# max_elements bounds the size of each stacked solve
+def bootstrap_uncertainty(image_x, image_y, world_x, world_y, weight=None, nsamples=1000,
+                          method='bootstrap', points=None, grid=9, seed=None, max_elements=2**24):
+    cols = [asarray(c, dtype=float) for c in (image_x, image_y, world_x, world_y)]
+    n = len(cols[0])
+    cols.append(ones(n) if weight is None else broadcast_to(asarray(weight, dtype=float), (n,)))
+    solver = BatchSVDSolver()
+    T0 = solver.ComputeSolutions(*(c[None] for c in cols))[0][0]
+
+    if method == 'bootstrap':
+        idx = default_rng(seed).integers(0, n, size=(nsamples, n))
+        mask = ones(idx.shape, dtype=bool)
+    elif method == 'jackknife':
+        idx = broadcast_to(arange(n), (n, n))
+        mask = ~eye(n, dtype=bool)
+    else:
+        raise ValueError(f'Unknown resampling method: {method}')
+
+    # Solve in chunks so A (chunk x 2n x 6) stays bounded
+    chunk = max(1, max_elements // (12*n))
+    Ts = []
+    for i in range(0, len(idx), chunk):
+        sel = idx[i:i+chunk]
+        T, r, t = solver.ComputeSolutions(*(c[sel] for c in cols[:4]), cols[4][sel], mask[i:i+chunk])
+        Ts.append(T)
+    T = concatenate(Ts)
+    samples = solution_from_transform(T)
+
+    if method == 'bootstrap':
+        covariance = cov(samples, rowvar=False)
+    else:
+        centered = samples - samples.mean(axis=0)
+        covariance = (n-1)/n * centered.T @ centered
+
+    if points is None:
+        gx, gy = meshgrid(linspace(cols[0].min(), cols[0].max(), grid),
+                          linspace(cols[1].min(), cols[1].max(), grid))
+        px, py = gx.ravel(), gy.ravel()
+    else:
+        px, py = (asarray(p, dtype=float) for p in points)
+    wx, wy = map_points(T0, px, py)
+    sx, sy = map_points(T, px, py)
+    if method == 'bootstrap':
+        ex, ey = sx.std(axis=0, ddof=1), sy.std(axis=0, ddof=1)
+    else:
+        ex = sqrt((n-1)/n * ((sx - sx.mean(axis=0))**2).sum(axis=0))
+        ey = sqrt((n-1)/n * ((sy - sy.mean(axis=0))**2).sum(axis=0))
+    return UncertaintyResult(T0, samples, covariance, px, py, wx, wy, ex, ey)
@@ -0,0 +1,353 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from numpy import array, asarray, arange, empty, zeros, ones, floor, clip, sinc, take, multiply, repeat, \
+                  float32, float64, int64, issubdtype, integer, iinfo, rint, linspace, concatenate, full, \
+                  ascontiguousarray, roll, stack, sqrt, count_nonzero
+from numpy.linalg import inv
+from numpy.lib.format import open_memmap
+
+#
+#  Perspective warp: rectified image from a photo and its solution T
+#
+# T maps image pixels to world coordinates. The output is a grid of world coordinates
+# (OutputGeometry), and every output pixel is inverse mapped through T^-1 to a source
+# position, which is then sampled. Output tiles are independent, so they are mapped and
+# sampled on a thread pool; the numpy work in each tile releases the GIL.
+#
+# Sampling kernels are separable; a tile gathers k x k source pixels per output pixel
+# (1 nearest, 2 bilinear, 4 bicubic, 6 lanczos) for all channels at once.
+#
+
+METHODS = ('nearest', 'bilinear', 'bicubic', 'lanczos')
+
+# World rectangle covered by the output and its resolution
+# Output pixel (i, j) (row, column) has its center at world
+#   (x0 + (j+0.5)*pixel_size, y0 + (i+0.5)*pixel_size)
+class OutputGeometry:
+    def __init__(self, x0, y0, pixel_size, width, height) -> None:
+        self.x0, self.y0 = x0, y0
+        self.pixel_size = pixel_size
+        self.width, self.height = width, height
+
+    # The world bounding box of the whole photo at the given resolution
+    # (pixels per world unit, e.g. dpi for a board measured in inches)
+    @classmethod
+    def from_image(cls, T, width, height, resolution):
+        return cls.from_polygon(T, [(0., 0.), (width, 0.), (width, height), (0., height)], resolution)
+
+    # The world bounding box of a polygon (N,2) of image positions, e.g. the board outline
+    @classmethod
+    def from_polygon(cls, T, polygon, resolution):
+        T = asarray(T, dtype=float64)
+        q = asarray(polygon, dtype=float64) @ T[:,:2].T + T[:,2]
+        wx, wy = q[:,0]/q[:,2], q[:,1]/q[:,2]
+        size = 1./resolution
+        return cls(wx.min(), wy.min(), size,
+                   int((wx.max()-wx.min())/size + 0.5), int((wy.max()-wy.min())/size + 0.5))
+
+    def shape(self):
+        return (self.height, self.width)
+
+    # Output tiles as (row0, col0, rows, cols), optionally only of rows [start, stop)
+    def tiles(self, tile, start=0, stop=None):
+        stop = self.height if stop is None else stop
+        for r0 in range(start, stop, tile):
+            for c0 in range(0, self.width, tile):
+                yield r0, c0, min(tile, stop-r0), min(tile, self.width-c0)
+
+# Source position of every pixel of one output tile, as float64 (rows,cols) arrays
+# Tinv maps world to image; profile is an optional lens.CameraProfile, with
+# image_size (width, height) of the photo, for photos taken through a distorting lens
+def inverse_map_tile(Tinv, geometry, r0, c0, rows, cols, profile=None, image_size=None):
+    g = geometry
+    wx = g.x0 + (c0 + arange(cols) + 0.5)*g.pixel_size
+    wy = g.y0 + (r0 + arange(rows) + 0.5)*g.pixel_size
+    # The homography is affine along a row, so build it from outer sums
+    qx = Tinv[0,0]*wx[None,:] + (Tinv[0,1]*wy + Tinv[0,2])[:,None]
+    qy = Tinv[1,0]*wx[None,:] + (Tinv[1,1]*wy + Tinv[1,2])[:,None]
+    qw = Tinv[2,0]*wx[None,:] + (Tinv[2,1]*wy + Tinv[2,2])[:,None]
+    sx, sy = qx/qw, qy/qw
+    if profile is not None:
+        sx, sy = profile.distort_points(sx, sy, *image_size)
+    return sx, sy
+
+# Kernel weights for the k taps starting at floor(s) - k//2 + 1, as a list of k arrays
+# shaped like t (the fractional part of the source position)
+def kernel_weights(method, t):
+    if method == 'bilinear':
+        return [1.-t, t]
+    if method == 'bicubic':
+        # Keys cubic convolution, a = -0.5
+        a = -0.5
+        near = lambda d: ((a+2.)*d - (a+3.))*d*d + 1.
+        far = lambda d: ((a*d - 5.*a)*d + 8.*a)*d - 4.*a
+        return [far(1.+t), near(t), near(1.-t), far(2.-t)]
+    if method == 'lanczos':
+        w = [sinc(d)*sinc(d/3.) for d in (t+2., t+1., t, t-1., t-2., t-3.)]
+        total = sum(w)
+        return [wi/total for wi in w]
+    raise ValueError(f'Unknown sampling method: {method}')
+
+TAPS = {'nearest': 1, 'bilinear': 2, 'bicubic': 4, 'lanczos': 6}
+
+# Sample image (H,W) or (H,W,C) at source positions sx, sy (pixel centers at integer + 0.5,
+# as QImage and the marker positions use), returns float32 (...,C) and a mask of positions
+# inside the image. Taps outside the image are clamped to the edge.
+# image may be a window of a larger image: origin is the window's (x, y) offset and size
+# the full image's (width, height); the window must then extend a kernel width past the
+# positions, except where it meets the image edge.
+def sample(image, sx, sy, method='bilinear', origin=(0, 0), size=None):
+    H, W = image.shape[:2]
+    flat = image.reshape(H*W, -1)
+    fullw, fullh = size or (W, H)
+    inside = (sx > 0.) & (sx < fullw) & (sy > 0.) & (sy < fullh)
+    x = sx - (0.5 + origin[0])
+    y = sy - (0.5 + origin[1])
+    if method == 'nearest':
+        ix = clip(rint(x), 0, W-1).astype(int64)
+        iy = clip(rint(y), 0, H-1).astype(int64)
+        return take(flat, iy*W + ix, axis=0).astype(float32), inside
+    k = TAPS[method]
+    fx, fy = floor(x), floor(y)
+    # Weights repeated over the channels, so the products below run over contiguous
+    # arrays instead of broadcasting a length C inner loop
+    C = flat.shape[1]
+    wx = [repeat(w[...,None], C, axis=-1) for w in kernel_weights(method, (x-fx).astype(float32))]
+    wy = [repeat(w[...,None], C, axis=-1) for w in kernel_weights(method, (y-fy).astype(float32))]
+    bx = fx.astype(int64) - (k//2 - 1)
+    by = fy.astype(int64) - (k//2 - 1)
+    # Only tiles that reach the image edge need their taps clamped
+    interior = bx.min() >= 0 and bx.max() + k <= W and by.min() >= 0 and by.max() + k <= H
+    if interior:
+        base = by*W + bx
+    out = zeros(sx.shape + flat.shape[1:], dtype=float32)
+    acc = empty(out.shape, dtype=float32)
+    tmp = empty(out.shape, dtype=float32)
+    for j in range(k):
+        if not interior:
+            row = clip(by + j, 0, H-1)*W
+        acc[...] = 0.
+        for i in range(k):
+            idx = base + (j*W + i) if interior else row + clip(bx + i, 0, W-1)
+            multiply(wx[i], take(flat, idx, axis=0), out=tmp)
+            acc += tmp
+        multiply(wy[j], acc, out=tmp)
+        out += tmp
+    return out, inside
+
+# Convert sampled float32 values to the image dtype, rounding and saturating integers
+def to_dtype(values, dtype):
+    if issubdtype(dtype, integer):
+        info = iinfo(dtype)
+        return clip(rint(values), info.min, info.max).astype(dtype)
+    return values.astype(dtype)
+
+#
+#  Region of interest
+#
+# A convex polygon of image positions, e.g. the board outline from outline.py, limits
+# the warp to the pixels inside it: it is mapped to output pixels once, as half planes,
+# and tiles outside it are filled without being mapped or sampled. Tiles across its
+# edge sample only their pixels inside.
+#
+
+# Half planes (N,3) a, b, c with a*x + b*y + c >= 0 inside, of a convex polygon (N,2)
+def half_planes(polygon):
+    p = asarray(polygon, dtype=float64)
+    q = roll(p, -1, axis=0)
+    a, b = p[:,1] - q[:,1], q[:,0] - p[:,0]
+    # Counterclockwise (in x right, y up terms) or clockwise, inside is on the same side
+    if (p[:,0]*q[:,1] - q[:,0]*p[:,1]).sum() < 0:
+        a, b = -a, -b
+    return stack((a, b, -(a*p[:,0] + b*p[:,1])), axis=1)
+
+# Half planes of the convex polygon of image positions, in output pixel coordinates
+# (pixel (i, j) at j + 0.5, i + 0.5); None if the polygon crosses the horizon
+def region_planes(region, T, geometry):
+    p = asarray(region, dtype=float64)
+    T = asarray(T, dtype=float64)
+    q = p @ T[:,:2].T + T[:,2]
+    if not ((q[:,2] > 0).all() or (q[:,2] < 0).all()):
+        return None
+    g = geometry
+    return half_planes(stack(((q[:,0]/q[:,2] - g.x0)/g.pixel_size, (q[:,1]/q[:,2] - g.y0)/g.pixel_size), axis=1))
+
+# Pixels of an output tile inside the half planes, as a (rows,cols) bool array, or just
+# True or False when the whole tile is inside or outside. Pixels are kept when their
+# center is within half a pixel outside, so pixels on the outline are kept.
+def region_mask(planes, r0, c0, rows, cols):
+    slack = -0.5*sqrt(planes[:,0]**2 + planes[:,1]**2)
+    # The corner pixels decide most tiles, with the same test as every pixel: a convex
+    # region holds the tile if it holds its corners, and misses it if one half plane
+    # misses all of them
+    cx = array([c0, c0+cols-1, c0, c0+cols-1], dtype=float64) + 0.5
+    cy = array([r0, r0, r0+rows-1, r0+rows-1], dtype=float64) + 0.5
+    inside = (planes[:,0:1]*cx + planes[:,1:2]*cy + planes[:,2:3]) >= slack[:,None]
+    if inside.all():
+        return True
+    if (~inside).all(axis=1).any():
+        return False
+    x = c0 + arange(cols) + 0.5
+    y = r0 + arange(rows) + 0.5
+    mask = ones((rows, cols), dtype=bool)
+    # Only the half planes that cut the tile need testing per pixel
+    for (a, b, c), s in zip(planes[~inside.all(axis=1)], slack[~inside.all(axis=1)]):
+        mask &= (a*x[None,:] + (b*y + c)[:,None]) >= s
+    if not mask.any():
+        return False
+    return True if mask.all() else mask
+
+# image may be a window of the source, see sample()
+# planes limits the tile to a region, see region_planes()
+def warp_tile(image, Tinv, geometry, out, r0, c0, rows, cols, method, fill, profile,
+              origin=(0, 0), size=None, planes=None):
+    size = size or image.shape[1::-1]
+    dest = out[r0:r0+rows, c0:c0+cols]
+    keep = True if planes is None else region_mask(planes, r0, c0, rows, cols)
+    if keep is False:
+        dest[...] = fill
+        return
+    sx, sy = inverse_map_tile(Tinv, geometry, r0, c0, rows, cols, profile, size)
+    if keep is True or 2*count_nonzero(keep) > keep.size:
+        # Mostly inside: sampling the whole tile is cheaper than gathering the kept pixels
+        values, inside = sample(image, sx, sy, method, origin, size)
+        values[~(inside if keep is True else inside & keep)] = fill
+    else:
+        part, inside = sample(image, sx[keep], sy[keep], method, origin, size)
+        part[~inside] = fill
+        values = full(sx.shape + part.shape[1:], fill, dtype=float32)
+        values[keep] = part
+    dest[...] = to_dtype(values, out.dtype).reshape(dest.shape)
+
+# Rectify image (H,W) or (H,W,C) array with T (image -> world) onto geometry
+# out may be a preallocated array (or memmap) of shape geometry.shape() (+ channels)
+# fill is the value of output pixels that map outside the photo, or outside region,
+# an optional convex polygon (N,2) of image positions to limit the warp to
+def warp(image, T, geometry, method='bilinear', tile=256, workers=None, out=None, fill=0, profile=None,
+         region=None):
+    if method not in METHODS:
+        raise ValueError(f'Unknown sampling method: {method}')
+    image = asarray(image)
+    Tinv = inv(asarray(T, dtype=float64))
+    planes = None if region is None else region_planes(region, T, geometry)
+    if out is None:
+        out = empty(geometry.shape() + image.shape[2:], dtype=image.dtype)
+    workers = workers or os.cpu_count() or 1
+    tiles = list(geometry.tiles(tile))
+    if workers == 1:
+        for t in tiles:
+            warp_tile(image, Tinv, geometry, out, *t, method, fill, profile, planes=planes)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for f in [pool.submit(warp_tile, image, Tinv, geometry, out, *t, method, fill, profile,
+                                  planes=planes) for t in tiles]:
+                f.result()
+    return out
+
+#
+#  Out of core rectification
+#
+# The output is written in row bands straight into a .npy memmap. For each band only
+# the source window that band maps from is read (from a memmap, or anything that
+# slices like an array, e.g. a row band reader), so peak memory is bounded by the budget
+# whatever the size of the source or the output.
+#
+
+# Rough bytes of sampling temporaries per output pixel, see sample()
+def temp_bytes(method, channels):
+    k = TAPS[method]
+    return 8*8 + 4*channels*(2*k + 4)
+
+# Source window (x0, y0, x1, y1) that output rows [r0, r1) map from, with a kernel margin
+# The band's outline is mapped; None when it crosses the horizon (maps to infinity)
+def source_window(Tinv, geometry, r0, r1, method, size, profile=None, samples=33):
+    g = geometry
+    t = linspace(0., 1., samples)
+    bx = concatenate((t*g.width, t*g.width, zeros(samples), full(samples, g.width)))
+    by = concatenate((full(samples, r0), full(samples, r1), r0 + t*(r1-r0), r0 + t*(r1-r0)))
+    wx, wy = g.x0 + bx*g.pixel_size, g.y0 + by*g.pixel_size
+    qw = Tinv[2,0]*wx + Tinv[2,1]*wy + Tinv[2,2]
+    if not ((qw > 0).all() or (qw < 0).all()):
+        return None
+    sx = (Tinv[0,0]*wx + Tinv[0,1]*wy + Tinv[0,2])/qw
+    sy = (Tinv[1,0]*wx + Tinv[1,1]*wy + Tinv[1,2])/qw
+    if profile is not None:
+        sx, sy = profile.distort_points(sx, sy, *size)
+    margin = TAPS[method] + 1
+    W, H = size
+    x0 = int(clip(floor(sx.min()) - margin, 0, W))
+    x1 = int(clip(floor(sx.max()) + margin + 1, 0, W))
+    y0 = int(clip(floor(sy.min()) - margin, 0, H))
+    y1 = int(clip(floor(sy.max()) + margin + 1, 0, H))
+    return x0, y0, x1, y1
+
+# Sampling temporaries of workers tiles at once, in bands of rows rows
+def tile_temps(geometry, rows, method, channels, tile, workers):
+    return workers*min(tile, rows)*min(tile, geometry.width)*temp_bytes(method, channels)
+
+# Rows per band, halved until the band's source window, output and temporaries fit budget
+def band_rows(Tinv, geometry, r0, rows, method, source, profile, budget, tile, workers):
+    H, W = source.shape[:2]
+    C = source.shape[2] if source.ndim == 3 else 1
+    itemsize = source.dtype.itemsize
+    while True:
+        r1 = min(r0 + rows, geometry.height)
+        window = source_window(Tinv, geometry, r0, r1, method, (W, H), profile)
+        if window is None:
+            window = (0, 0, W, H)
+        x0, y0, x1, y1 = window
+        temps = tile_temps(geometry, r1-r0, method, C, tile, workers)
+        need = (x1-x0)*(y1-y0)*C*itemsize + (r1-r0)*geometry.width*C*itemsize + temps
+        if need <= budget or rows == 1:
+            return r1-r0, window, need
+        rows = max(1, rows//2)
+
+# Rectify source (H,W) or (H,W,C), e.g. numpy.load(path, mmap_mode='r'), into a new
+# .npy file at path, in row bands of at most budget bytes of working memory
+# progress(rows_done, rows_total) is called after each band; cancel is polled between
+# bands (a threading.Event or anything with is_set()). Returns the output opened as a read
+# only memmap, or None if cancelled, in which case the partial file is removed.
+# region limits the warp as in warp()
+def warp_to_file(source, T, geometry, path, method='bilinear', budget=512*2**20, tile=256,
+                 workers=None, fill=0, profile=None, progress=None, cancel=None, region=None):
+    if method not in METHODS:
+        raise ValueError(f'Unknown sampling method: {method}')
+    Tinv = inv(asarray(T, dtype=float64))
+    planes = None if region is None else region_planes(region, T, geometry)
+    workers = workers or os.cpu_count() or 1
+    H, W = source.shape[:2]
+    C = source.shape[2] if source.ndim == 3 else 1
+    # Fewer workers when their tiles' temporaries would take more than half the budget,
+    # so the bands, not the sampling, get the rest
+    per_worker = tile_temps(geometry, tile, method, C, tile, 1)
+    workers = max(1, min(workers, budget//2//per_worker))
+    out = open_memmap(path, mode='w+', dtype=source.dtype, shape=geometry.shape() + source.shape[2:])
+    rows = geometry.height
+    r0 = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while r0 < geometry.height:
+            if cancel is not None and cancel.is_set():
+                del out
+                os.remove(path)
+                return None
+            rows, (x0, y0, x1, y1), need = band_rows(Tinv, geometry, r0, rows, method, source,
+                                                    profile, budget, tile, workers)
+            r1 = r0 + rows
+            window = ascontiguousarray(source[y0:y1, x0:x1])
+            if window.size == 0:
+                out[r0:r1] = fill
+            else:
+                futures = [pool.submit(warp_tile, window, Tinv, geometry, out, *t, method, fill, profile,
+                                       (x0, y0), (W, H), planes) for t in geometry.tiles(tile, r0, r1)]
+                for f in futures:
+                    f.result()
+            # Written pages go back to the file, so they do not pile up in memory
+            out.flush()
+            del window
+            r0 = r1
+            # Try a larger band next time, band_rows() halves it again if needed
+            rows *= 2
+            if progress is not None:
+                progress(r0, geometry.height)
+    del out
+    return open_memmap(path, mode='r')
@@ -0,0 +1,211 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import blake2b
+from pathlib import Path
+from numpy import asarray, array, empty, stack, float64, floor, load, save
+from numpy.linalg import inv
+
+from warp import METHODS, OutputGeometry, inverse_map_tile, sample, to_dtype
+
+#
+#  Cache of inverse maps and rectified tiles
+#
+# Output is rendered in tiles of a world lattice: lattice pixel n covers world
+# phase + n*pixel_size, for every output geometry with the same pixel size and phase.
+# Crops that move by whole pixels, or grow and shrink, therefore hit the same tiles.
+#
+# Two kinds of entry share one LRU:
+#   map   source position of every pixel of a lattice tile, keyed on T (and lens profile
+#         with the photo size), pixel size, phase and tile index; reused for any image
+#         and sampling method
+#   tile  sampled pixels, keyed on the map key plus image content, method and fill;
+#         reused by repeated exports and crops, converted to any output format later
+#
+
+# Content hash of an image array (or memmap), read in row bands
+def image_digest(image, band_rows=256):
+    image = asarray(image)
+    h = blake2b(digest_size=16)
+    h.update(f'{image.shape}{image.dtype.str}'.encode())
+    for r0 in range(0, image.shape[0], band_rows):
+        h.update(array(image[r0:r0+band_rows]).tobytes())
+    return h.hexdigest()
+
+# With a lens profile the source positions also depend on the photo's (width, height),
+# the distortion center being a fraction of it
+def transform_digest(T, profile=None, image_size=None):
+    h = blake2b(digest_size=16)
+    h.update(asarray(T, dtype=float64).tobytes())
+    if profile is not None:
+        h.update(profile.digest().encode())
+        h.update(repr(tuple(image_size)).encode())
+    return h.hexdigest()
+
+# LRU of numpy arrays bounded by total bytes, safe to use from worker threads
+# With a directory, entries are also written there as <key>.npy and read back on a miss,
+# so they survive eviction and restarts; disk_maxbytes bounds the directory, dropping
+# the least recently written files first.
+class ArrayCache:
+    def __init__(self, maxbytes=512*2**20, directory=None, disk_maxbytes=None) -> None:
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.entries: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.directory = None if directory is None else Path(directory)
+        self.disk_maxbytes = disk_maxbytes
+        self.disk: OrderedDict = OrderedDict()
+        if self.directory is not None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            files = sorted(self.directory.glob('*.npy'), key=lambda p: p.stat().st_mtime)
+            for p in files:
+                self.disk[p.stem] = p.stat().st_size
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            ondisk = key in self.disk
+        if ondisk:
+            try:
+                value = load(self.directory / f'{key}.npy')
+            except (OSError, ValueError):
+                value = None
+            if value is not None:
+                self.put(key, value, persist=False)
+                with self.lock:
+                    self.disk_hits += 1
+                return value
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, value, persist=True) -> None:
+        with self.lock:
+            if key in self.entries:
+                self.nbytes -= self.entries.pop(key).nbytes
+            self.entries[key] = value
+            self.nbytes += value.nbytes
+            while self.nbytes > self.maxbytes and len(self.entries) > 1:
+                self.nbytes -= self.entries.popitem(last=False)[1].nbytes
+        if persist and self.directory is not None:
+            self.write(key, value)
+
+    def write(self, key, value) -> None:
+        directory = self.directory
+        if directory is None:
+            return
+        path = directory / f'{key}.npy'
+        tmp = directory / f'{key}.{threading.get_ident()}.tmp'
+        with open(tmp, 'wb') as f:
+            save(f, value)
+        os.replace(tmp, path)
+        with self.lock:
+            self.disk[key] = path.stat().st_size
+            self.disk.move_to_end(key)
+            if self.disk_maxbytes is None:
+                return
+            total = sum(self.disk.values())
+            while total > self.disk_maxbytes and len(self.disk) > 1:
+                old, size = self.disk.popitem(last=False)
+                total -= size
+                (directory / f'{old}.npy').unlink(missing_ok=True)
+
+    def clear(self, disk=False) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+            self.hits = self.misses = self.disk_hits = 0
+            if disk and self.directory is not None:
+                for key in self.disk:
+                    (self.directory / f'{key}.npy').unlink(missing_ok=True)
+                self.disk.clear()
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'disk_hits': self.disk_hits,
+                'size': len(self.entries), 'nbytes': self.nbytes, 'maxbytes': self.maxbytes}
+
+class WarpCache:
+    def __init__(self, maxbytes=512*2**20, directory=None, disk_maxbytes=None, tile=256) -> None:
+        self.cache = ArrayCache(maxbytes, directory, disk_maxbytes)
+        self.tile = tile
+
+    # Lattice phase of a geometry, quantized so that crops computed with slightly
+    # different rounding still land on the same lattice
+    def lattice(self, geometry):
+        ps = geometry.pixel_size
+        nx, ny = floor(geometry.x0/ps + 1e-6), floor(geometry.y0/ps + 1e-6)
+        px = round(geometry.x0/ps - nx, 4)
+        py = round(geometry.y0/ps - ny, 4)
+        return int(nx), int(ny), px, py
+
+    def map_key(self, tdigest, geometry, ti, tj):
+        nx, ny, px, py = self.lattice(geometry)
+        return f'map-{tdigest}-{geometry.pixel_size!r}-{px}-{py}-{self.tile}-{ti}-{tj}'
+
+    def tile_geometry(self, geometry, ti, tj):
+        nx, ny, px, py = self.lattice(geometry)
+        ps = geometry.pixel_size
+        return OutputGeometry((px + tj*self.tile)*ps, (py + ti*self.tile)*ps, ps, self.tile, self.tile)
+
+    # Source positions of a lattice tile, (2,tile,tile)
+    def inverse_map(self, Tinv, tdigest, geometry, ti, tj, profile=None, image_size=None):
+        key = self.map_key(tdigest, geometry, ti, tj)
+        maps = self.cache.get(key)
+        if maps is None:
+            g = self.tile_geometry(geometry, ti, tj)
+            maps = stack(inverse_map_tile(Tinv, g, 0, 0, self.tile, self.tile, profile, image_size))
+            self.cache.put(key, maps)
+        return maps
+
+    def render_tile(self, image, digest, Tinv, tdigest, geometry, ti, tj, method, fill, profile):
+        key = f'tile-{digest}-{method}-{fill!r}-' + self.map_key(tdigest, geometry, ti, tj)
+        values = self.cache.get(key)
+        if values is None:
+            maps = self.inverse_map(Tinv, tdigest, geometry, ti, tj, profile, image.shape[1::-1])
+            values, inside = sample(image, maps[0], maps[1], method)
+            values[~inside] = fill
+            values = to_dtype(values, image.dtype).reshape((self.tile, self.tile) + image.shape[2:])
+            self.cache.put(key, values)
+        return values
+
+    # Same as warp.warp(), through the cache
+    # digest is the image's content key if already known (see image_digest())
+    def warp(self, image, T, geometry, method='bilinear', workers=None, fill=0, profile=None, digest=None):
+        if method not in METHODS:
+            raise ValueError(f'Unknown sampling method: {method}')
+        image = asarray(image)
+        digest = digest or image_digest(image)
+        tdigest = transform_digest(T, profile, image.shape[1::-1])
+        Tinv = inv(asarray(T, dtype=float64))
+        out = empty(geometry.shape() + image.shape[2:], dtype=image.dtype)
+        nx, ny, px, py = self.lattice(geometry)
+        t = self.tile
+        jobs = [(ti, tj) for ti in range(ny//t, (ny + geometry.height - 1)//t + 1)
+                         for tj in range(nx//t, (nx + geometry.width - 1)//t + 1)]
+
+        def place(ti, tj):
+            values = self.render_tile(image, digest, Tinv, tdigest, geometry, ti, tj, method, fill, profile)
+            # Overlap of the lattice tile with the output, in lattice pixels
+            r0, r1 = max(ti*t, ny), min((ti+1)*t, ny + geometry.height)
+            c0, c1 = max(tj*t, nx), min((tj+1)*t, nx + geometry.width)
+            out[r0-ny:r1-ny, c0-nx:c1-nx] = values[r0-ti*t:r1-ti*t, c0-tj*t:c1-tj*t]
+
+        workers = workers or os.cpu_count() or 1
+        if workers == 1:
+            for job in jobs:
+                place(*job)
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                for f in [pool.submit(place, *job) for job in jobs]:
+                    f.result()
+        return out
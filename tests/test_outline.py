@@ -0,0 +1,50 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from imagefile import read_image
+from outline import detect_outline
+from warp import half_planes
+
+IMAGES = Path(__file__).parent.parent / 'testimages'
+
+def polygon_area(p):
+    x, y = p[:, 0], p[:, 1]
+    return abs(np.dot(x, np.roll(y, 1)) - np.dot(y, np.roll(x, 1)))/2
+
+def inside(polygon, points):
+    planes = half_planes(polygon)
+    return ((points @ planes[:, :2].T + planes[:, 2]) >= 0).all(axis=1)
+
+@pytest.fixture(scope='module')
+def image1():
+    return read_image(IMAGES / 'image1.jpg')
+
+# The board in image1.jpg fills the width and the middle of the frame, with a rail,
+# cables and a textured surface above and below it
+def test_outline_fits_board(image1):
+    H, W = image1.shape[:2]
+    polygon = detect_outline(image1)
+    assert polygon is not None
+    # Points just inside the board's corners
+    corners = np.array([(400., 840.), (1980., 760.), (2040., 2880.), (160., 2840.)])
+    assert inside(polygon, corners).all()
+    # Background above and below the board
+    background = np.array([(1100., 400.), (1100., 3400.), (300., 3600.), (2000., 300.)])
+    assert not inside(polygon, background).any()
+    assert polygon_area(polygon) < 0.56*W*H
+
+# Green board with traces on a grey background as busy as the board
+def test_outline_by_color():
+    rng = np.random.default_rng(1)
+    image = rng.normal(128, 40, (600, 800, 3)).clip(0, 255).astype(np.uint8)
+    board = np.zeros((600, 800), bool)
+    board[150:450, 200:650] = True
+    image[board] = (60, 140, 70)
+    image[150:450:12, 220:630] = (200, 200, 190)
+    image[170:430, 230:620:16] = (200, 200, 190)
+    polygon = detect_outline(image, size=256)
+    assert polygon is not None
+    assert inside(polygon, np.array([(205., 155.), (645., 155.), (645., 445.), (205., 445.)])).all()
+    assert polygon_area(polygon) < 1.3*450*300
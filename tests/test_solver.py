@@ -0,0 +1,111 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from robust import RobustEstimator
+from solvecache import fingerprint
+from solver import BatchSVDSolver, SVDSolver, stack_constraint_sets, transform_from_solution
+
+# Solution vector of a mild perspective: scale, rotation, translation, perspective
+X_TRUE = np.array([0.05, 0.02, 12., -7., 2e-5, -3e-5])
+
+# SVDSolver's emitters need a running event loop when it is created
+def make_solver():
+    async def create():
+        return SVDSolver()
+    return asyncio.run(create())
+
+# Point constraints (image_x, image_y, world_x, world_y) of x, with noise in world units
+def point_constraints(rng, n, x=X_TRUE, noise=0.01):
+    ix, iy = rng.uniform(0, 1000, (2, n))
+    q = transform_from_solution(x) @ np.stack((ix, iy, np.ones(n)))
+    wx, wy = q[0]/q[2], q[1]/q[2]
+    return ix, iy, wx + rng.normal(0, noise, n), wy + rng.normal(0, noise, n)
+
+def test_incremental_matches_batch():
+    rng = np.random.default_rng(0)
+    cols = point_constraints(rng, 40)
+    s = make_solver()
+    s.SetIncremental()
+    handles = s.CreateConstraints(*cols)
+    # Edit like the GUI does: drag some, delete some, add some
+    for c in handles[:5]:
+        s.MoveConstraint(c, image_x=c.image_x + 1., world_y=c.world_y - 0.5)
+    for c in handles[10:20]:
+        s.DestroyConstraint(c, emit=False)
+    s.CreateConstraints(*point_constraints(rng, 7))
+    T_inc = s.ComputeSolution()
+    # Same constraints, solved from scratch
+    b = make_solver()
+    b.CreateConstraints(*(s.store.column(f) for f in ('image_x', 'image_y', 'world_x', 'world_y', 'weight')))
+    T_batch = b.ComputeSolution()
+    np.testing.assert_allclose(T_inc, T_batch, rtol=1e-9, atol=1e-12)
+
+def test_stream_matches_batch():
+    rng = np.random.default_rng(1)
+    cols = point_constraints(rng, 1000)
+    s = make_solver()
+    s.CreateConstraints(*cols)
+    T = s.ComputeSolution()
+    chunks = (tuple(c[i:i+128] for c in cols) for i in range(0, 1000, 128))
+    assert s.IngestConstraints(chunks) == 1000
+    np.testing.assert_allclose(s.ComputeStreamSolution(), T, rtol=1e-9, atol=1e-12)
+
+def test_batch_solver_matches_svdsolver():
+    rng = np.random.default_rng(2)
+    sets = [np.stack(point_constraints(rng, n), axis=1) for n in (3, 4, 9, 25)]
+    *cols, mask = stack_constraint_sets(sets)
+    T, r, t = BatchSVDSolver().ComputeSolutions(*cols, mask=mask)
+    for k, c in enumerate(sets):
+        s = make_solver()
+        s.CreateConstraints(*c.T)
+        np.testing.assert_allclose(T[k], s.ComputeSolution(), rtol=1e-9, atol=1e-12)
+
+def test_fingerprint_ignores_order():
+    rng = np.random.default_rng(3)
+    cols = point_constraints(rng, 20)
+    perm = rng.permutation(20)
+    assert fingerprint('svd', *cols) == fingerprint('svd', *(c[perm] for c in cols))
+    assert fingerprint('svd', *cols) != fingerprint('nlls', *cols)
+    moved = [c.copy() for c in cols]
+    moved[0][5] += 1e-9
+    assert fingerprint('svd', *cols) != fingerprint('svd', *moved)
+    # -0. and 0. are the same value
+    zeros = [np.zeros(3)]*4
+    assert fingerprint('svd', *zeros) == fingerprint('svd', *(-z for z in zeros))
+
+def test_cache_hit_keeps_model_residuals():
+    rng = np.random.default_rng(4)
+    # Two points leave the full model rank deficient, so the reduced models are solved
+    # and the no skew one is preferred
+    cols = point_constraints(rng, 2, x=np.array([0.05, 0.02, 12., -7., 0., 0.]), noise=0.)
+    s = make_solver()
+    s.CreateConstraints(*cols)
+    T = s.ComputeSolution()
+    residuals = s.ModelResiduals()
+    assert set(residuals) == {'full', 'no_x_skew', 'no_y_skew', 'no_skew'}
+    hits = SVDSolver.cache.hits
+    again = make_solver()
+    again.CreateConstraints(*(c[::-1] for c in cols))
+    np.testing.assert_array_equal(again.ComputeSolution(), T)
+    assert SVDSolver.cache.hits == hits + 1
+    assert again.ModelResiduals() == residuals
+
+@pytest.mark.parametrize('method, threshold', [('ransac', 0.1), ('lmeds', None)])
+def test_robust_recovers_inliers(method, threshold):
+    rng = np.random.default_rng(5)
+    ix, iy, wx, wy = point_constraints(rng, 40)
+    outliers = rng.choice(40, 10, replace=False)
+    wx[outliers] += rng.uniform(5, 50, 10)*rng.choice((-1, 1), 10)
+    s = make_solver()
+    s.CreateConstraints(ix, iy, wx, wy)
+    T = s.ComputeRobustSolution(method, threshold, seed=0)
+    expected = np.ones(40, dtype=bool)
+    expected[outliers] = False
+    np.testing.assert_array_equal(s.inliers, expected)
+    np.testing.assert_allclose(T, transform_from_solution(X_TRUE), rtol=1e-3, atol=1e-3)
+
+def test_robust_estimator_needs_threshold():
+    with pytest.raises(ValueError):
+        RobustEstimator('ransac')
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+from scipy.ndimage import gaussian_filter, shift
+
+from phasecorr import phase_correlate
+from warp import METHODS, OutputGeometry, warp, warp_to_file
+
+# Mild perspective, image to world
+T = np.array([[1.02, 0.05, 3.], [-0.04, 0.98, -2.], [2e-4, -1e-4, 1.]])
+
+@pytest.fixture(scope='module')
+def image():
+    rng = np.random.default_rng(0)
+    return rng.integers(0, 256, (300, 400, 3), dtype=np.uint8)
+
+# warp_to_file() works in row bands sized to the budget; it must give the same pixels as
+# warp() of the whole image
+@pytest.mark.parametrize('method', METHODS)
+def test_warp_to_file_matches_warp(tmp_path, image, method):
+    geometry = OutputGeometry.from_image(T, 400, 300, 1.5)
+    expected = warp(image, T, geometry, method, tile=64)
+    out = warp_to_file(image, T, geometry, tmp_path / 'out.npy', method, budget=2**19, tile=64, workers=2)
+    np.testing.assert_array_equal(out, expected)
+
+def test_warp_to_file_region_matches_warp(tmp_path, image):
+    region = np.array([(40., 30.), (350., 60.), (370., 260.), (60., 280.)])
+    geometry = OutputGeometry.from_polygon(T, region, 1.)
+    expected = warp(image, T, geometry, 'bilinear', tile=32, region=region)
+    out = warp_to_file(image, T, geometry, tmp_path / 'out.npy', 'bilinear', budget=2**18, tile=32,
+                       workers=2, region=region)
+    np.testing.assert_array_equal(out, expected)
+
+def test_warp_to_file_cancel(tmp_path, image):
+    class Cancelled:
+        def is_set(self):
+            return True
+    geometry = OutputGeometry.from_image(T, 400, 300, 1.)
+    path = tmp_path / 'out.npy'
+    assert warp_to_file(image, T, geometry, path, cancel=Cancelled()) is None
+    assert not path.exists()
+
+@pytest.mark.parametrize('dx, dy', [(7., -3.), (-12.25, 5.5), (0.4, 0.)])
+def test_phase_correlate_offset(dx, dy):
+    rng = np.random.default_rng(1)
+    a = gaussian_filter(rng.normal(size=(256, 256)), 2.)
+    # b(x, y) = a(x - dx, y - dy)
+    b = shift(a, (dy, dx), order=3, mode='wrap')
+    found = phase_correlate(a, b)
+    assert found is not None
+    assert found[0] == pytest.approx(dx, abs=0.05)
+    assert found[1] == pytest.approx(dy, abs=0.05)
+    assert found[2] > 0.5
+
+def test_phase_correlate_unrelated():
+    rng = np.random.default_rng(2)
+    a, b = (gaussian_filter(rng.normal(size=(128, 128)), 2.) for _ in range(2))
+    assert phase_correlate(a, b)[2] < 0.3
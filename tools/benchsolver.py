@@ -0,0 +1,195 @@
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+import subprocess
+import tracemalloc
+from io import StringIO
+from pathlib import Path
+from contextlib import redirect_stdout
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+from solver import SVDSolver, transform_from_solution
+from solver2 import NLLSSolver
+
+'''
+Solver benchmark
+
+Times SVDSolver and NLLSSolver on synthetic constraint sets with a known
+ground truth transformation, and writes the results as JSON so runs from
+different commits can be compared:
+
+    python tools/benchsolver.py --output before.json
+    (change something)
+    python tools/benchsolver.py --output after.json --compare before.json
+
+Each case reports the best wall time over the repeats, the peak Python heap
+memory (tracemalloc, from a separate run) and the parameter error against truth.
+'''
+
+IMAGE_W, IMAGE_H = 4000., 3000.
+
+# Ground truth solution vectors, in SVDSolver form (see transform_from_solution)
+# Scale is ~1/400 (pixels to inches), so the skew terms are small but significant
+CASES = {
+    'skew':     np.array([-0.9975, 0.0002, 0.5, 0.7, 2e-6, 3e-6]),
+    'x_skew':   np.array([-0.9975, 0.0002, 0.5, 0.7, 2e-6, 0.]),
+    'no_skew':  np.array([-0.9975, 0.0002, 0.5, 0.7, 0., 0.]),
+    # All image points on one line, so the system is rank deficient
+    'rank_deficient': np.array([-0.9975, 0.0002, 0.5, 0.7, 0., 0.]),
+}
+
+def map_points(x, image_x, image_y):
+    T = transform_from_solution(x)
+    w = T @ np.stack((image_x, image_y, np.ones_like(image_x)))
+    return w[0]/w[2], w[1]/w[2]
+
+def image_points(rng, n, case):
+    image_x = rng.uniform(0., IMAGE_W, n)
+    if case == 'rank_deficient':
+        image_y = 0.5*image_x + 100.
+    else:
+        image_y = rng.uniform(0., IMAGE_H, n)
+    return image_x, image_y
+
+# n point constraints, world positions with gaussian noise (world units)
+def point_constraints(rng, n, case, noise):
+    x = CASES[case]
+    image_x, image_y = image_points(rng, n, case)
+    world_x, world_y = map_points(x, image_x, image_y)
+    return image_x, image_y, world_x + rng.normal(0., noise, n), world_y + rng.normal(0., noise, n)
+
+# n delta X and n delta Y constraints between random point pairs
+def delta_constraints(rng, n, case, noise):
+    x = CASES[case]
+    x1, y1 = image_points(rng, n, case)
+    x2, y2 = image_points(rng, n, case)
+    wx1, wy1 = map_points(x, x1, y1)
+    wx2, wy2 = map_points(x, x2, y2)
+    return x1, y1, x2, y2, wx1-wx2 + rng.normal(0., noise, n), wy1-wy2 + rng.normal(0., noise, n)
+
+# Max world position error over the image corners, for a solution T
+# Delta constraints do not fix the translation, so relative=True ignores the mean offset
+def corner_error(T, x, relative=False):
+    cx = np.array([0., IMAGE_W, 0., IMAGE_W])
+    cy = np.array([0., 0., IMAGE_H, IMAGE_H])
+    w = T @ np.stack((cx, cy, np.ones(4)))
+    tx, ty = map_points(x, cx, cy)
+    ex, ey = w[0]/w[2]-tx, w[1]/w[2]-ty
+    if relative:
+        ex, ey = ex-ex.mean(), ey-ey.mean()
+    return float(np.max(np.hypot(ex, ey)))
+
+def run_svd(data):
+    s = SVDSolver()
+    s.CreateConstraints(*data)
+    A, b = s.BuildMatrix()
+    x, r, t = s.compute_solution(A, b)
+    return transform_from_solution(x[:,0]), {'rank': int(r), 'type': int(t)}
+
+def run_nlls(data):
+    s = NLLSSolver()
+    x1, y1, x2, y2, dx, dy = data
+    s.CreateDXConstraints(x1, y1, x2, y2, dx)
+    s.CreateDYConstraints(x1, y1, x2, y2, dy)
+    # Bypass the result cache, or repeats after the first would not solve
+    with redirect_stdout(StringIO()):
+        s.ComputeSolution(use_cache=False)
+    res = s.result
+    # NLLSSolver uses the scale directly in x[0], SVDSolver uses scale-1
+    x = res.x.copy()
+    x[0] -= 1.
+    return transform_from_solution(x), {'nfev': int(res.nfev), 'cost': float(res.cost)}
+
+SOLVERS = {
+    'svd':  (run_svd, point_constraints),
+    'nlls': (run_nlls, delta_constraints),
+}
+
+def bench_case(solver, case, n, noise, repeat, seed):
+    run, generate = SOLVERS[solver]
+    rng = np.random.default_rng(seed)
+    data = generate(rng, n, case, noise)
+    # Memory in its own run, tracemalloc slows things down
+    tracemalloc.start()
+    run(data)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    times = []
+    for i in range(0, repeat):
+        t0 = time.perf_counter()
+        T, info = run(data)
+        times.append(time.perf_counter() - t0)
+    record = {
+        'solver': solver, 'case': case, 'n': n, 'noise': noise,
+        'time': min(times), 'times': times, 'peak_bytes': peak,
+        # Parameters are not defined when the system is rank deficient
+        'corner_error': corner_error(T, CASES[case], solver == 'nlls') if case != 'rank_deficient' else None,
+        'param_error': float(np.max(np.abs(T - transform_from_solution(CASES[case])))),
+    }
+    record.update(info)
+    return record
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, cwd=Path(__file__).parent).stdout.strip()
+    except OSError:
+        return ''
+
+def compare(results, old):
+    key = lambda r: (r['solver'], r['case'], r['n'])
+    before = {key(r): r for r in old['results']}
+    print(f"\n{'solver':6} {'case':15} {'n':>8} {'before':>10} {'after':>10} {'ratio':>6}")
+    for r in results:
+        o = before.get(key(r))
+        if o is not None:
+            print(f"{r['solver']:6} {r['case']:15} {r['n']:8} {o['time']:10.5f} {r['time']:10.5f} {r['time']/o['time']:6.2f}")
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark the rectify solvers')
+    parser.add_argument('--solvers', nargs='+', default=list(SOLVERS), choices=list(SOLVERS))
+    parser.add_argument('--cases', nargs='+', default=list(CASES), choices=list(CASES))
+    parser.add_argument('--counts', nargs='+', type=int, default=[4, 16, 100, 1000, 10000, 100000, 1000000])
+    parser.add_argument('--nlls-max', type=int, default=100000, help='largest count run with NLLSSolver')
+    parser.add_argument('--noise', type=float, default=1e-4, help='world units (inches)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='bench_output.json')
+    parser.add_argument('--compare', help='earlier results file to compare against')
+    args = parser.parse_args()
+
+    async def run_all() -> list:
+        # The solvers' emitters need a running event loop
+        results = []
+        for solver in args.solvers:
+            for case in args.cases:
+                for n in args.counts:
+                    if solver == 'nlls' and n > args.nlls_max:
+                        continue
+                    r = bench_case(solver, case, n, args.noise, args.repeat, args.seed)
+                    err = '-' if r['corner_error'] is None else f"{r['corner_error']:.3g}"
+                    print(f"{solver:6} {case:15} {n:8} {r['time']:10.5f}s {r['peak_bytes']/1e6:9.2f}MB  err={err}")
+                    results.append(r)
+        return results
+
+    results = asyncio.run(run_all())
+    output = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+if __name__ == '__main__':
+    main()